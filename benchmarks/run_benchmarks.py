@@ -0,0 +1,168 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import subprocess
+
+import numpy as np
+
+# Run from a checkout without installing the package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dbnl_bear.fake_server import FakeOpenAIServer
+from dbnl_bear.results_store import ResultsStore, STORE_NAME
+from dbnl_bear.processing import METRICS_SUMMARY_NAME
+
+"""
+End-to-end throughput benchmark: runs the dbnl-bear CLI over (part of) the notebook/tulips
+corpus against the fake OpenAI server (dbnl_bear/fake_server.py), for every combination of
+``--max_document_tasks`` and ``--max_concurrent_requests`` given, and reports per setting:
+
+- chunks per second (chunks judged, from the results store of the run, over wall time)
+- p50/p95/p99 request latency as the client saw it: from handing a request to the scheduler
+  until it returned, so including waits for a slot, 429 retries and their backoff (from
+  ``dbnl_bear_request_end_to_end_seconds`` in the run's metrics summary; interpolated within
+  the histogram buckets)
+- p50/p95/p99 of the server's own handling time, which mostly reflects ``--latency``
+- peak RSS of the CLI process
+- requests sent, retries (the injected 429s) and failures
+
+Every benchmark starts a fresh server and runs without the judgement cache and without rate
+limits, so only the pipeline is measured. The results are written as JSON; pass an earlier
+result file with ``--baseline`` to print the change in throughput per setting.
+
+    python benchmarks/run_benchmarks.py --files 5 --document_tasks 1 4 --concurrency 10 50
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CORPUS = os.path.join(ROOT, "notebook", "tulips")
+_REQUESTS = re.compile(r"Requests sent: (\d+), retried: (\d+), failed: (\d+)")
+_CLIENT_LATENCY = "dbnl_bear_request_end_to_end_seconds"
+
+
+def prepare_corpus(corpus: str, files: int, directory: str) -> str:
+    """Input directory with links to the first ``files`` texts of ``corpus`` (all with files=0)."""
+    names = sorted(f for f in os.listdir(corpus) if f.endswith(".txt"))
+    if files:
+        names = names[:files]
+    input_dir = os.path.join(directory, "input")
+    os.makedirs(input_dir)
+    for name in names:
+        os.symlink(os.path.join(os.path.abspath(corpus), name), os.path.join(input_dir, name))
+    return input_dir
+
+
+def run_benchmark(input_dir: str, output_dir: str, document_tasks: int, concurrency: int, args) -> dict:
+    with FakeOpenAIServer(latency=args.latency, rate_limit_rate=args.rate_limit_rate,
+                          retry_after=args.retry_after, seed=args.seed) as server:
+        env = dict(os.environ, OPENAI_API_KEY="fake", OPENAI_BASE_URL=server.base_url,
+                   PYTHONPATH=os.pathsep.join(filter(None, (ROOT, os.environ.get("PYTHONPATH")))))
+        env.pop("OPENAI_API_BASE", None)
+        command = [sys.executable, "-m", "dbnl_bear.cli", "run", args.phenomenon,
+                   "--input_dir", input_dir, "--output_dir", output_dir, "--no_cache",
+                   "--max_document_tasks", str(document_tasks), "--max_concurrent_requests", str(concurrency),
+                   "--requests_per_minute", "1e9", "--tokens_per_minute", "1e12",
+                   "--batch_size", str(args.batch_size)]
+        started = time.perf_counter()
+        process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        output = process.stdout.read()
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - started
+        process.returncode = os.waitstatus_to_exitcode(status)
+        stats = server.stats()
+    if process.returncode != 0:
+        raise RuntimeError(f"The run failed (exit code {process.returncode}):\n{output[-2000:]}")
+
+    store = ResultsStore(os.path.join(output_dir, STORE_NAME))
+    chunks = sum(row["chunks"] for row in store.summary())
+    store.close()
+    match = _REQUESTS.search(output)
+    requests, retries, failures = (int(n) for n in match.groups()) if match else (None, None, None)
+    with open(os.path.join(output_dir, METRICS_SUMMARY_NAME), "r", encoding="utf-8") as f:
+        client = json.load(f)["histograms"].get(_CLIENT_LATENCY, {})
+    server_latencies = np.array(stats["latencies"]) * 1000
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak_rss = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return {
+        "max_document_tasks": document_tasks,
+        "max_concurrent_requests": concurrency,
+        "chunks": chunks,
+        "seconds": round(seconds, 3),
+        "chunks_per_second": round(chunks / seconds, 2),
+        "latency_ms": {f"p{q}": round(client[f"p{q}"] * 1000, 2) if client.get(f"p{q}") is not None else None
+                       for q in (50, 95, 99)},
+        "server_latency_ms": {f"p{q}": round(float(np.percentile(server_latencies, q)), 2)
+                              if len(server_latencies) else None for q in (50, 95, 99)},
+        "peak_rss_mb": round(peak_rss, 1),
+        "requests": requests,
+        "retries": retries,
+        "failures": failures,
+        "rate_limited_by_server": stats["rate_limited"],
+    }
+
+
+def compare(results: list, baseline_file: str) -> None:
+    with open(baseline_file, "r", encoding="utf-8") as f:
+        baseline = {(r["max_document_tasks"], r["max_concurrent_requests"]): r for r in json.load(f)["results"]}
+    for result in results:
+        before = baseline.get((result["max_document_tasks"], result["max_concurrent_requests"]))
+        if before is None:
+            continue
+        change = result["chunks_per_second"] / before["chunks_per_second"] - 1
+        print(f"tasks={result['max_document_tasks']:<3} concurrency={result['max_concurrent_requests']:<4} "
+              f"{before['chunks_per_second']:>9.1f} -> {result['chunks_per_second']:>9.1f} chunks/s ({change:+.1%}), "
+              f"peak RSS {before['peak_rss_mb']:.0f} -> {result['peak_rss_mb']:.0f} MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the dbnl-bear pipeline against the fake OpenAI server.")
+    parser.add_argument("--corpus", type=str, default=DEFAULT_CORPUS, help="Directory of .txt files to run over.")
+    parser.add_argument("--files", type=int, default=5, help="Number of files of the corpus to use (0 for all).")
+    parser.add_argument("--document_tasks", type=int, nargs="+", default=[1, 4], help="--max_document_tasks values.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50], help="--max_concurrent_requests values.")
+    parser.add_argument("--batch_size", type=int, default=1, help="--batch_size of the runs.")
+    parser.add_argument("--phenomenon", type=str, default="tulips", help="Phenomenon to ask about.")
+    parser.add_argument("--latency", type=str, default="lognormal:0.1,0.5", help="Latency distribution of the server.")
+    parser.add_argument("--rate_limit_rate", type=float, default=0.01, help="Fraction of requests answered with a 429.")
+    parser.add_argument("--retry_after", type=float, default=0.2, help="Retry-After (seconds) of the 429s.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the server's latencies and 429s.")
+    parser.add_argument("--output", type=str, help="Result file (default: benchmarks/results/<time>.json).")
+    parser.add_argument("--baseline", type=str, help="Earlier result file to compare with.")
+    args = parser.parse_args(argv)
+
+    output = args.output or os.path.join(ROOT, "benchmarks", "results", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        input_dir = prepare_corpus(args.corpus, args.files, directory)
+        for document_tasks in args.document_tasks:
+            for concurrency in args.concurrency:
+                output_dir = os.path.join(directory, f"out_{document_tasks}_{concurrency}")
+                result = run_benchmark(input_dir, output_dir, document_tasks, concurrency, args)
+                shutil.rmtree(output_dir)
+                print(f"tasks={document_tasks:<3} concurrency={concurrency:<4} {result['chunks_per_second']:>9.1f} chunks/s  "
+                      f"client p50/p95/p99 {result['latency_ms']['p50']}/{result['latency_ms']['p95']}/"
+                      f"{result['latency_ms']['p99']} ms  server p50 {result['server_latency_ms']['p50']} ms  peak RSS {result['peak_rss_mb']:.0f} MB  "
+                      f"retries {result['retries']}")
+                results.append(result)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {output}")
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
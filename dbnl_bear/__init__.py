@@ -1,9 +1,11 @@
 from importlib.metadata import version, PackageNotFoundError
 
 from .parse import parser
-from .ai_read import analyze_document
+from .ai_read import analyze_document, AnalysisSession
 from .processing import run_processing
 from .token_cost import TokenCostTracker
+from .results_store import ResultsStore
+from .segment import SegmentSplitter
 
 try:
     __version__ = version("dbnl_bear")
@@ -13,8 +15,11 @@ except PackageNotFoundError:
 __all__ = [
     'parser',
     'analyze_document',
+    'AnalysisSession',
     'run_processing',
     'TokenCostTracker',
+    'ResultsStore',
+    'SegmentSplitter',
     '__version__',
 ]
 
@@ -1,10 +1,23 @@
 import os
+import re
+import json
+import time
+import asyncio
+import httpx
+from typing import Optional
 from langchain_openai import ChatOpenAI
 from tqdm.asyncio import tqdm
 from pydantic import BaseModel, Field, create_model
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from .token_cost import TokenCostTracker
+from .token_cost import TokenCostTracker, UsageCallbackHandler, BudgetExceeded
+from .cache import JudgementCache
+from .scheduler import RequestScheduler
+from .cascade import EscalationPolicy
+from .metrics import registry as metrics
+from .segment import SegmentSplitter, DEFAULT_CHUNK_TOKENS
+
+DEFAULT_MODEL = "gpt-4-turbo-mini-2024-07-18"
 
 text_splitter = RecursiveCharacterTextSplitter(
     chunk_size=400,
@@ -13,6 +26,133 @@ text_splitter = RecursiveCharacterTextSplitter(
     is_separator_regex=False,
 )
 
+SPLITTERS = ("recursive", "segment")
+
+def make_text_splitter(splitter: str = "recursive", chunk_tokens: int = DEFAULT_CHUNK_TOKENS):
+    """
+    The text splitter called ``splitter``: "recursive" is the default ``text_splitter``
+    (400 characters), "segment" a ``SegmentSplitter`` that packs whole sentences and verse
+    lines into chunks of at most ``chunk_tokens`` tokens.
+    """
+    if splitter == "recursive":
+        return text_splitter
+    if splitter == "segment":
+        return SegmentSplitter(chunk_tokens)
+    raise ValueError(f"Unknown splitter {splitter}; choose from {', '.join(SPLITTERS)}")
+
+def split_with_offsets(text: str, text_splitter=text_splitter):
+    """
+    Split ``text`` like ``text_splitter.split_text`` does, but return (chunk, start, end)
+    tuples with the character offsets of every chunk in ``text``.
+    """
+    if hasattr(text_splitter, "split_with_offsets"):
+        # The splitter knows the offsets itself.
+        return text_splitter.split_with_offsets(text)
+    # Consecutive chunks overlap by at most chunk_overlap characters, so the next chunk
+    # is searched for from there (the same bookkeeping as the splitter's add_start_index).
+    overlap = getattr(text_splitter, "_chunk_overlap", 0)
+    chunks = []
+    search_from = 0
+    for chunk in text_splitter.split_text(text):
+        start = text.find(chunk, search_from)
+        if start == -1:
+            start = text.find(chunk)
+        end = start + len(chunk)
+        chunks.append((chunk, start, end))
+        search_from = max(start + 1, end - overlap)
+    return chunks
+
+def iter_chunks_with_offsets(input_file: str, text_splitter=text_splitter, block_size: int = 1 << 20,
+                             resume=None):
+    """
+    Generator version of ``split_with_offsets`` for a file: reads ``input_file`` in blocks of
+    ``block_size`` characters and yields the same (chunk, start, end) tuples, so memory use
+    does not grow with the size of the file. With ``resume`` (see ``iter_chunk_windows``),
+    only the chunks from that point on are yielded.
+    """
+    for chunks, _ in iter_chunk_windows(input_file, text_splitter, block_size, resume):
+        yield from chunks
+
+def iter_chunk_windows(input_file: str, text_splitter=text_splitter, block_size: int = 1 << 20, resume=None):
+    """
+    The chunks of ``iter_chunks_with_offsets`` per window of the file: yields (chunks,
+    resume) pairs, where ``resume`` is the point to continue from after those chunks (or
+    None after the last window). Passing such a point as ``resume`` gives the rest of the
+    chunks, with the same offsets, without splitting the text before it again.
+    """
+    # The last chunks of a window can change once the text after it is known, so they are
+    # held back. The window is cut where the splitter starts afresh: right before a
+    # separator that precedes a chunk, or, for a SegmentSplitter, at a chunk that starts a
+    # sentence. The splitter splits on the first of its separators that occurs in the text,
+    # so that is where it is cut: text without blank lines is cut at line breaks, text
+    # without line breaks at spaces. A window that still has no cut point (no whitespace, or no sentence ends)
+    # is cut at a chunk start once it is over ``max_window`` characters, so memory stays
+    # bounded; the chunks around such a forced cut may differ from splitting the whole text.
+    held_back = 3
+    separators = [s for s in getattr(text_splitter, "_separators", ["\n\n"]) if s]
+    starts_sentence = getattr(text_splitter, "starts_sentence", None)
+    max_window = block_size + 100 * getattr(text_splitter, "_chunk_size", 400)
+
+    def cut_before(window: str, start: int, separator: str):
+        """Where to cut ``window`` to restart the splitter at the chunk at ``start``, or None."""
+        if starts_sentence is not None:
+            return start if starts_sentence(window, start) else None
+        cut = start - len(separator)
+        return cut if cut >= 0 and window.startswith(separator, cut) else None
+
+    def find_cut(window: str, chunks: list):
+        """(number of chunks before the cut, cut offset), or None to read more first."""
+        if starts_sentence is not None:
+            levels = [None]
+        else:
+            # Cutting at a lower level than the one the splitter uses would change the chunks.
+            levels = [separator for separator in separators if separator in window][:1]
+        for separator in levels:
+            for j in range(len(chunks) - held_back, 0, -1):
+                cut = cut_before(window, chunks[j][1], separator)
+                if cut is not None:
+                    return j, cut
+        if len(window) > max_window and len(chunks) > held_back:
+            j = len(chunks) - held_back
+            return j, chunks[j][1]
+        return None
+
+    # A resume point is (index of the next chunk, offset of the window, offset up to which
+    # the window had been read, file position of a block start at or before the window, the
+    # offset of that block). Reading the window back up to the same offset makes the rest
+    # of the stream identical. File positions are those of ``tell``: text offsets differ
+    # from byte offsets.
+    index, window_start, read_until, position, position_offset = resume or (0, 0, 0, 0, 0)
+    with open(input_file, 'r', encoding='utf-8') as f:
+        f.seek(position)
+        skip = window_start - position_offset
+        while skip > 0:
+            skipped = f.read(min(skip, block_size))
+            if not skipped:
+                break
+            skip -= len(skipped)
+        blocks = [(position, position_offset)]
+        window = f.read(read_until - window_start) if read_until > window_start else ""
+        while True:
+            blocks.append((f.tell(), window_start + len(window)))
+            block = f.read(block_size)
+            window += block
+            chunks = split_with_offsets(window, text_splitter)
+            if not block:
+                yield [(chunk, window_start + start, window_start + end) for chunk, start, end in chunks], None
+                return
+            found = find_cut(window, chunks)
+            if found is not None:
+                j, cut = found
+                index += j
+                read_until = window_start + len(window)
+                window_chunks = [(chunk, window_start + start, window_start + end) for chunk, start, end in chunks[:j]]
+                window = window[cut:]
+                window_start += cut
+                blocks = [block for block in blocks if block[1] <= window_start][-1:] + \
+                    [block for block in blocks if block[1] > window_start]
+                yield window_chunks, (index, window_start, read_until) + blocks[0]
+
 def create_model_name(phenomenon_of_interest: str) -> str:
     return ''.join(word.capitalize() for word in phenomenon_of_interest.split())
 
@@ -31,14 +171,80 @@ def create_llm_analysis_model(phenomenon_of_interest: str) -> BaseModel:
 
 def create_full_analysis_model(phenomenon_of_interest: str) -> BaseModel:
     """
-    This model is the same as the llm_analysis_model but with the original sentence field added.
+    This model is the same as the llm_analysis_model but with the original sentence field added,
+    the character offsets of that sentence in the document and the model that judged it.
     """
     model_name = create_model_name(phenomenon_of_interest)
     return create_model(
         f"{model_name}InText",
         explanation=(str, Field(description=f"Explain whether the sentence contains information about {phenomenon_of_interest}")),
         judgement=(bool, Field(description=f"Whether the sentence contains information about {phenomenon_of_interest}")),
-        original_sentence=(str, Field(description="The original sentence from the document"))
+        original_sentence=(str, Field(description="The original sentence from the document")),
+        start=(Optional[int], Field(default=None, description="Offset of the first character of the sentence in the document")),
+        end=(Optional[int], Field(default=None, description="Offset just past the last character of the sentence in the document")),
+        judged_by=(Optional[str], Field(default=None, description="The model that gave the judgement (None if no model was asked)"))
+    )
+
+def phenomenon_field_name(phenomenon_of_interest: str) -> str:
+    """Prefix of the fields for one phenomenon in a multi-phenomenon model ("vanitas symbols" -> "vanitas_symbols")."""
+    return re.sub(r"\W+", "_", phenomenon_of_interest.lower()).strip("_")
+
+def _multi_analysis_fields(phenomena) -> dict:
+    fields = {}
+    for phenomenon in phenomena:
+        name = phenomenon_field_name(phenomenon)
+        if f"{name}_judgement" in fields:
+            raise ValueError(f"Phenomena must have different names, got '{phenomenon}' twice")
+        fields[f"{name}_explanation"] = (str, Field(description=f"Explain whether the sentence contains information about {phenomenon}"))
+        fields[f"{name}_judgement"] = (bool, Field(description=f"Whether the sentence contains information about {phenomenon}"))
+    return fields
+
+def create_multi_analysis_model(phenomena) -> BaseModel:
+    """
+    Like the llm_analysis_model, but with an explanation and a judgement field for every
+    phenomenon, so one request judges a sentence for all of them at once.
+    """
+    model_name = "".join(create_model_name(phenomenon) for phenomenon in phenomena)
+    return create_model(f"{model_name}InText", **_multi_analysis_fields(phenomena))
+
+def create_full_multi_analysis_model(phenomena) -> BaseModel:
+    """The multi_analysis_model with the original sentence, its offsets and the judging model added."""
+    model_name = "".join(create_model_name(phenomenon) for phenomenon in phenomena)
+    return create_model(
+        f"{model_name}InText",
+        **_multi_analysis_fields(phenomena),
+        original_sentence=(str, Field(description="The original sentence from the document")),
+        start=(Optional[int], Field(default=None, description="Offset of the first character of the sentence in the document")),
+        end=(Optional[int], Field(default=None, description="Offset just past the last character of the sentence in the document")),
+        judged_by=(Optional[str], Field(default=None, description="The model that gave the judgement (None if no model was asked)"))
+    )
+
+def add_confidence_field(AnalysisModel: BaseModel) -> BaseModel:
+    """
+    ``AnalysisModel`` with a confidence field added, for the screening model of a cascade
+    (see ``AnalysisSession``).
+    """
+    return create_model(
+        f"{AnalysisModel.__name__}WithConfidence",
+        __base__=AnalysisModel,
+        confidence=(float, Field(ge=0.0, le=1.0, description="How sure you are of your judgement, from 0 (guessing) to 1 (certain)"))
+    )
+
+def create_llm_batch_analysis_model(phenomenon_of_interest: str, item_model: BaseModel = None) -> BaseModel:
+    """
+    Batched version of the llm_analysis_model (or of ``item_model``, if given): one item
+    per numbered passage, so several chunks can share a single request (and a single copy
+    of the system prompt).
+    """
+    model_name = create_model_name(phenomenon_of_interest)
+    ItemModel = create_model(
+        f"{model_name}InPassage",
+        __base__=item_model or create_llm_analysis_model(phenomenon_of_interest),
+        passage_number=(int, Field(description="The number of the passage this item is about")),
+    )
+    return create_model(
+        f"{model_name}InPassages",
+        items=(list[ItemModel], Field(description="Exactly one item per numbered passage, in the same order as the passages"))
     )
 
 def get_system_prompt(phenomenon_of_interest: str) -> str:
@@ -46,70 +252,586 @@ def get_system_prompt(phenomenon_of_interest: str) -> str:
     given my research interest, the sentence is relevant to my research. You should provide a clear explanation, a boolean judgement, and details about
     {phenomenon_of_interest} if present."""
 
-async def analyze_sentence(sentence: str, structured_llm, FullAnalysisModel):
+def get_multi_system_prompt(phenomena) -> str:
+    listed = ", ".join(phenomena)
+    return f"""I am a Cultural Historian and Literary Scholar interested in several phenomena: {listed}. Your task is to read sentences in Early Modern Dutch and indicate, 
+    for each of these phenomena separately, whether the sentence is relevant to my research. For every phenomenon, provide a clear explanation and a boolean
+    judgement in the fields named after it."""
+
+CONFIDENCE_INSTRUCTIONS = """
+    Also say how confident you are of your judgement, from 0 (guessing) to 1 (certain). Use a low confidence when the
+    sentence is ambiguous or when the relevance depends on context you cannot see."""
+
+BATCH_INSTRUCTIONS = """
+    You will receive several numbered passages at once. Judge every passage on its own and return exactly one item
+    per passage, in the same order, with its passage number."""
+
+def get_batch_system_prompt(phenomenon_of_interest: str) -> str:
+    return get_system_prompt(phenomenon_of_interest) + BATCH_INSTRUCTIONS
+
+def format_passages(sentences) -> str:
+    return "\n\n".join(f"[{n}]\n{sentence}" for n, sentence in enumerate(sentences, start=1))
+
+def worst_case_cost(cost_tracker, prompt: str, completion_tokens: int, overhead_tokens: int = 0) -> float:
+    """
+    Upper bound for the cost of a request: no token is shorter than one byte, so the prompt
+    has at most as many tokens as it has UTF-8 bytes (plus the schema and message overhead).
+    """
+    return cost_tracker.cost(len(prompt.encode("utf-8")) + overhead_tokens, completion_tokens)
+
+async def analyze_sentence(sentence: str, structured_llm, FullAnalysisModel, cache=None, cache_key=None,
+                           cost_tracker=None, scheduler=None, request_tokens: int = 0,
+                           deduplicator=None, dedup_key=None, dedup_tag=None, request_cost: float = 0.0):
     try:
-        llm_result = await structured_llm.ainvoke(sentence)
-        
-        full_result = FullAnalysisModel(
-            explanation = llm_result.explanation,
-            judgement = llm_result.judgement,
-            original_sentence = sentence
-        )
+        with metrics.timer("cache"):
+            cached = cache.get(cache_key) if cache is not None else None
+        if cost_tracker is not None and cache is not None:
+            cost_tracker.record_cache(cached is not None)
+        if cached is not None:
+            metrics.inc("dbnl_bear_chunks_total", outcome="cached")
+            return FullAnalysisModel(**cached, original_sentence=sentence)
+
+        async def send():
+            if cost_tracker is not None:
+                cost_tracker.record_call()
+            with metrics.timer("request"):
+                return await structured_llm.ainvoke(sentence)
+
+        requested = False
+
+        async def request():
+            nonlocal requested
+            requested = True
+            if scheduler is not None:
+                return await scheduler.submit(send, tokens=request_tokens, cost=request_cost)
+            return await send()
+
+        if deduplicator is not None:
+            # Near-duplicates of this chunk elsewhere in the corpus share one request.
+            llm_result = await deduplicator.resolve(dedup_key, request, tag=dedup_tag)
+        else:
+            llm_result = await request()
+        # A result shared by a near-duplicate is not cached under this text's key: it was
+        # not given for this text.
+        if cache is not None and requested:
+            with metrics.timer("cache"):
+                cache.set(cache_key, llm_result.model_dump())
+
+        with metrics.timer("validation"):
+            full_result = FullAnalysisModel(
+                **llm_result.model_dump(),
+                original_sentence = sentence
+            )
+        metrics.inc("dbnl_bear_chunks_total", outcome="judged")
         return full_result
+    except BudgetExceeded:
+        # Reported once by the budget; the chunk is left for a resumed run.
+        metrics.inc("dbnl_bear_chunks_total", outcome="over_budget")
+        return None
     except Exception as e:
+        metrics.inc("dbnl_bear_chunks_total", outcome="failed")
+        metrics.inc("dbnl_bear_errors_total", stage="analyze", type=type(e).__name__)
         print(f"Error analyzing sentence: {e}")
         print(f"Problematic sentence: {sentence}")
         return None
 
-async def analyze_document(input_file: str, phenomenon_of_interest: str, text_splitter=text_splitter,
-                         model="gpt-4-turbo-mini-2024-07-18"):
-    
-    with open(input_file, 'r', encoding='utf-8') as f:
-        original_text = f.read()
-
-    sentences = text_splitter.split_text(original_text)
-    
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise ValueError("API key not found. Install python-dotenv, make .env file and save the API key there as: OPENAI_API_KEY=your-api-key-here")
-    
-    # Initialize cost tracker
-    cost_tracker = TokenCostTracker(model)
-    
-    llm = ChatOpenAI(
-        model=model,
-        callbacks=[{
-            "on_llm_start": lambda x: cost_tracker.update_usage(
-                cost_tracker.count_tokens(str(x.prompts)),
-                0
-            ),
-            "on_llm_end": lambda x: cost_tracker.update_usage(
-                0,
-                cost_tracker.count_tokens(str(x.response))
+async def _analyze_passages(sentences, structured_batch_llm, scheduler=None, completion_tokens: int = 150,
+                            system_prompt: str = "", cost_tracker=None, max_completion_tokens: int = None,
+                            overhead_tokens: int = 0):
+    """
+    Send ``sentences`` as one batched request and return the items in input order. When the
+    answer does not have one item per passage in the right order, the batch is split in half
+    and both halves are retried, down to single passages.
+    """
+    passages = format_passages(sentences)
+    try:
+        tokens = RequestScheduler.estimate_tokens(system_prompt + passages, completion_tokens * len(sentences))
+
+        async def send():
+            if cost_tracker is not None:
+                cost_tracker.record_call()
+            with metrics.timer("request"):
+                return await structured_batch_llm.ainvoke(passages)
+
+        if scheduler is not None:
+            cost = 0.0
+            if cost_tracker is not None:
+                cost = worst_case_cost(cost_tracker, system_prompt + passages,
+                                       max_completion_tokens or completion_tokens * len(sentences), overhead_tokens)
+            batch = await scheduler.submit(send, tokens=tokens, cost=cost)
+        else:
+            batch = await send()
+        numbers = [item.passage_number for item in batch.items]
+        if numbers != list(range(1, len(sentences) + 1)):
+            raise ValueError(f"Expected passages 1-{len(sentences)} in order, got {numbers}")
+        return batch.items
+    except ValueError as e:
+        metrics.inc("dbnl_bear_errors_total", stage="validation", type=type(e).__name__)
+        if len(sentences) == 1:
+            print(f"Error analyzing sentence: {e}")
+            print(f"Problematic sentence: {sentences[0]}")
+            return [None]
+        half = len(sentences) // 2
+        first = await _analyze_passages(sentences[:half], structured_batch_llm, scheduler, completion_tokens,
+                                        system_prompt, cost_tracker, max_completion_tokens, overhead_tokens)
+        second = await _analyze_passages(sentences[half:], structured_batch_llm, scheduler, completion_tokens,
+                                         system_prompt, cost_tracker, max_completion_tokens, overhead_tokens)
+        return first + second
+    except BudgetExceeded:
+        return [None] * len(sentences)
+    except Exception as e:
+        metrics.inc("dbnl_bear_errors_total", stage="analyze", type=type(e).__name__)
+        print(f"Error analyzing batch of {len(sentences)} sentences: {e}")
+        return [None] * len(sentences)
+
+async def analyze_batch(sentences, structured_batch_llm, FullAnalysisModel, cache=None, cache_keys=None,
+                        cost_tracker=None, scheduler=None, system_prompt: str = "",
+                        max_completion_tokens: int = None, overhead_tokens: int = 0):
+    """
+    Batched counterpart of analyze_sentence: cached chunks are taken from the cache, the
+    rest is sent to the LLM together in one request.
+    """
+    results = [None] * len(sentences)
+    todo = []
+    for i, sentence in enumerate(sentences):
+        with metrics.timer("cache"):
+            cached = cache.get(cache_keys[i]) if cache is not None else None
+        if cost_tracker is not None and cache is not None:
+            cost_tracker.record_cache(cached is not None)
+        if cached is not None:
+            results[i] = FullAnalysisModel(**cached, original_sentence=sentence)
+        else:
+            todo.append(i)
+    metrics.inc("dbnl_bear_chunks_total", len(sentences) - len(todo), outcome="cached")
+    if not todo:
+        return results
+
+    items = await _analyze_passages([sentences[i] for i in todo], structured_batch_llm, scheduler,
+                                    system_prompt=system_prompt, cost_tracker=cost_tracker,
+                                    max_completion_tokens=max_completion_tokens, overhead_tokens=overhead_tokens)
+    for i, item in zip(todo, items):
+        if item is None:
+            metrics.inc("dbnl_bear_chunks_total", outcome="failed")
+            continue
+        if cache is not None:
+            with metrics.timer("cache"):
+                cache.set(cache_keys[i], item.model_dump(exclude={"passage_number"}))
+        with metrics.timer("validation"):
+            results[i] = FullAnalysisModel(
+                **item.model_dump(exclude={"passage_number"}),
+                original_sentence=sentences[i]
             )
-        }]
-    )
-    
-    LLMAnalysisModel = create_llm_analysis_model(phenomenon_of_interest)
-    FullAnalysisModel = create_full_analysis_model(phenomenon_of_interest)
-
-    llm_structured_output = llm.with_structured_output(LLMAnalysisModel)
-
-    system_prompt = get_system_prompt(phenomenon_of_interest)
-    prompt = ChatPromptTemplate.from_messages([("system", system_prompt), ("human", "{input}")])
-    structured_llm = prompt | llm_structured_output
-    
-    tasks = [analyze_sentence(sentence, structured_llm, FullAnalysisModel) for sentence in sentences]
-    
-    results = await tqdm.gather(*tasks)
-    
-    # Get final usage report
-    usage_report = cost_tracker.get_usage_report()
-    print("\nToken Usage and Cost Report:")
-    print(f"Model: {usage_report['model']}")
-    print(f"Prompt Tokens: {usage_report['prompt_tokens']}")
-    print(f"Completion Tokens: {usage_report['completion_tokens']}")
-    print(f"Total Tokens: {usage_report['total_tokens']}")
-    print(f"Estimated Cost: ${usage_report['estimated_cost_usd']:.4f}")
-    
-    return results, usage_report
\ No newline at end of file
+        metrics.inc("dbnl_bear_chunks_total", outcome="judged")
+    return results
+
+class AnalysisTier:
+    """One model of an ``AnalysisSession``, with its structured-output models, prompts and chains."""
+
+    def __init__(self, name: str, llm, phenomenon_of_interest: str, LLMAnalysisModel, FullAnalysisModel,
+                 system_prompt: str):
+        self.name = name
+        self.llm = llm
+        self.model = llm.model_name
+        self.LLMAnalysisModel = LLMAnalysisModel
+        self.FullAnalysisModel = FullAnalysisModel
+        self.system_prompt = system_prompt
+        self.structured_llm = ChatPromptTemplate.from_messages([("system", system_prompt), ("human", "{input}")]) | \
+            llm.with_structured_output(LLMAnalysisModel)
+        self.batch_prompt = system_prompt + BATCH_INSTRUCTIONS
+        BatchModel = create_llm_batch_analysis_model(phenomenon_of_interest, LLMAnalysisModel)
+        self.batch_llm = ChatPromptTemplate.from_messages([("system", self.batch_prompt), ("human", "{input}")]) | \
+            llm.with_structured_output(BatchModel)
+        # Tokens sent with every request besides the prompt: the output schema and the message framing.
+        self.overhead_tokens = len(json.dumps(BatchModel.model_json_schema())) + 100
+
+class AnalysisSession:
+    """
+    Everything that is the same for all documents of a run: one ``ChatOpenAI`` client on a
+    pooled HTTP client (so connections are kept alive between documents), the pydantic
+    models, the prompts and the structured-output chains. Create it once per (model,
+    phenomenon) and analyze any number of documents with it; ``aclose`` it at the end.
+
+    ``phenomenon_of_interest`` may also be a list of phenomena. Every chunk is then judged
+    for all of them in a single request; ``judgements`` splits a result per phenomenon.
+
+    With a ``screening_model``, the session runs a cascade: the screening model judges every
+    chunk and says how confident it is, and the chunks that ``escalation`` (an
+    ``EscalationPolicy``) selects are judged again by ``model``, whose judgement is final.
+
+    ``max_completion_tokens`` caps the answer of every request. Together with the scheduler's
+    ``CostBudget`` it makes the worst-case cost of every request known before it is sent.
+    """
+
+    def __init__(self, phenomenon_of_interest, model=DEFAULT_MODEL, text_splitter=text_splitter,
+                 screening_model: str = None, escalation: EscalationPolicy = None,
+                 max_completion_tokens: int = None, max_connections: int = 100, max_keepalive_connections: int = 50,
+                 keepalive_expiry: float = 60.0, timeout: float = 120.0):
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise ValueError("API key not found. Install python-dotenv, make .env file and save the API key there as: OPENAI_API_KEY=your-api-key-here")
+
+        self.phenomena = [phenomenon_of_interest] if isinstance(phenomenon_of_interest, str) else list(phenomenon_of_interest)
+        if not self.phenomena:
+            raise ValueError("At least one phenomenon of interest is needed.")
+        self.model = model
+        self.text_splitter = text_splitter
+        self.max_completion_tokens = max_completion_tokens
+        self.escalation = escalation or EscalationPolicy()
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_keepalive_connections,
+                                keepalive_expiry=keepalive_expiry),
+            timeout=timeout,
+        )
+
+        if len(self.phenomena) == 1:
+            self.phenomenon_of_interest = self.phenomena[0]
+            LLMAnalysisModel = create_llm_analysis_model(self.phenomenon_of_interest)
+            FullAnalysisModel = create_full_analysis_model(self.phenomenon_of_interest)
+            system_prompt = get_system_prompt(self.phenomenon_of_interest)
+        else:
+            self.phenomenon_of_interest = ", ".join(self.phenomena)
+            LLMAnalysisModel = create_multi_analysis_model(self.phenomena)
+            FullAnalysisModel = create_full_multi_analysis_model(self.phenomena)
+            system_prompt = get_multi_system_prompt(self.phenomena)
+
+        # The last tier gives the final judgement.
+        self.tiers = []
+        if screening_model is not None:
+            self.tiers.append(AnalysisTier(
+                "screen", self._chat_model(screening_model), self.phenomenon_of_interest,
+                add_confidence_field(LLMAnalysisModel), add_confidence_field(FullAnalysisModel),
+                system_prompt + CONFIDENCE_INSTRUCTIONS,
+            ))
+        self.tiers.append(AnalysisTier(
+            "confirm" if screening_model is not None else "main", self._chat_model(model),
+            self.phenomenon_of_interest, LLMAnalysisModel, FullAnalysisModel, system_prompt,
+        ))
+        self.LLMAnalysisModel = LLMAnalysisModel
+        self.FullAnalysisModel = FullAnalysisModel
+        self.system_prompt = system_prompt
+
+    def _chat_model(self, model: str):
+        return ChatOpenAI(
+            model=model,
+            # Retries are handled by the scheduler, which also sees the 429s that way.
+            max_retries=0,
+            max_tokens=self.max_completion_tokens,
+            http_async_client=self.http_client,
+        )
+
+    def judgements(self, result) -> dict:
+        """Phenomenon -> (judgement, explanation) for a result of ``analyze_text``."""
+        if len(self.phenomena) == 1:
+            return {self.phenomena[0]: (result.judgement, result.explanation)}
+        return {
+            phenomenon: (getattr(result, f"{phenomenon_field_name(phenomenon)}_judgement"),
+                         getattr(result, f"{phenomenon_field_name(phenomenon)}_explanation"))
+            for phenomenon in self.phenomena
+        }
+
+    def negative_result(self, chunk: str, start: int, end: int, explanation: str):
+        """A result that judges ``chunk`` not relevant for every phenomenon."""
+        fields = {}
+        for phenomenon in self.phenomena:
+            prefix = "" if len(self.phenomena) == 1 else phenomenon_field_name(phenomenon) + "_"
+            fields[f"{prefix}explanation"] = explanation
+            fields[f"{prefix}judgement"] = False
+        return self.FullAnalysisModel(**fields, original_sentence=chunk, start=start, end=end)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self.http_client.aclose()
+
+    async def analyze_file(self, input_file: str, **kwargs):
+        """Read ``input_file`` and analyze it with ``analyze_text``."""
+        with open(input_file, 'r', encoding='utf-8') as f:
+            original_text = f.read()
+        return await self.analyze_text(original_text, name=input_file, **kwargs)
+
+    def _chunk_analyzer(self, name: str, cost_tracker, cache=None, scheduler=None, batch_size: int = 1,
+                        deduplicator=None):
+        """
+        Coroutine function that analyzes a list of (index, chunk, start, end) tuples of
+        document ``name`` (one request, or one per tier in a cascade) and returns their results.
+        """
+        phenomenon_of_interest = self.phenomenon_of_interest
+        cascade = len(self.tiers) > 1
+        chains = {}
+        for tier in self.tiers:
+            tracker = cost_tracker.tier(tier.name, tier.model) if cascade else cost_tracker
+            callbacks = [UsageCallbackHandler(tracker, budget=scheduler.budget)]
+            chains[tier.name] = (tracker, tier.structured_llm.with_config(callbacks=callbacks),
+                                 tier.batch_llm.with_config(callbacks=callbacks))
+
+        async def judge(tier, items):
+            tracker, structured_llm, batch_llm = chains[tier.name]
+            if batch_size > 1:
+                tier_results = await analyze_batch(
+                    [chunk for _, chunk, _, _ in items], batch_llm, tier.FullAnalysisModel,
+                    cache=cache,
+                    cache_keys=[JudgementCache.make_key(tier.model, tier.batch_prompt, phenomenon_of_interest, chunk)
+                                for _, chunk, _, _ in items],
+                    cost_tracker=tracker,
+                    scheduler=scheduler,
+                    system_prompt=tier.batch_prompt,
+                    max_completion_tokens=self.max_completion_tokens,
+                    overhead_tokens=tier.overhead_tokens,
+                )
+            else:
+                tier_results = [await analyze_sentence(
+                    chunk, structured_llm, tier.FullAnalysisModel,
+                    cache=cache,
+                    cache_key=JudgementCache.make_key(tier.model, tier.system_prompt, phenomenon_of_interest, chunk),
+                    cost_tracker=tracker,
+                    scheduler=scheduler,
+                    request_tokens=RequestScheduler.estimate_tokens(tier.system_prompt + chunk),
+                    deduplicator=deduplicator,
+                    dedup_key=(name, i),
+                    dedup_tag=tier.name if cascade else None,
+                    request_cost=worst_case_cost(tracker, tier.system_prompt + chunk,
+                                                 self.max_completion_tokens or 150, tier.overhead_tokens),
+                ) for i, chunk, _, _ in items]
+            for result in tier_results:
+                if result is not None:
+                    result.judged_by = tier.model
+            return tier_results
+
+        async def analyze_chunks(items):
+            chunk_results = await judge(self.tiers[0], items)
+            if cascade:
+                escalate = [k for k, result in enumerate(chunk_results) if result is not None and
+                            self.escalation.should_escalate(
+                                [judgement for judgement, _ in self.judgements(result).values()], result.confidence)]
+                for k, result in enumerate(chunk_results):
+                    if result is not None and k not in escalate:
+                        chunk_results[k] = self.FullAnalysisModel(**result.model_dump(exclude={"confidence"}))
+                if escalate:
+                    cost_tracker.record_escalations(len(escalate))
+                    confirmed = await judge(self.tiers[-1], [items[k] for k in escalate])
+                    for k, result in zip(escalate, confirmed):
+                        chunk_results[k] = result
+            for (_, _, start, end), result in zip(items, chunk_results):
+                if result is not None:
+                    result.start, result.end = start, end
+            return chunk_results
+
+        return analyze_chunks
+
+    def _is_relevant(self, result) -> bool:
+        return any(judgement for judgement, _ in self.judgements(result).values())
+
+    def _print_usage_report(self, cost_tracker, cache=None, prefilter=None) -> dict:
+        usage_report = cost_tracker.get_usage_report()
+        print("\nToken Usage and Cost Report:")
+        print(f"Model: {usage_report['model']}")
+        print(f"Prompt Tokens: {usage_report['prompt_tokens']}")
+        print(f"Completion Tokens: {usage_report['completion_tokens']}")
+        print(f"Total Tokens: {usage_report['total_tokens']}")
+        print(f"Estimated Cost: ${usage_report['estimated_cost_usd']:.4f}")
+        if cache is not None:
+            print(f"Cache Hits: {usage_report['cache_hits']}")
+            print(f"Cache Misses: {usage_report['cache_misses']}")
+        if prefilter is not None:
+            print(f"Chunks Skipped by Pre-filter: {usage_report['chunks_skipped']}")
+            print(f"Skipped Chunks Audited: {usage_report['chunks_audited']} "
+                  f"({usage_report['audited_relevant']} judged relevant)")
+        if len(self.tiers) > 1:
+            print(f"Chunks Escalated: {usage_report['escalated']}")
+            for tier_name, tier_report in usage_report["tiers"].items():
+                print(f"{tier_name.capitalize()} Tier ({tier_report['model']}): {tier_report['calls']} calls, "
+                      f"{tier_report['total_tokens']} tokens, ${tier_report['estimated_cost_usd']:.4f}")
+        return usage_report
+
+    async def analyze_text(self, original_text: str, name: str = None, cache=None, scheduler=None,
+                           batch_size: int = 1, skip_chunks=None, on_result=None, prefilter=None,
+                           deduplicator=None):
+        """
+        Analyze every chunk of ``original_text``; ``name`` identifies the document for
+        near-duplicate sharing. See ``analyze_document`` for the other arguments.
+        """
+        with metrics.timer("split"):
+            chunks = split_with_offsets(original_text, self.text_splitter)
+        sentences = [chunk for chunk, _, _ in chunks]
+
+        if scheduler is None:
+            scheduler = RequestScheduler()
+
+        # Initialize cost tracker, with a tracker per model in a cascade.
+        cost_tracker = TokenCostTracker(self.model)
+        analyze_chunks = self._chunk_analyzer(name, cost_tracker, cache=cache, scheduler=scheduler,
+                                              batch_size=batch_size, deduplicator=deduplicator)
+
+        skip_chunks = skip_chunks or set()
+        results = [None] * len(sentences)
+        filtered_out = set()
+        audited = set()
+        if prefilter is not None:
+            kept, audited = prefilter.select(sentences)
+            filtered_out = set(range(len(sentences))) - kept - audited
+            cost_tracker.record_prefilter(len(filtered_out), len(audited))
+            metrics.inc("dbnl_bear_chunks_total", len(filtered_out - skip_chunks), outcome="skipped")
+        todo = [i for i in range(len(sentences)) if i not in skip_chunks and i not in filtered_out]
+
+        async def tracked(indices):
+            chunk_results = await analyze_chunks([(i, *chunks[i]) for i in indices])
+            for i, result in zip(indices, chunk_results):
+                if result is not None and i in audited and self._is_relevant(result):
+                    cost_tracker.record_audited_relevant()
+                results[i] = result
+                if on_result is not None:
+                    on_result(i, result)
+
+        tasks = [tracked(todo[i:i + batch_size]) for i in range(0, len(todo), batch_size)]
+
+        for i in sorted(filtered_out - skip_chunks):
+            chunk, start, end = chunks[i]
+            results[i] = self.negative_result(chunk, start, end, "Skipped by the lexical pre-filter")
+            if on_result is not None:
+                on_result(i, results[i])
+
+        await tqdm.gather(*tasks)
+
+        # Get final usage report
+        usage_report = self._print_usage_report(cost_tracker, cache, prefilter)
+        return results, usage_report
+
+    async def stream_file(self, input_file: str, cache=None, scheduler=None, batch_size: int = 1,
+                          skip_chunks=None, prefilter=None, deduplicator=None, workers: int = None,
+                          queue_size: int = None, block_size: int = 1 << 20, cost_tracker=None, chunks: range = None,
+                          resume=None):
+        """
+        Analyze ``input_file`` with bounded memory, yielding (index, result) pairs in the
+        order they finish. The file is read in blocks (see ``iter_chunks_with_offsets``),
+        the chunks go through a queue of ``queue_size`` to a fixed pool of ``workers``, and
+        finished results are handed out as they come, so neither the text nor the results
+        of the whole document are ever held at once.
+
+        The arguments are those of ``analyze_document``; a pre-filter must use a threshold
+        (``top_fraction`` ranks whole documents). Pass a ``cost_tracker`` to read the usage
+        afterwards. With ``chunks`` (a range of chunk indices), only those chunks are analyzed;
+        pass a ``resume`` point at or before the first of them (see ``iter_chunk_windows``)
+        to start reading the file there.
+        """
+        if scheduler is None:
+            scheduler = RequestScheduler()
+        workers = workers or scheduler.max_in_flight
+        queue_size = queue_size or 2 * workers
+        cost_tracker = cost_tracker or TokenCostTracker(self.model)
+        analyze_chunks = self._chunk_analyzer(input_file, cost_tracker, cache=cache, scheduler=scheduler,
+                                              batch_size=batch_size, deduplicator=deduplicator)
+        skip_chunks = skip_chunks or set()
+        work = asyncio.Queue(maxsize=queue_size)
+        done = asyncio.Queue(maxsize=queue_size)
+        end_of_stream = object()
+
+        async def produce():
+            cancelled = False
+            try:
+                batch = []
+                for index, (chunk, start, end) in enumerate(metrics.timed(
+                        iter_chunks_with_offsets(input_file, self.text_splitter, block_size, resume), "split"),
+                        start=resume[0] if resume else 0):
+                    if chunks is not None and index >= chunks.stop:
+                        break
+                    if index in skip_chunks or (chunks is not None and index not in chunks):
+                        continue
+                    audited = False
+                    if prefilter is not None:
+                        kept, audited = prefilter.decide(index, chunk)
+                        cost_tracker.record_prefilter(int(not kept and not audited), int(audited))
+                        if not kept and not audited:
+                            metrics.inc("dbnl_bear_chunks_total", outcome="skipped")
+                            await done.put((index, self.negative_result(chunk, start, end,
+                                                                        "Skipped by the lexical pre-filter")))
+                            continue
+                    batch.append((index, chunk, start, end, audited))
+                    if len(batch) == batch_size:
+                        await work.put((time.perf_counter(), batch))
+                        batch = []
+                if batch:
+                    await work.put((time.perf_counter(), batch))
+            except asyncio.CancelledError:
+                cancelled = True
+                raise
+            finally:
+                if not cancelled:
+                    for _ in range(workers):
+                        await work.put(None)
+
+        async def work_loop():
+            while (queued := await work.get()) is not None:
+                queued_at, batch = queued
+                metrics.observe("dbnl_bear_stage_seconds", time.perf_counter() - queued_at, stage="queue")
+                chunk_results = await analyze_chunks([item[:4] for item in batch])
+                for (index, _, _, _, audited), result in zip(batch, chunk_results):
+                    if result is not None and audited and self._is_relevant(result):
+                        cost_tracker.record_audited_relevant()
+                    await done.put((index, result))
+
+        async def close():
+            try:
+                await asyncio.gather(producer, *pool)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                await done.put(end_of_stream)
+                raise
+            await done.put(end_of_stream)
+
+        producer = asyncio.create_task(produce())
+        pool = [asyncio.create_task(work_loop()) for _ in range(workers)]
+        closer = asyncio.create_task(close())
+        progress = tqdm(desc=os.path.basename(input_file), unit="chunk")
+        try:
+            while (item := await done.get()) is not end_of_stream:
+                progress.update()
+                yield item
+            # Raises the error of a failed producer or worker, if any.
+            await closer
+        finally:
+            for task in (producer, *pool, closer):
+                task.cancel()
+            progress.close()
+        self._print_usage_report(cost_tracker, cache, prefilter)
+
+async def analyze_document(input_file: str, phenomenon_of_interest, text_splitter=text_splitter,
+                         model=DEFAULT_MODEL, cache=None, scheduler=None, batch_size: int = 1,
+                         skip_chunks=None, on_result=None, prefilter=None, deduplicator=None,
+                         screening_model: str = None, escalation: EscalationPolicy = None):
+    """
+    Analyze every chunk of ``input_file``. If a ``JudgementCache`` is given, chunks that
+    were judged before with the same model, prompt and phenomenon are not sent again.
+    All requests go through ``scheduler`` (a ``RequestScheduler``); pass the same one for
+    every document of a run so the rate limits hold for the whole process.
+    With ``batch_size`` > 1, that many consecutive chunks are packed into each request.
+
+    Chunks whose index is in ``skip_chunks`` are not analyzed (their result is None), and
+    ``on_result(index, result)`` is called for every other chunk as soon as it is done.
+
+    With a ``LexicalPrefilter``, chunks it rejects are not sent; they get a negative
+    judgement without a request (except for the audit sample, which is sent anyway).
+
+    With a ``ChunkDeduplicator``, chunks that have near-duplicates in the corpus reuse the
+    judgement of their cluster instead of sending their own request (not with batching).
+
+    ``phenomenon_of_interest`` may be a list of phenomena, which are all judged in the same
+    request; use ``AnalysisSession.judgements`` to get the judgement per phenomenon.
+
+    With a ``screening_model``, that (cheaper) model judges every chunk first and only the
+    chunks selected by ``escalation`` (by default: judged relevant, or judged with low
+    confidence) are sent to ``model``.
+
+    This sets up a new client for every call; to analyze many documents, create one
+    ``AnalysisSession`` and use its ``analyze_file`` instead.
+    """
+    async with AnalysisSession(phenomenon_of_interest, model=model, text_splitter=text_splitter,
+                               screening_model=screening_model, escalation=escalation) as session:
+        return await session.analyze_file(input_file, cache=cache, scheduler=scheduler, batch_size=batch_size,
+                                          skip_chunks=skip_chunks, on_result=on_result, prefilter=prefilter,
+                                          deduplicator=deduplicator)
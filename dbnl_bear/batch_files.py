@@ -0,0 +1,187 @@
+import os
+import json
+from collections import defaultdict
+from . import ai_read
+from .processing import write_relevant_passages, phenomenon_output_dirs
+
+"""
+Offline two-phase pipeline for very large corpora, using the (discounted, asynchronous)
+OpenAI Batch API instead of live requests.
+
+Phase one (export_batch_requests) writes one chat-completion request per chunk to sharded
+JSONL files in the batch-request format. Every request has a stable custom_id that maps
+back to the file, the chunk index and the character offsets of the chunk.
+
+Phase two (ingest_batch_results) reads the result JSONL files downloaded from the Batch API
+and writes the same ``_relevant.txt`` files as run_processing does.
+
+As in a live run, several phenomena can be judged in one pass: every request then asks for
+a judgement per phenomenon, and the passages of each phenomenon go to a subdirectory of the
+output directory.
+"""
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+
+def make_custom_id(file_name: str, index: int, start: int, end: int) -> str:
+    return f"{file_name}|{index}|{start}|{end}"
+
+
+def parse_custom_id(custom_id: str):
+    """Inverse of make_custom_id: returns (file_name, index, start, end)."""
+    file_name, index, start, end = custom_id.rsplit("|", 3)
+    return file_name, int(index), int(start), int(end)
+
+
+def _phenomena(phenomenon_of_interest) -> list:
+    phenomena = [phenomenon_of_interest] if isinstance(phenomenon_of_interest, str) else list(phenomenon_of_interest)
+    if not phenomena:
+        raise ValueError("At least one phenomenon of interest is needed")
+    return phenomena
+
+
+def analysis_model(phenomena) -> type:
+    """The model requested for ``phenomena``: the llm_analysis_model, or the multi_analysis_model."""
+    if len(phenomena) == 1:
+        return ai_read.create_llm_analysis_model(phenomena[0])
+    return ai_read.create_multi_analysis_model(phenomena)
+
+
+def system_prompt(phenomena) -> str:
+    if len(phenomena) == 1:
+        return ai_read.get_system_prompt(phenomena[0])
+    return ai_read.get_multi_system_prompt(phenomena)
+
+
+def judgements(phenomena, llm_result) -> dict:
+    """Phenomenon -> judgement for a result of ``analysis_model(phenomena)``."""
+    if len(phenomena) == 1:
+        return {phenomena[0]: llm_result.judgement}
+    return {phenomenon: getattr(llm_result, f"{ai_read.phenomenon_field_name(phenomenon)}_judgement")
+            for phenomenon in phenomena}
+
+
+def response_format(phenomenon_of_interest) -> dict:
+    """Strict JSON-schema response format built from the llm_analysis_model."""
+    LLMAnalysisModel = analysis_model(_phenomena(phenomenon_of_interest))
+    schema = LLMAnalysisModel.model_json_schema()
+    schema["additionalProperties"] = False
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": LLMAnalysisModel.__name__, "strict": True, "schema": schema},
+    }
+
+
+def export_batch_requests(input_dir: str, phenomenon_of_interest, output_dir: str,
+                          model=ai_read.DEFAULT_MODEL, shard_size: int = 50_000,
+                          text_splitter=ai_read.text_splitter):
+    """
+    Write a batch request for every chunk of every .txt file in ``input_dir`` to
+    ``output_dir/batch_requests_NNN.jsonl`` (at most ``shard_size`` requests per file).
+    ``phenomenon_of_interest`` may be a list of phenomena, which are then all judged in the
+    same request. Returns the paths of the written shards.
+    """
+    phenomena = _phenomena(phenomenon_of_interest)
+    file_names = sorted(f for f in os.listdir(input_dir) if f.endswith('.txt'))
+    if not file_names:
+        raise ValueError(f"No .txt files found in {input_dir}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    prompt = system_prompt(phenomena)
+    fmt = response_format(phenomena)
+    shard_paths = []
+    shard = None
+    in_shard = 0
+    try:
+        for file_name in file_names:
+            with open(os.path.join(input_dir, file_name), 'r', encoding='utf-8') as f:
+                text = f.read()
+            for index, (chunk, start, end) in enumerate(ai_read.split_with_offsets(text, text_splitter)):
+                if shard is None or in_shard >= shard_size:
+                    if shard is not None:
+                        shard.close()
+                    shard_paths.append(os.path.join(output_dir, f"batch_requests_{len(shard_paths):03d}.jsonl"))
+                    shard = open(shard_paths[-1], "w", encoding="utf-8")
+                    in_shard = 0
+                request = {
+                    "custom_id": make_custom_id(file_name, index, start, end),
+                    "method": "POST",
+                    "url": BATCH_ENDPOINT,
+                    "body": {
+                        "model": model,
+                        "messages": [
+                            {"role": "system", "content": prompt},
+                            {"role": "user", "content": chunk},
+                        ],
+                        "response_format": fmt,
+                    },
+                }
+                shard.write(json.dumps(request, ensure_ascii=False) + "\n")
+                in_shard += 1
+    finally:
+        if shard is not None:
+            shard.close()
+    return shard_paths
+
+
+def read_batch_results(result_paths, phenomenon_of_interest):
+    """
+    Parse Batch API result files. Returns a dict mapping each file name to a list of
+    (index, start, end, llm_result) tuples, and the custom_ids of requests that failed.
+    ``phenomenon_of_interest`` must be the phenomenon (or list of phenomena) of the export.
+    """
+    LLMAnalysisModel = analysis_model(_phenomena(phenomenon_of_interest))
+    results = defaultdict(list)
+    failed = []
+    for result_path in result_paths:
+        with open(result_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    custom_id = record["custom_id"]
+                except (KeyError, TypeError, ValueError) as e:
+                    print(f"Skipping malformed line in {result_path}: {e}")
+                    failed.append(None)
+                    continue
+                try:
+                    response = record.get("response") or {}
+                    if record.get("error") or response.get("status_code") != 200:
+                        raise ValueError(record.get("error") or f"status {response.get('status_code')}")
+                    content = response["body"]["choices"][0]["message"]["content"]
+                    llm_result = LLMAnalysisModel.model_validate_json(content)
+                    file_name, index, start, end = parse_custom_id(custom_id)
+                except (AttributeError, KeyError, IndexError, TypeError, ValueError) as e:
+                    print(f"Request {custom_id} failed: {e}")
+                    failed.append(custom_id)
+                    continue
+                results[file_name].append((index, start, end, llm_result))
+    return results, failed
+
+
+def ingest_batch_results(result_paths, input_dir: str, phenomenon_of_interest, output_dir: str):
+    """
+    Write ``_relevant.txt`` files for every document in the result files. The passages
+    are cut from the original texts in ``input_dir`` using the offsets in the custom_ids.
+    With several phenomena, the files of each phenomenon go to its own subdirectory of
+    ``output_dir``, as in a live run. Returns the custom_ids of failed requests, so they
+    can be exported again (None for lines that could not be read at all).
+    """
+    phenomena = _phenomena(phenomenon_of_interest)
+    results, failed = read_batch_results(result_paths, phenomena)
+    output_dirs = phenomenon_output_dirs(phenomena, output_dir)
+    for directory in output_dirs.values():
+        os.makedirs(directory, exist_ok=True)
+    for file_name, chunks in results.items():
+        path = os.path.join(input_dir, file_name)
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        chunks.sort(key=lambda chunk: chunk[0])
+        for phenomenon, directory in output_dirs.items():
+            spans = [(start, end) for _, start, end, llm_result in chunks
+                     if judgements(phenomena, llm_result)[phenomenon]]
+            write_relevant_passages(path, directory, [text[start:end] for start, end in spans], spans=spans)
+    if failed:
+        print(f"{len(failed)} requests failed and have no result")
+    return failed
@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+"""
+On-disk cache for per-chunk LLM judgements.
+
+Every entry is keyed on a hash of (model, prompt template, phenomenon, chunk text),
+so re-running the same corpus only pays for chunks that actually changed. Entries
+are evicted when they get too old or when the cache grows beyond ``max_entries``
+(least recently used first).
+
+Writes are batched so that the hot path does not pay for a transaction per chunk: new
+entries are committed every ``commit_every`` writes or ``commit_interval`` seconds, and the
+last-used times of cache hits are kept in memory until then. ``close`` commits the rest;
+a crash loses at most the last batch, which is only asked again on the next run.
+"""
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "dbnl_bear", "judgements.sqlite")
+
+
+class JudgementCache:
+    """SQLite-backed cache mapping chunk keys to the LLM's structured output."""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_entries: int = 1_000_000,
+                 max_age_days: float = 90, commit_every: int = 200, commit_interval: float = 5.0):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_days * 24 * 3600
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.hits = 0
+        self.misses = 0
+        self._uncommitted = 0
+        self._last_used = {}
+        self._last_commit = time.monotonic()
+        self._connection = sqlite3.connect(path, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL only syncs at checkpoints; a power loss can drop the latest
+        # commits, but never corrupts the cache.
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS judgements (
+                   key TEXT PRIMARY KEY,
+                   value TEXT NOT NULL,
+                   created REAL NOT NULL,
+                   last_used REAL NOT NULL
+               )"""
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON judgements (last_used)")
+        self._connection.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(model: str, prompt_template: str, phenomenon: str, chunk: str) -> str:
+        """Content address of a single chunk request."""
+        payload = json.dumps([model, prompt_template, phenomenon, chunk], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """Return the cached result dict for ``key``, or None on a miss."""
+        row = self._connection.execute(
+            "SELECT value, created FROM judgements WHERE key = ?", (key,)
+        ).fetchone()
+        now = time.time()
+        if row is None or now - row[1] > self.max_age_seconds:
+            self.misses += 1
+            return None
+        self._last_used[key] = now
+        self.hits += 1
+        self._maybe_commit()
+        return json.loads(row[0])
+
+    def set(self, key: str, value: dict) -> None:
+        now = time.time()
+        self._connection.execute(
+            "INSERT OR REPLACE INTO judgements (key, value, created, last_used) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), now, now),
+        )
+        self._last_used.pop(key, None)
+        self._uncommitted += 1
+        self._maybe_commit()
+
+    def _maybe_commit(self) -> None:
+        if (self._uncommitted + len(self._last_used) >= self.commit_every
+                or time.monotonic() - self._last_commit >= self.commit_interval):
+            self.commit()
+
+    def commit(self) -> None:
+        """Write the pending entries and last-used times."""
+        if self._last_used:
+            self._connection.executemany("UPDATE judgements SET last_used = ? WHERE key = ?",
+                                         [(used, key) for key, used in self._last_used.items()])
+            self._last_used = {}
+        self._connection.commit()
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+
+    def evict(self) -> None:
+        """Drop entries that are too old, then the least recently used ones above ``max_entries``."""
+        self.commit()
+        self._connection.execute(
+            "DELETE FROM judgements WHERE created < ?", (time.time() - self.max_age_seconds,)
+        )
+        (count,) = self._connection.execute("SELECT COUNT(*) FROM judgements").fetchone()
+        if count > self.max_entries:
+            self._connection.execute(
+                """DELETE FROM judgements WHERE key IN (
+                       SELECT key FROM judgements ORDER BY last_used ASC LIMIT ?
+                   )""",
+                (count - self.max_entries,),
+            )
+        self._connection.commit()
+
+    def clear(self) -> None:
+        self._last_used = {}
+        self._connection.execute("DELETE FROM judgements")
+        self.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM judgements").fetchone()[0]
+
+    def close(self) -> None:
+        self.evict()
+        self._connection.close()
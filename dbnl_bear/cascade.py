@@ -0,0 +1,27 @@
+"""
+Escalation policy for the two-tier model cascade.
+
+In a cascade a cheap screening model judges every chunk and also says how confident it
+is. Only chunks it finds relevant, or is unsure about, are sent to the stronger model,
+whose judgement is final. Since most chunks of a corpus are clearly irrelevant, most of
+them never reach the expensive model.
+"""
+
+
+class EscalationPolicy:
+    def __init__(self, escalate_relevant: bool = True, min_confidence: float = 0.75):
+        """
+        ``escalate_relevant``: confirm every chunk the screening model judged relevant
+        (for any phenomenon). ``min_confidence``: confirm every chunk the screening model
+        is less sure about than this (0 to 1).
+        """
+        if not 0.0 <= min_confidence <= 1.0:
+            raise ValueError(f"min_confidence must be between 0 and 1, got {min_confidence}")
+        self.escalate_relevant = escalate_relevant
+        self.min_confidence = min_confidence
+
+    def should_escalate(self, judgements, confidence: float) -> bool:
+        """Whether a chunk with these screening ``judgements`` and ``confidence`` goes to the stronger model."""
+        if self.escalate_relevant and any(judgements):
+            return True
+        return confidence < self.min_confidence
@@ -1,21 +1,318 @@
+import os
+import sys
+import json
 import argparse
-from dbnl_bear.processing import run_processing
+from dbnl_bear.processing import run_processing, estimate_run_cost, print_cost_estimate
+from dbnl_bear.prefilter import LexicalPrefilter
+from dbnl_bear.cache import DEFAULT_CACHE_PATH
+from dbnl_bear.ai_read import DEFAULT_MODEL, SPLITTERS, make_text_splitter
+from dbnl_bear.segment import DEFAULT_CHUNK_TOKENS
+from dbnl_bear import batch_files, overview, fake_server, metrics, work_queue
+from dbnl_bear.results_store import ResultsStore, export
+from dbnl_bear.parse import parser as dbnl_parser
 
-def main():
+def run_command(argv):
     parser = argparse.ArgumentParser(description="Process documents for relevant passages.")
-    parser.add_argument("phenomenon_of_interest", type=str, help="The phenomenon to analyze.")
+    parser.add_argument("phenomenon_of_interest", type=str, nargs="+",
+                        help="The phenomenon to analyze. Several phenomena are judged in one pass.")
     parser.add_argument("--input_dir", type=str, required=True, help="Directory of input files.")
     parser.add_argument("--output_dir", type=str, required=True, help="Directory for output files.")
     parser.add_argument("--max_document_tasks", type=int, default=1, help="Max concurrent document tasks.")
-    args = parser.parse_args()
+    parser.add_argument("--no_cache", action="store_true", help="Bypass the on-disk judgement cache.")
+    parser.add_argument("--clear_cache", action="store_true", help="Empty the judgement cache before running.")
+    parser.add_argument("--cache_path", type=str, default=DEFAULT_CACHE_PATH, help="Location of the judgement cache.")
+    parser.add_argument("--requests_per_minute", type=float, default=500, help="Request budget per minute for the whole run.")
+    parser.add_argument("--tokens_per_minute", type=float, default=200_000, help="Token budget per minute for the whole run.")
+    parser.add_argument("--max_concurrent_requests", type=int, default=50, help="Max requests in flight across all documents.")
+    parser.add_argument("--batch_size", type=int, default=1, help="Number of consecutive chunks per request.")
+    parser.add_argument("--splitter", type=str, choices=SPLITTERS, default="recursive",
+                        help="How to cut texts into chunks: 400 characters, or whole sentences and verse lines.")
+    parser.add_argument("--chunk_tokens", type=int, default=DEFAULT_CHUNK_TOKENS,
+                        help="Max tokens per chunk for --splitter segment.")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted run in output_dir.")
+    parser.add_argument("--seed_terms", nargs="+", help="Only send chunks mentioning these terms (spelling variants included).")
+    parser.add_argument("--prefilter_threshold", type=int, default=1, help="Min number of seed term matches to send a chunk.")
+    parser.add_argument("--prefilter_top_fraction", type=float, help="Send the best scoring fraction of each document instead.")
+    parser.add_argument("--audit_rate", type=float, default=0.0, help="Fraction of skipped chunks to send anyway to measure recall.")
+    parser.add_argument("--dedup_threshold", type=float, help="Share one request between near-duplicate chunks (e.g. 0.8).")
+    parser.add_argument("--model", type=str, default=DEFAULT_MODEL, help="Model that gives the final judgements.")
+    parser.add_argument("--screening_model", type=str, help="Cheaper model that screens all chunks first.")
+    parser.add_argument("--escalation_confidence", type=float, default=0.75,
+                        help="Send screened chunks judged with less confidence than this to --model.")
+    parser.add_argument("--no_escalate_relevant", action="store_true",
+                        help="Don't send chunks the screening model judged relevant with enough confidence to --model.")
+    parser.add_argument("--max_cost", type=float, help="Budget in USD; no requests are sent that could exceed it.")
+    parser.add_argument("--estimate_only", action="store_true", help="Only print the estimated cost of the run.")
+    parser.add_argument("--metrics_file", type=str, help="Write run metrics to this Prometheus text file while running.")
+    parser.add_argument("--metrics_interval", type=float, default=15.0, help="Seconds between metrics file updates.")
+    parser.add_argument("--profile", type=str,
+                        help="Profile the run; writes <PROFILE>.pstats (cProfile) and <PROFILE>_tasks.json (asyncio tasks).")
+    args = parser.parse_args(argv)
 
+    phenomena = args.phenomenon_of_interest
+    if args.estimate_only:
+        print_cost_estimate(estimate_run_cost(
+            [os.path.join(args.input_dir, f) for f in os.listdir(args.input_dir) if f.endswith('.txt')],
+            phenomena, model=args.model, batch_size=args.batch_size, screening_model=args.screening_model,
+            text_splitter=make_text_splitter(args.splitter, args.chunk_tokens),
+            prefilter=LexicalPrefilter(args.seed_terms, threshold=args.prefilter_threshold,
+                                       top_fraction=args.prefilter_top_fraction,
+                                       audit_rate=args.audit_rate) if args.seed_terms else None,
+        ))
+        return
     run_processing(
-        phenomenon_of_interest=args.phenomenon_of_interest,
+        phenomenon_of_interest=phenomena[0] if len(phenomena) == 1 else phenomena,
         input_dir=args.input_dir,
         output_dir=args.output_dir,
-        max_document_tasks=args.max_document_tasks
+        max_document_tasks=args.max_document_tasks,
+        use_cache=not args.no_cache,
+        cache_path=args.cache_path,
+        clear_cache=args.clear_cache,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        max_concurrent_requests=args.max_concurrent_requests,
+        batch_size=args.batch_size,
+        resume=args.resume,
+        seed_terms=args.seed_terms,
+        prefilter_threshold=args.prefilter_threshold,
+        prefilter_top_fraction=args.prefilter_top_fraction,
+        audit_rate=args.audit_rate,
+        dedup_threshold=args.dedup_threshold,
+        model=args.model,
+        screening_model=args.screening_model,
+        escalation_confidence=args.escalation_confidence,
+        escalate_relevant=not args.no_escalate_relevant,
+        max_cost=args.max_cost,
+        metrics_file=args.metrics_file,
+        metrics_interval=args.metrics_interval,
+        profile=args.profile,
+        splitter=args.splitter,
+        chunk_tokens=args.chunk_tokens,
     )
 
+def batch_export_command(argv):
+    parser = argparse.ArgumentParser(prog="dbnl-bear batch-export",
+                                     description="Write batch request files for every chunk of a corpus.")
+    parser.add_argument("phenomenon_of_interest", type=str, nargs="+",
+                        help="The phenomenon to analyze. Several phenomena are judged in one request.")
+    parser.add_argument("--input_dir", type=str, required=True, help="Directory of input files.")
+    parser.add_argument("--output_dir", type=str, required=True, help="Directory for the request files.")
+    parser.add_argument("--model", type=str, default=DEFAULT_MODEL, help="Model to request.")
+    parser.add_argument("--shard_size", type=int, default=50_000, help="Max requests per request file.")
+    parser.add_argument("--splitter", type=str, choices=SPLITTERS, default="recursive",
+                        help="How to cut texts into chunks: 400 characters, or whole sentences and verse lines.")
+    parser.add_argument("--chunk_tokens", type=int, default=DEFAULT_CHUNK_TOKENS,
+                        help="Max tokens per chunk for --splitter segment.")
+    args = parser.parse_args(argv)
+
+    shards = batch_files.export_batch_requests(args.input_dir, args.phenomenon_of_interest, args.output_dir,
+                                               model=args.model, shard_size=args.shard_size,
+                                               text_splitter=make_text_splitter(args.splitter, args.chunk_tokens))
+    print(f"Wrote {len(shards)} request file(s) to {args.output_dir}")
+
+def batch_ingest_command(argv):
+    parser = argparse.ArgumentParser(prog="dbnl-bear batch-ingest",
+                                     description="Turn batch result files into relevant passage files.")
+    parser.add_argument("phenomenon_of_interest", type=str, nargs="+",
+                        help="The phenomenon (or phenomena, in the same order) given to batch-export.")
+    parser.add_argument("--results", nargs="+", required=True, help="Batch result JSONL file(s).")
+    parser.add_argument("--input_dir", type=str, required=True, help="Directory of the original input files.")
+    parser.add_argument("--output_dir", type=str, required=True, help="Directory for output files.")
+    args = parser.parse_args(argv)
+
+    batch_files.ingest_batch_results(args.results, args.input_dir, args.phenomenon_of_interest, args.output_dir)
+
+def parse_command(argv):
+    parser = argparse.ArgumentParser(prog="dbnl-bear parse",
+                                     description="Convert DBNL XML files to plain text files.")
+    parser.add_argument("--input_dir", type=str, required=True, help="Directory of DBNL XML files.")
+    parser.add_argument("--output_dir", type=str, default="dbnl_txt_files", help="Directory for the .txt files.")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of worker processes.")
+    parser.add_argument("--metrics_file", type=str, help="Write conversion metrics to this Prometheus text file.")
+    args = parser.parse_args(argv)
+
+    errors = dbnl_parser.dbnl_to_txt(args.input_dir, args.output_dir, jobs=args.jobs)
+    if args.metrics_file:
+        metrics.registry.write_prometheus(args.metrics_file)
+    for f_name, error in sorted(errors.items()):
+        print(f"file {f_name} could not be parsed because of: {error}")
+
+def barcode_command(argv):
+    parser = argparse.ArgumentParser(prog="dbnl-bear barcode",
+                                     description="Draw the relevant passages of a whole run as a barcode image.")
+    parser.add_argument("image_file", type=str, help="Image to write (.png, .svg, ...).")
+    parser.add_argument("--input_dir", type=str, required=True, help="Directory of the input files of the run.")
+    parser.add_argument("--output_dir", type=str, required=True, help="Output directory of the run.")
+    parser.add_argument("--bins", type=int, default=1000, help="Horizontal resolution (relative position in the text).")
+    args = parser.parse_args(argv)
+
+    names = overview.render_corpus_barcode(args.input_dir, args.output_dir, args.image_file, n_bins=args.bins)
+    print(f"Drew {len(names)} documents to {args.image_file}")
+
+def results_command(argv):
+    parser = argparse.ArgumentParser(prog="dbnl-bear results",
+                                     description="Query the verdicts of a run; prints one JSON object per line.")
+    parser.add_argument("store", type=str, help="Results store of the run (results.sqlite in its output directory).")
+    parser.add_argument("--phenomenon", type=str, help="Only verdicts on this phenomenon.")
+    parser.add_argument("--file", type=str, help="Only verdicts on this file (name of the .txt file).")
+    parser.add_argument("--relevant", action="store_true", help="Only chunks judged relevant.")
+    parser.add_argument("--run", type=int, help="Run id (default: the latest run).")
+    parser.add_argument("--runs", action="store_true", help="List the runs in the store instead.")
+    parser.add_argument("--summary", action="store_true", help="Count chunks and relevant chunks per file instead.")
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.store):
+        parser.error(f"No results store at {args.store}")
+
+    store = ResultsStore(args.store)
+    try:
+        if args.runs:
+            rows = store.runs()
+        elif args.summary:
+            rows = store.summary(run=args.run)
+        else:
+            rows = store.verdicts(run=args.run, file=args.file, phenomenon=args.phenomenon,
+                                  relevant=True if args.relevant else None)
+        for row in rows:
+            print(json.dumps(row, ensure_ascii=False))
+    finally:
+        store.close()
+
+def export_command(argv):
+    parser = argparse.ArgumentParser(prog="dbnl-bear export",
+                                     description="Regenerate the outputs of a run from its results store.")
+    parser.add_argument("store", type=str, help="Results store of the run (results.sqlite in its output directory).")
+    parser.add_argument("phenomenon_of_interest", type=str, help="The phenomenon to write the outputs for.")
+    parser.add_argument("--output_dir", type=str, required=True, help="Directory for the regenerated files.")
+    parser.add_argument("--input_dir", type=str, help="Directory of the original input files (for --word and --barcode).")
+    parser.add_argument("--run", type=int, help="Run id (default: the latest run).")
+    parser.add_argument("--word", action="store_true", help="Also write a Word document per file with highlighted passages.")
+    parser.add_argument("--barcode", type=str, help="Also draw the corpus barcode to this image file.")
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.store):
+        parser.error(f"No results store at {args.store}")
+
+    store = ResultsStore(args.store)
+    try:
+        names = export(store, args.phenomenon_of_interest, args.output_dir, run=args.run, input_dir=args.input_dir,
+                       word=args.word, barcode_file=args.barcode)
+    finally:
+        store.close()
+    print(f"Wrote the outputs of {len(names)} file(s) with relevant passages to {args.output_dir}")
+
+def enqueue_command(argv):
+    parser = argparse.ArgumentParser(prog="dbnl-bear enqueue",
+                                     description="Put a corpus run in a work queue for `dbnl-bear worker` processes.")
+    parser.add_argument("queue", type=str, help="Work queue file to create (on a filesystem all workers can reach).")
+    parser.add_argument("phenomenon_of_interest", type=str, nargs="+",
+                        help="The phenomenon to analyze. Several phenomena are judged in one pass.")
+    parser.add_argument("--input_dir", type=str, required=True, help="Directory of input files.")
+    parser.add_argument("--output_dir", type=str, required=True, help="Directory for output files.")
+    parser.add_argument("--chunks_per_item", type=int, default=500, help="Number of chunks per work item.")
+    parser.add_argument("--max_attempts", type=int, default=3, help="Attempts per work item before it is marked failed.")
+    parser.add_argument("--batch_size", type=int, default=1, help="Number of consecutive chunks per request.")
+    parser.add_argument("--splitter", type=str, choices=SPLITTERS, default="recursive",
+                        help="How to cut texts into chunks: 400 characters, or whole sentences and verse lines.")
+    parser.add_argument("--chunk_tokens", type=int, default=DEFAULT_CHUNK_TOKENS,
+                        help="Max tokens per chunk for --splitter segment.")
+    parser.add_argument("--seed_terms", nargs="+", help="Only send chunks mentioning these terms (spelling variants included).")
+    parser.add_argument("--prefilter_threshold", type=int, default=1, help="Min number of seed term matches to send a chunk.")
+    parser.add_argument("--audit_rate", type=float, default=0.0, help="Fraction of skipped chunks to send anyway to measure recall.")
+    parser.add_argument("--model", type=str, default=DEFAULT_MODEL, help="Model that gives the final judgements.")
+    parser.add_argument("--screening_model", type=str, help="Cheaper model that screens all chunks first.")
+    parser.add_argument("--escalation_confidence", type=float, default=0.75,
+                        help="Send screened chunks judged with less confidence than this to --model.")
+    parser.add_argument("--no_escalate_relevant", action="store_true",
+                        help="Don't send chunks the screening model judged relevant with enough confidence to --model.")
+    args = parser.parse_args(argv)
+
+    phenomena = args.phenomenon_of_interest
+    items = work_queue.enqueue_corpus(
+        args.queue, phenomena[0] if len(phenomena) == 1 else phenomena, args.input_dir, args.output_dir,
+        chunks_per_item=args.chunks_per_item, model=args.model, screening_model=args.screening_model,
+        escalation_confidence=args.escalation_confidence, escalate_relevant=not args.no_escalate_relevant,
+        batch_size=args.batch_size, seed_terms=args.seed_terms, prefilter_threshold=args.prefilter_threshold,
+        audit_rate=args.audit_rate, max_attempts=args.max_attempts, splitter=args.splitter,
+        chunk_tokens=args.chunk_tokens,
+    )
+    print(f"Queued {items} work item(s) in {args.queue}")
+
+def worker_command(argv):
+    parser = argparse.ArgumentParser(prog="dbnl-bear worker",
+                                     description="Claim and analyze work items from a queue made by `dbnl-bear enqueue`.")
+    parser.add_argument("queue", type=str, help="The work queue file.")
+    parser.add_argument("--worker_id", type=str, help="Name of this worker (default: <host>:<pid>).")
+    parser.add_argument("--lease_seconds", type=float, default=120.0,
+                        help="How long a claimed item stays ours without a heartbeat.")
+    parser.add_argument("--poll_interval", type=float, default=5.0,
+                        help="Seconds to wait for items that other workers hold.")
+    parser.add_argument("--keep_running", action="store_true", help="Keep polling when the queue is empty.")
+    parser.add_argument("--no_cache", action="store_true", help="Bypass the on-disk judgement cache.")
+    parser.add_argument("--cache_path", type=str, default=DEFAULT_CACHE_PATH, help="Location of the judgement cache.")
+    parser.add_argument("--requests_per_minute", type=float, default=500, help="Request budget per minute for this worker.")
+    parser.add_argument("--tokens_per_minute", type=float, default=200_000, help="Token budget per minute for this worker.")
+    parser.add_argument("--max_concurrent_requests", type=int, default=50, help="Max requests in flight in this worker.")
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.queue):
+        parser.error(f"No work queue at {args.queue}")
+
+    work_queue.run_worker(
+        args.queue, worker=args.worker_id, lease_seconds=args.lease_seconds, poll_interval=args.poll_interval,
+        exit_when_empty=not args.keep_running, use_cache=not args.no_cache, cache_path=args.cache_path,
+        requests_per_minute=args.requests_per_minute, tokens_per_minute=args.tokens_per_minute,
+        max_concurrent_requests=args.max_concurrent_requests,
+    )
+
+def merge_command(argv):
+    parser = argparse.ArgumentParser(prog="dbnl-bear merge",
+                                     description="Write the outputs of the finished documents of a work queue.")
+    parser.add_argument("queue", type=str, help="The work queue file.")
+    parser.add_argument("--force", action="store_true", help="Also merge documents that were merged before.")
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.queue):
+        parser.error(f"No work queue at {args.queue}")
+
+    report = work_queue.merge_results(args.queue, force=args.force)
+    print(f"Merged {report['files_merged']} file(s); {report['files_complete']} complete, "
+          f"{report['files_open']} still open. Items: {report['done']} done, {report['pending']} pending, "
+          f"{report['leased']} leased, {report['failed']} failed")
+
+def requeue_command(argv):
+    parser = argparse.ArgumentParser(prog="dbnl-bear requeue",
+                                     description="Give items of a work queue back to the workers.")
+    parser.add_argument("queue", type=str, help="The work queue file.")
+    parser.add_argument("--failed", action="store_true", help="Requeue the items that failed, with fresh attempts.")
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.queue):
+        parser.error(f"No work queue at {args.queue}")
+    if not args.failed:
+        parser.error("Say which items to requeue (--failed)")
+
+    print(f"Requeued {work_queue.requeue_failed(args.queue)} failed item(s)")
+
+COMMANDS = {
+    "run": run_command,
+    "batch-export": batch_export_command,
+    "batch-ingest": batch_ingest_command,
+    "parse": parse_command,
+    "barcode": barcode_command,
+    "results": results_command,
+    "export": export_command,
+    "fake-server": fake_server.main,
+    "enqueue": enqueue_command,
+    "worker": worker_command,
+    "merge": merge_command,
+    "requeue": requeue_command,
+}
+
+def main(argv=None):
+    """
+    Dispatch to a subcommand. Without a known subcommand the arguments are passed to
+    ``run``, so ``dbnl-bear "my phenomenon" --input_dir ...`` keeps working.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+    return run_command(argv)
+
 if __name__ == "__main__":
     main()
-
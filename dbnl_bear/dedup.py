@@ -0,0 +1,210 @@
+import asyncio
+from collections import Counter
+import numpy as np
+
+"""
+Corpus-wide near-duplicate detection for chunks (MinHash + LSH).
+
+DBNL has many reprints and editions of the same work, and a lot of recurring front
+matter. Before a run, every chunk of the corpus is fingerprinted with MinHash over
+character shingles; LSH banding finds candidate pairs, which are kept when their
+estimated Jaccard similarity reaches ``threshold``. Clusters are formed with union-find.
+
+During the run only one request is made per cluster: the first member that gets
+analyzed sends the request, the other members wait for its result and reuse it.
+"""
+
+_BASE = 1_000_003
+_WHITESPACE = np.array([ord(c) for c in " \t\n\r\x0b\x0c\xa0\u2009\u200a\u202f\u3000"], dtype=np.uint64)
+
+
+def normalize(text: str):
+    """
+    Code points of the lowercased text with every run of whitespace reduced to one space,
+    plus the array that maps an offset in ``text`` to the matching offset in the result.
+    """
+    lowered = text.lower()
+    if len(lowered) != len(text):
+        lowered = text
+    codes = np.frombuffer(lowered.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    space = np.isin(codes, _WHITESPACE)
+    codes[space] = ord(" ")
+    keep = np.ones(len(codes), dtype=bool)
+    keep[1:] = ~(space[1:] & space[:-1])
+    offsets = np.concatenate(([0], np.cumsum(keep)))
+    return codes[keep], offsets
+
+
+def window_hashes(codes: np.ndarray, k: int = 5) -> np.ndarray:
+    """Hash of the character k-gram starting at every position (a polynomial rolling hash)."""
+    if len(codes) < k:
+        codes = np.pad(codes, (0, k - len(codes)))
+    windows = np.lib.stride_tricks.sliding_window_view(codes, k)
+    powers = np.array([pow(_BASE, k - 1 - j, 1 << 64) for j in range(k)], dtype=np.uint64)
+    hashes = (windows * powers).sum(axis=1)
+    return hashes ^ (hashes >> np.uint64(29))
+
+
+def shingle_hashes(text: str, k: int = 5) -> np.ndarray:
+    """Hashes of the distinct character k-grams of the normalized text."""
+    return np.unique(window_hashes(normalize(text)[0], k))
+
+
+def lsh_parameters(threshold: float, num_perm: int):
+    """Choose (bands, rows) with bands * rows <= num_perm so the LSH S-curve crosses at ``threshold``."""
+    best = None
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        error = abs((1 / bands) ** (1 / rows) - threshold)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = 64, k: int = 5, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.k = k
+        # Multiply-shift hashing: h(x) = (a*x + b) >> 32 with odd a, in wrapping 64-bit arithmetic.
+        self.a = rng.integers(0, 1 << 63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.b = rng.integers(0, 1 << 63, size=num_perm, dtype=np.uint64)
+
+    def _permute(self, hashes: np.ndarray) -> np.ndarray:
+        permuted = np.multiply.outer(hashes, self.a)
+        permuted += self.b
+        permuted >>= np.uint64(32)
+        return permuted.astype(np.uint32)
+
+    def signature(self, text: str) -> np.ndarray:
+        return self._permute(shingle_hashes(text, self.k)).min(axis=0).astype(np.uint32)
+
+    def signatures(self, text: str, spans, block_size: int = 256) -> np.ndarray:
+        """
+        Signatures of the chunks ``text[start:end]`` for all (start, end) in ``spans``,
+        computed for the whole document at once.
+        """
+        codes, offsets = normalize(text)
+        hashes = window_hashes(codes, self.k)
+        spans = [(int(offsets[start]), int(offsets[end])) for start, end in spans]
+        result = np.empty((len(spans), self.num_perm), dtype=np.uint32)
+        for first in range(0, len(spans), block_size):
+            block = spans[first:first + block_size]
+            low = block[0][0]
+            high = max(end for _, end in block) - self.k + 1
+            permuted = self._permute(hashes[low:max(high, low + 1)])
+            for i, (start, end) in enumerate(block, start=first):
+                if end - start < self.k:
+                    # Too short for a full shingle: hash the zero-padded chunk.
+                    result[i] = self._permute(window_hashes(codes[start:end], self.k)).min(axis=0)
+                else:
+                    result[i] = permuted[start - low:end - self.k + 1 - low].min(axis=0)
+        return result
+
+
+def find_clusters(documents, threshold: float = 0.8, num_perm: int = 64, k: int = 5):
+    """
+    Group near-duplicate chunks. ``documents`` is an iterable of (key, text, spans) triples;
+    chunk i of a document is ``text[start:end]`` for the i-th (start, end) in ``spans``.
+    Returns a dict mapping every (key, i) that has near-duplicates to the (key, i)
+    representing its cluster (the first chunk of the cluster).
+    """
+    hasher = MinHasher(num_perm, k)
+    keys = []
+    signatures = []
+    for key, text, spans in documents:
+        if spans:
+            keys.extend((key, i) for i in range(len(spans)))
+            signatures.append(hasher.signatures(text, spans))
+    if not keys:
+        return {}
+    signatures = np.concatenate(signatures)
+    bands, rows = lsh_parameters(threshold, num_perm)
+
+    parent = list(range(len(keys)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for band in range(bands):
+        buckets = {}
+        for i, part in enumerate(signatures[:, band * rows:(band + 1) * rows]):
+            buckets.setdefault(part.tobytes(), []).append(i)
+        for members in buckets.values():
+            first = members[0]
+            for j in members[1:]:
+                root_first, root_j = find(first), find(j)
+                if root_first == root_j:
+                    continue
+                if np.mean(signatures[first] == signatures[j]) >= threshold:
+                    parent[max(root_first, root_j)] = min(root_first, root_j)
+
+    roots = [find(i) for i in range(len(keys))]
+    sizes = Counter(roots)
+    return {key: keys[roots[i]] for i, key in enumerate(keys) if sizes[roots[i]] > 1}
+
+
+class ChunkDeduplicator:
+    """
+    Shares one LLM result between all members of a near-duplicate cluster. Built once
+    per run from the chunks of the whole corpus (see from_corpus).
+    """
+
+    def __init__(self, representatives: dict):
+        self.representatives = representatives
+        self.duplicates = len(representatives)
+        self.clusters = len(set(representatives.values()))
+        self.calls_saved = 0
+        self._futures = {}
+
+    @classmethod
+    def from_corpus(cls, paths, text_splitter, threshold: float = 0.8, num_perm: int = 64):
+        from .ai_read import split_with_offsets
+
+        def documents():
+            for path in paths:
+                with open(path, 'r', encoding='utf-8') as f:
+                    text = f.read()
+                yield path, text, [(start, end) for _, start, end in split_with_offsets(text, text_splitter)]
+
+        return cls(find_clusters(documents(), threshold, num_perm))
+
+    async def resolve(self, key, request, tag=None):
+        """
+        Result for chunk ``key`` (a (path, index) pair). The first member of a cluster to
+        get here awaits ``request()`` (a coroutine function); the other members wait for
+        that result instead of sending their own request. Chunks without near-duplicates
+        always run their own request. Requests with a different ``tag`` (e.g. for another
+        model) are shared separately.
+        """
+        if self.representatives.get(key) is None:
+            return await request()
+        representative = (tag, self.representatives[key])
+        future = self._futures.get(representative)
+        if future is not None:
+            self.calls_saved += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # The request for the cluster failed; try again with our own.
+                self.calls_saved -= 1
+                return await self.resolve(key, request, tag)
+        future = asyncio.get_running_loop().create_future()
+        self._futures[representative] = future
+        try:
+            result = await request()
+        except BaseException:
+            # Don't share a failure: the other members run their own request.
+            del self._futures[representative]
+            future.cancel()
+            raise
+        future.set_result(result)
+        return result
+
+    def stats(self) -> dict:
+        return {"duplicates": self.duplicates, "clusters": self.clusters, "calls_saved": self.calls_saved}
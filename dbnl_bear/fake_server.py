@@ -0,0 +1,291 @@
+import re
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+"""
+A stand-in for the OpenAI chat completions API, for measuring and testing runs without a
+key and without cost. Point a run at it with ``OPENAI_BASE_URL=http://127.0.0.1:<port>/v1``.
+
+The server answers structured-output requests in both forms ``with_structured_output``
+uses: a forced function call (``tools``) and a ``json_schema`` response format. The answer
+is filled in from the schema. Judgements are deterministic: a passage is relevant when it
+mentions one of ``relevant_terms``, or otherwise when a hash of the passage and the field
+falls below ``relevant_rate``, so the same corpus always gives the same verdicts. Batched
+requests (numbered passages, see ``ai_read.format_passages``) get one item per passage.
+
+Every answer is delayed by a draw from a latency distribution (see ``parse_latency``), and
+a fraction ``rate_limit_rate`` of the requests is refused with a 429 and a Retry-After
+header. ``GET /stats`` returns the request count, the number of 429s and the handling
+time of every answered request.
+"""
+
+_PASSAGE = re.compile(r"(?:^|\n\n)\[(\d+)\]\n")
+
+
+def parse_latency(spec: str):
+    """
+    Latency distribution from a spec like ``fixed:0.2``, ``uniform:0.1,0.5``,
+    ``normal:0.3,0.1``, ``lognormal:0.3,0.5`` (median and sigma) or ``exponential:0.3``
+    (mean), all in seconds. Returns a function that draws a delay from a ``random.Random``.
+    """
+    kind, _, arguments = spec.partition(":")
+    try:
+        values = [float(value) for value in arguments.split(",") if value]
+    except ValueError:
+        raise ValueError(f"Invalid latency spec: {spec}")
+    distributions = {
+        "fixed": (1, lambda rng, s: s),
+        "uniform": (2, lambda rng, low, high: rng.uniform(low, high)),
+        "normal": (2, lambda rng, mu, sigma: max(0.0, rng.gauss(mu, sigma))),
+        "lognormal": (2, lambda rng, median, sigma: median * rng.lognormvariate(0.0, sigma)),
+        "exponential": (1, lambda rng, mean: rng.expovariate(1 / mean) if mean > 0 else 0.0),
+    }
+    if kind not in distributions or len(values) != distributions[kind][0]:
+        raise ValueError(f"Invalid latency spec: {spec}; use e.g. fixed:0.2, uniform:0.1,0.5, normal:0.3,0.1, "
+                         f"lognormal:0.3,0.5 or exponential:0.3")
+    draw = distributions[kind][1]
+    return lambda rng: draw(rng, *values)
+
+
+def split_passages(text: str) -> dict:
+    """Passage number -> passage for a batched prompt; {1: text} for a single passage."""
+    parts = _PASSAGE.split(text)
+    if len(parts) < 3:
+        return {1: text}
+    return {int(number): passage for number, passage in zip(parts[1::2], parts[2::2])}
+
+
+class _Server(ThreadingHTTPServer):
+    # A run opens up to --max_concurrent_requests connections at once; with the default
+    # listen backlog of 5 some of them are refused.
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class FakeAnswers:
+    """Fills in a JSON schema with deterministic judgements about a passage."""
+
+    def __init__(self, relevant_terms=(), relevant_rate: float = 0.1):
+        self.relevant_terms = [term.lower() for term in relevant_terms]
+        self.relevant_rate = relevant_rate
+
+    def _fraction(self, *parts) -> float:
+        digest = hashlib.sha256("\x00".join(parts).encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big") / 2 ** 64
+
+    def is_relevant(self, passage: str, field: str) -> bool:
+        if self.relevant_terms:
+            return any(term in passage.lower() for term in self.relevant_terms)
+        return self._fraction(field, passage) < self.relevant_rate
+
+    def fill(self, schema: dict, passages: dict, defs: dict = None, number: int = None):
+        defs = defs if defs is not None else schema.get("$defs", {})
+        if "$ref" in schema:
+            schema = defs[schema["$ref"].rsplit("/", 1)[-1]]
+        for option in schema.get("anyOf", ()):
+            if option.get("type") != "null":
+                return self.fill(option, passages, defs, number)
+        kind = schema.get("type")
+        if kind == "array":
+            item = schema.get("items", {})
+            return [self.fill(item, passages, defs, n) for n in sorted(passages)]
+        if kind != "object":
+            return {"string": "", "boolean": False, "integer": 0, "number": 0.0}.get(kind)
+        passage = passages.get(number or min(passages), "")
+        answer = {}
+        for name, field in schema.get("properties", {}).items():
+            if name.endswith("judgement"):
+                answer[name] = self.is_relevant(passage, name)
+            elif name.endswith("explanation"):
+                judgement = self.is_relevant(passage, name[:-len("explanation")] + "judgement")
+                answer[name] = f"Fake judgement: {'relevant' if judgement else 'not relevant'}."
+            elif name == "confidence":
+                answer[name] = round(0.5 + self._fraction("confidence", passage) / 2, 3)
+            elif name == "passage_number":
+                answer[name] = number or 1
+            else:
+                answer[name] = self.fill(field, passages, defs, number)
+        return answer
+
+
+class FakeOpenAIServer:
+    """
+    The fake chat completions server, run in a background thread. Use it as a context
+    manager; ``base_url`` is the value for ``OPENAI_BASE_URL``.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: str = "fixed:0",
+                 rate_limit_rate: float = 0.0, retry_after: float = 0.5, relevant_terms=(),
+                 relevant_rate: float = 0.1, seed: int = 0):
+        self.latency = parse_latency(latency)
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.answers = FakeAnswers(relevant_terms, relevant_rate)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.rate_limited = 0
+        self.passages = 0
+        self.latencies = []
+        self.httpd = _Server((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def _draw(self):
+        """(delay, rate limited) for the next request."""
+        with self._lock:
+            self.requests += 1
+            if self._rng.random() < self.rate_limit_rate:
+                self.rate_limited += 1
+                return 0.0, True
+            return self.latency(self._rng), False
+
+    def complete(self, request: dict) -> dict:
+        """The chat completion for ``request`` (the parsed request body)."""
+        text = "\n\n".join(message["content"] for message in request.get("messages", [])
+                           if message.get("role") == "user" and isinstance(message.get("content"), str))
+        passages = split_passages(text)
+        message = {"role": "assistant", "content": None}
+        response_format = request.get("response_format") or {}
+        if request.get("tools"):
+            function = request["tools"][0]["function"]
+            choice = request.get("tool_choice")
+            if isinstance(choice, dict):
+                name = choice["function"]["name"]
+                function = next(tool["function"] for tool in request["tools"] if tool["function"]["name"] == name)
+            arguments = json.dumps(self.answers.fill(function.get("parameters", {}), passages), ensure_ascii=False)
+            message["tool_calls"] = [{"id": "call_" + hashlib.sha1(arguments.encode()).hexdigest()[:24],
+                                      "type": "function",
+                                      "function": {"name": function["name"], "arguments": arguments}}]
+            finish_reason, completion = "tool_calls", arguments
+        elif response_format.get("type") == "json_schema":
+            completion = json.dumps(self.answers.fill(response_format["json_schema"]["schema"], passages),
+                                    ensure_ascii=False)
+            message["content"] = completion
+            finish_reason = "stop"
+        else:
+            completion = "This is a fake answer."
+            message["content"] = completion
+            finish_reason = "stop"
+        with self._lock:
+            self.passages += len(passages)
+        prompt_tokens = len(json.dumps(request, ensure_ascii=False)) // 4
+        completion_tokens = len(completion) // 4 + 1
+        return {
+            "id": "chatcmpl-fake" + hashlib.sha1(text.encode("utf-8")).hexdigest()[:20],
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "fake"),
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason, "logprobs": None}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "rate_limited": self.rate_limited, "passages": self.passages,
+                    "latencies": list(self.latencies)}
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _send(self, status: int, body: dict, headers=None):
+                payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                if self.path.rstrip("/") == "/stats":
+                    self._send(200, server.stats())
+                else:
+                    self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+            def do_POST(self):
+                started = time.perf_counter()
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+                    return
+                delay, rate_limited = server._draw()
+                if rate_limited:
+                    self._send(429, {"error": {"message": "Rate limit reached (injected by the fake server)",
+                                               "type": "requests", "code": "rate_limit_exceeded"}},
+                               {"Retry-After": str(server.retry_after)})
+                    return
+                try:
+                    answer = server.complete(json.loads(body))
+                except (ValueError, KeyError, StopIteration) as e:
+                    self._send(400, {"error": {"message": f"Invalid request: {e}"}})
+                    return
+                time.sleep(max(0.0, delay - (time.perf_counter() - started)))
+                self._send(200, answer)
+                with server._lock:
+                    server.latencies.append(time.perf_counter() - started)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> "FakeOpenAIServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="dbnl-bear fake-server",
+                                     description="Run a fake OpenAI chat completions server for testing and benchmarks.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on.")
+    parser.add_argument("--latency", type=str, default="fixed:0",
+                        help="Latency distribution, e.g. fixed:0.2, uniform:0.1,0.5 or lognormal:0.3,0.5 (seconds).")
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0, help="Fraction of requests refused with a 429.")
+    parser.add_argument("--retry_after", type=float, default=0.5, help="Retry-After (seconds) sent with a 429.")
+    parser.add_argument("--relevant_terms", nargs="+", default=(), help="Passages mentioning these terms are relevant.")
+    parser.add_argument("--relevant_rate", type=float, default=0.1,
+                        help="Without terms, the (deterministic) fraction of passages judged relevant.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for latencies and 429s.")
+    args = parser.parse_args(argv)
+
+    server = FakeOpenAIServer(args.host, args.port, latency=args.latency, rate_limit_rate=args.rate_limit_rate,
+                              retry_after=args.retry_after, relevant_terms=args.relevant_terms,
+                              relevant_rate=args.relevant_rate, seed=args.seed)
+    print(f"Fake OpenAI server on {server.base_url}; use OPENAI_BASE_URL={server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import os
+import json
+import time
+
+"""
+Run manifest for checkpointed, resumable corpus runs.
+
+The manifest is an append-only JSON Lines file in the output directory. Every finished
+chunk and every finished file gets a line. Lines are flushed as they are written, so they
+survive a crash of the process; they are fsynced every ``sync_every`` lines or
+``sync_interval`` seconds, and at the end of every file, so a crash of the machine loses
+at most those chunks, which a resumed run analyzes again. A half-written last line (the
+crash happened during the write) is ignored when the manifest is read back.
+
+Chunk records are only kept in memory when a run is resumed, and only for files that the
+interrupted run did not finish; they are handed over (and dropped) when their file is
+picked up again, so memory does not grow with the size of the corpus.
+"""
+
+MANIFEST_NAME = "run_manifest.jsonl"
+
+
+class RunManifest:
+    def __init__(self, output_dir: str, resume: bool = False, sync_every: int = 100, sync_interval: float = 2.0):
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.chunks = {}
+        self.done_files = set()
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+        if resume and os.path.exists(self.path):
+            self._load()
+        self._handle = open(self.path, "a" if resume else "w", encoding="utf-8")
+        if resume and self._handle.tell() > 0:
+            # Start on a fresh line in case the last write was cut off.
+            self._handle.write("\n")
+
+    def _load(self) -> None:
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if "chunk" in record:
+                    passage = (record["passage"], record["start"], record["end"]) if record["judgement"] else None
+                    self.chunks.setdefault(record["file"], {})[record["chunk"]] = passage
+                elif record.get("done"):
+                    self.done_files.add(record["file"])
+                    # A finished file is skipped as a whole; its chunks are not needed.
+                    self.chunks.pop(record["file"], None)
+
+    def _append(self, record: dict) -> None:
+        self._handle.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._handle.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every or time.monotonic() - self._synced_at >= self.sync_interval:
+            self.sync()
+
+    def sync(self) -> None:
+        """fsync the lines written so far."""
+        if self._unsynced:
+            os.fsync(self._handle.fileno())
+            self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def is_done(self, file_name: str) -> bool:
+        return file_name in self.done_files
+
+    def completed_chunks(self, file_name: str) -> dict:
+        """
+        Chunk index -> (passage, start, end), or None for chunks judged not relevant, of the
+        chunks the interrupted run finished. Call once per file: the records are dropped.
+        """
+        return self.chunks.pop(file_name, {})
+
+    def record_chunk(self, file_name: str, index: int, judgement: bool, passage=None) -> None:
+        """``passage`` is the (passage, start, end) tuple of a relevant chunk."""
+        record = {"file": file_name, "chunk": index, "judgement": judgement}
+        if judgement:
+            record["passage"], record["start"], record["end"] = passage
+        self._append(record)
+
+    def finish_file(self, file_name: str) -> None:
+        self._append({"file": file_name, "done": True})
+        self.sync()
+        self.done_files.add(file_name)
+
+    def close(self) -> None:
+        self.sync()
+        self._handle.close()
@@ -0,0 +1,313 @@
+import os
+import json
+import time
+import bisect
+import asyncio
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+"""
+Run metrics: counters, gauges and histograms for the hot path of a run.
+
+All modules record into one process-wide ``registry``:
+
+- ``dbnl_bear_stage_seconds{stage}``: time per pipeline stage. Stages are ``split``
+  (chunking), ``queue`` (waiting for the scheduler and the worker pool), ``request`` (a
+  whole structured-output call, including parsing the answer), ``validation`` (building
+  and checking the results), ``cache``, ``write`` and ``parse`` (XML conversion).
+- ``dbnl_bear_request_latency_seconds{model}``: time between sending a request and its answer.
+- ``dbnl_bear_request_end_to_end_seconds``: time from handing a request to the scheduler until
+  it returns, including waiting for a slot or rate budget and retries with their backoff.
+- ``dbnl_bear_requests_in_flight``, ``dbnl_bear_scheduler_queue_depth`` and
+  ``dbnl_bear_documents_in_progress``: gauges.
+- ``dbnl_bear_requests_total{model}``, ``dbnl_bear_retries_total{reason}``,
+  ``dbnl_bear_errors_total{stage, type}`` and ``dbnl_bear_chunks_total{outcome}``: counters.
+- per-document throughput (chunks, seconds, chunks per second) in the summary.
+
+``MetricsExporter`` writes the registry to a Prometheus text file at a fixed interval (for
+the node_exporter textfile collector, or just to watch); ``write_summary`` writes a JSON
+summary with quantiles at the end of a run. ``TaskSampler`` samples where the asyncio tasks
+of a run are waiting, for ``--profile``.
+"""
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+DESCRIPTIONS = {
+    "dbnl_bear_stage_seconds": "Time spent per pipeline stage.",
+    "dbnl_bear_request_latency_seconds": "Time between sending a request to the model and its answer.",
+    "dbnl_bear_request_end_to_end_seconds": "Time from submitting a request to the scheduler until it returns, "
+                                            "including queueing, rate-limit waits and retries.",
+    "dbnl_bear_requests_in_flight": "Requests sent and not answered yet.",
+    "dbnl_bear_scheduler_queue_depth": "Requests waiting for a scheduler slot or rate budget.",
+    "dbnl_bear_documents_in_progress": "Documents being analyzed.",
+    "dbnl_bear_requests_total": "Requests sent to the model.",
+    "dbnl_bear_retries_total": "Requests retried, by reason.",
+    "dbnl_bear_errors_total": "Errors, by stage and type.",
+    "dbnl_bear_chunks_total": "Chunk judgements, by outcome (escalated chunks are judged twice).",
+    "dbnl_bear_documents_total": "Documents finished, by outcome.",
+}
+
+
+class Histogram:
+    """Cumulative-bucket histogram, as Prometheus keeps them."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float):
+        """Estimate of the ``q`` quantile, interpolated within its bucket (like histogram_quantile)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                low = self.buckets[i - 1] if i > 0 else 0.0
+                high = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(low + (high - low) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+
+def _bucket_bounds(histogram: Histogram) -> list:
+    return [repr(float(bound)) for bound in histogram.buckets] + ["+Inf"]
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+            self.documents = {}
+            self.started = time.time()
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        key = (name, _label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self.gauges[(name, _label_key(labels))] = value
+
+    def add(self, name: str, amount: float, **labels) -> None:
+        key = (name, _label_key(labels))
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, stage: str):
+        """Add the time spent in the ``with`` block to ``dbnl_bear_stage_seconds{stage}``."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("dbnl_bear_stage_seconds", time.perf_counter() - started, stage=stage)
+
+    def timed(self, iterable, stage: str):
+        """Iterate over ``iterable``, adding the time spent producing every item to ``stage``."""
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.observe("dbnl_bear_stage_seconds", time.perf_counter() - started, stage=stage)
+            yield item
+
+    def record_document(self, name: str, chunks: int, seconds: float) -> None:
+        with self._lock:
+            self.documents[name] = {"chunks": chunks, "seconds": round(seconds, 3),
+                                    "chunks_per_second": round(chunks / seconds, 2) if seconds > 0 else None}
+
+    def to_prometheus(self) -> str:
+        """The registry in the Prometheus text exposition format."""
+        with self._lock:
+            series = {}
+            for kind, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+                for (name, key), value in metrics.items():
+                    series.setdefault((name, kind), []).append(f"{name}{_format_labels(key)} {value}")
+            for (name, key), histogram in self.histograms.items():
+                lines = series.setdefault((name, "histogram"), [])
+                cumulative = 0
+                for bound, count in zip(_bucket_bounds(histogram), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(key, (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum}")
+                lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        text = []
+        for (name, kind), lines in sorted(series.items()):
+            text.append(f"# HELP {name} {DESCRIPTIONS.get(name, name)}")
+            text.append(f"# TYPE {name} {kind}")
+            text.extend(lines)
+        return "\n".join(text) + "\n"
+
+    def summary(self) -> dict:
+        """Counters, gauges, histogram quantiles and per-document throughput, as plain data."""
+
+        def labelled(name, key):
+            return name + _format_labels(key)
+
+        with self._lock:
+            histograms = {}
+            for (name, key), histogram in self.histograms.items():
+                histograms[labelled(name, key)] = {
+                    "count": histogram.count,
+                    "sum": round(histogram.sum, 6),
+                    "mean": round(histogram.sum / histogram.count, 6) if histogram.count else None,
+                    "max": round(histogram.max, 6),
+                    **{f"p{round(q * 100)}": histogram.quantile(q) for q in (0.5, 0.95, 0.99)},
+                }
+            return {
+                "started": self.started,
+                "seconds": round(time.time() - self.started, 3),
+                "counters": {labelled(name, key): value for (name, key), value in sorted(self.counters.items())},
+                "gauges": {labelled(name, key): value for (name, key), value in sorted(self.gauges.items())},
+                "histograms": dict(sorted(histograms.items())),
+                "documents": dict(self.documents),
+            }
+
+    def write_prometheus(self, path: str) -> None:
+        # Write next to the target and rename, so a reader never sees a half-written file.
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(temporary, path)
+
+    def write_summary(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=2, ensure_ascii=False)
+
+
+registry = MetricsRegistry()
+
+
+def error_reason(error: Exception) -> str:
+    """Short label for an error: its HTTP status code if it has one, its type otherwise."""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return str(status) if status is not None else type(error).__name__
+
+
+class MetricsExporter:
+    """Writes ``registry`` to the Prometheus text file ``path`` every ``interval`` seconds, from a thread."""
+
+    def __init__(self, path: str, interval: float = 15.0, metrics: MetricsRegistry = registry):
+        self.path = path
+        self.interval = interval
+        self.metrics = metrics
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _loop(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.metrics.write_prometheus(self.path)
+
+    def start(self) -> "MetricsExporter":
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop exporting, after a last write."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.metrics.write_prometheus(self.path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def task_location(task) -> str:
+    """Where ``task`` is waiting: the chain of coroutines it is in, outermost first."""
+    frames = []
+    awaitable = task.get_coro()
+    while awaitable is not None:
+        frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "ag_frame", None)
+        if frame is None:
+            break
+        frames.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+        awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "ag_await", None)
+    return " -> ".join(frames) or repr(task.get_coro())
+
+
+class TaskSampler:
+    """
+    Samples the asyncio tasks of the running loop every ``interval`` seconds and counts where
+    they are waiting (see ``task_location``), which shows where a run spends its time when
+    cProfile only sees the event loop.
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.samples = 0
+        self.locations = Counter()
+        self._task = None
+
+    async def _sample(self) -> None:
+        current = asyncio.current_task()
+        while True:
+            for task in asyncio.all_tasks():
+                if task is not current:
+                    self.locations[task_location(task)] += 1
+            self.samples += 1
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        """Start sampling; call from within the running loop."""
+        self._task = asyncio.get_running_loop().create_task(self._sample())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+    def report(self) -> dict:
+        return {"interval": self.interval, "samples": self.samples,
+                "locations": [{"tasks": count, "location": location}
+                              for location, count in self.locations.most_common()]}
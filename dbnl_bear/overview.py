@@ -4,57 +4,83 @@ import matplotlib.pyplot as plt
 import tqdm
 import numpy as np
 
+import os
+import json
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
 """
-The highlight relevant passages function still has flaws.
-I have not been able to come up with a system that has 100% recall and 100% precision,
-but theoretically that should be possible.
+Runs write the character offsets of every relevant passage next to the passages
+(``<name>_relevant_spans.jsonl``), so highlighting and plotting can use exact spans.
 
-The barcode plot has the same issue (with a different solution though) but here the problem
-is less urgent because the barcode plot is just used to give an indication so there's more
-room for error.
+For older output files without offsets the passages have to be found in the text again.
+align_passages does that: exact matches first, a fuzzy match only as a last resort.
+That fallback still has flaws; 100% recall and precision is not guaranteed there.
 """
 
-def highlight_relevant_passages(input_file, output_file, relevant_passages):
+def load_relevant_spans(spans_file):
+    """Read the (start, end) offsets written next to a ``_relevant.txt`` file."""
+    with open(spans_file, 'r', encoding='utf-8') as file:
+        return [tuple(json.loads(line)) for line in file if line.strip()]
+
+def align_passages(original_text, relevant_passages):
+    """
+    Fallback for legacy output files without offsets: find the (start, end) span of every
+    passage, in order. Passages are looked up exactly from the previous match onwards;
+    only when that fails a fuzzy alignment is done, first just after the previous match and
+    then on the rest of the text.
+    """
+    spans = []
+    current_pos = 0
+    for passage in relevant_passages:
+        if not passage:
+            continue
+        start = original_text.find(passage, current_pos)
+        if start == -1:
+            start = original_text.find(passage)
+        if start != -1:
+            spans.append((start, start + len(passage)))
+            current_pos = start + 1
+            continue
+        for window in (original_text[current_pos:current_pos + 4 * len(passage) + 1000], original_text[current_pos:]):
+            alignment = fuzz.partial_ratio_alignment(passage, window, score_cutoff=80)
+            if alignment is not None:
+                spans.append((current_pos + alignment.dest_start, current_pos + alignment.dest_end))
+                current_pos += alignment.dest_start + 1
+                break
+    return spans
+
+def highlight_relevant_passages(input_file, output_file, relevant_passages=None, spans=None):
+    """
+    Write the text of ``input_file`` to a Word document with the relevant passages highlighted.
+    Pass the ``spans`` of a run (see load_relevant_spans) for exact highlighting; with only
+    ``relevant_passages`` the spans are recovered with align_passages.
+    """
     # Read the original text
     with open(input_file, 'r', encoding='utf-8') as file:
         original_text = file.read()
 
+    if spans is None:
+        spans = align_passages(original_text, relevant_passages or [])
+
     # Create a new Word document
     doc = docx.Document()
 
-    # Preprocess the text to create an index
-    text_index = {}
-    for i in range(len(original_text) - 5):
-        five_gram = original_text[i:i+5]
-        if five_gram not in text_index:
-            text_index[five_gram] = []
-        text_index[five_gram].append(i)
-
     # Process the text and add it to the document with highlighting
     current_pos = 0
-    for passage in tqdm.tqdm(relevant_passages, desc="Processing passages"):
-        # Find the best match for the passage using the index
-        best_match = None
-        best_ratio = 0
-        potential_starts = text_index.get(passage[:5], [])
-        
-        for start in potential_starts:
-            end = start + len(passage)
-            substring = original_text[start:end]
-            ratio = fuzz.ratio(passage, substring)
-            if ratio > best_ratio:
-                best_ratio = ratio
-                best_match = (start, end)
-
-        if best_match:
-            doc.add_paragraph(original_text[current_pos:best_match[0]])
-
-            # Add the matched text with yellow highlighting
-            p = doc.add_paragraph()
-            run = p.add_run(original_text[best_match[0]:best_match[1]])
-            run.font.highlight_color = docx.enum.text.WD_COLOR_INDEX.YELLOW
-
-            current_pos = best_match[1]
+    for start, end in tqdm.tqdm(sorted(spans), desc="Processing passages"):
+        # Consecutive chunks overlap a little; don't add the overlap twice
+        start = max(start, current_pos)
+        if end <= start:
+            continue
+        doc.add_paragraph(original_text[current_pos:start])
+
+        # Add the matched text with yellow highlighting
+        p = doc.add_paragraph()
+        run = p.add_run(original_text[start:end])
+        run.font.highlight_color = docx.enum.text.WD_COLOR_INDEX.YELLOW
+
+        current_pos = end
 
     # Add any remaining text
     if current_pos < len(original_text):
@@ -63,13 +89,19 @@ def highlight_relevant_passages(input_file, output_file, relevant_passages):
     # Save the document
     doc.save(output_file)
 
-def map_to_original_index(original_text, alphanumeric_index):
-    alphanumeric_count = 0
-    for i, char in enumerate(original_text):
-        if char.isalnum():
-            if alphanumeric_count == alphanumeric_index:
-                return i
-            alphanumeric_count += 1
+def alphanumeric_positions(original_text):
+    """Positions of the alphanumeric characters, so map_to_original_index is a lookup."""
+    return [i for i, char in enumerate(original_text) if char.isalnum()]
+
+def map_to_original_index(original_text, alphanumeric_index, positions=None):
+    """
+    Map the index of an alphanumeric character to its index in ``original_text``.
+    Pass ``positions`` from alphanumeric_positions when mapping many indices.
+    """
+    if positions is None:
+        positions = alphanumeric_positions(original_text)
+    if alphanumeric_index < len(positions):
+        return positions[alphanumeric_index]
     return len(original_text)
 
 def create_plain_text_output(output_file, document_name, relevant_passages):
@@ -78,13 +110,90 @@ def create_plain_text_output(output_file, document_name, relevant_passages):
         for n, passage in enumerate(relevant_passages):
             file.write(f"No. {n}:    {passage}\n")
 
-def create_barcode_plot(relevant_passages, all_passages):
-    barcode = np.array([1 if p in relevant_passages else 0 for p in all_passages])
+def create_barcode_plot(relevant_passages, all_passages, output_file=None):
+    """
+    One bar per passage, black where the passage is relevant. The passages can be strings
+    or, better, (start, end) spans, which identify a chunk exactly. With ``output_file``
+    the plot is saved there (no display needed) instead of shown.
+    """
+    relevant = set(relevant_passages)
+    barcode = np.array([1 if p in relevant else 0 for p in all_passages])
     pixel_per_bar = 4
     dpi = 100
-    fig = plt.figure(figsize=(len(barcode) * pixel_per_bar / dpi, 2), dpi=dpi)
+    figsize = (len(barcode) * pixel_per_bar / dpi, 2)
+    if output_file is not None:
+        fig = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(fig)
+    else:
+        fig = plt.figure(figsize=figsize, dpi=dpi)
     ax = fig.add_axes([0, 0, 1, 1])  # span the whole figure
     ax.set_axis_off()
     ax.imshow(barcode.reshape(1, -1), cmap='binary', aspect='auto',
           interpolation='nearest')
-    plt.show()
+    if output_file is not None:
+        fig.savefig(output_file)
+    else:
+        plt.show()
+
+def spans_to_row(spans, text_length, n_bins=1000):
+    """
+    Relevance of one document as a row of ``n_bins`` bins over its relative position
+    (0 = start of the text, 1 = end): 1 where a relevant span covers the bin.
+    """
+    row = np.zeros(n_bins + 1, dtype=np.int32)
+    if len(spans) and text_length:
+        spans = np.asarray(spans, dtype=np.float64)
+        starts = np.floor(spans[:, 0] / text_length * n_bins).astype(np.int64)
+        ends = np.ceil(spans[:, 1] / text_length * n_bins).astype(np.int64)
+        # Every span covers at least one bin
+        ends = np.clip(np.maximum(ends, starts + 1), 0, n_bins)
+        np.add.at(row, np.clip(starts, 0, n_bins - 1), 1)
+        np.add.at(row, ends, -1)
+    return (np.cumsum(row[:-1]) > 0).astype(np.uint8)
+
+def corpus_relevance_matrix(input_dir, output_dir, n_bins=1000, spans=None):
+    """
+    Relevance matrix of a whole run: one row per .txt file in ``input_dir`` (sorted by
+    name), built from the spans files in ``output_dir``. Legacy outputs with only a
+    ``_relevant.txt`` file are aligned with the text first. ``spans`` (a dict of file name
+    -> spans, e.g. from a ResultsStore) can be given instead of ``output_dir``.
+    Returns (names, matrix).
+    """
+    names = sorted(f for f in os.listdir(input_dir) if f.endswith('.txt'))
+    matrix = np.zeros((len(names), n_bins), dtype=np.uint8)
+    for i, name in enumerate(names):
+        if spans is not None:
+            if spans.get(name):
+                with open(os.path.join(input_dir, name), 'r', encoding='utf-8') as file:
+                    matrix[i] = spans_to_row(spans[name], len(file.read()), n_bins)
+            continue
+        spans_file = os.path.join(output_dir, name + "_relevant_spans.jsonl")
+        passages_file = os.path.join(output_dir, name + "_relevant.txt")
+        if not os.path.exists(spans_file) and not os.path.exists(passages_file):
+            continue
+        with open(os.path.join(input_dir, name), 'r', encoding='utf-8') as file:
+            original_text = file.read()
+        if os.path.exists(spans_file):
+            doc_spans = load_relevant_spans(spans_file)
+        else:
+            with open(passages_file, 'r', encoding='utf-8') as file:
+                doc_spans = align_passages(original_text, file.read().splitlines())
+        matrix[i] = spans_to_row(doc_spans, len(original_text), n_bins)
+    return names, matrix
+
+def render_corpus_barcode(input_dir, output_dir, image_file, n_bins=1000, pixel_per_row=4, spans=None):
+    """
+    Draw every document of a run as one row of a barcode image and save it as
+    ``image_file`` (PNG, SVG, ... by extension). Rendering uses the non-interactive Agg
+    canvas, so it works on headless machines. See corpus_relevance_matrix for ``spans``.
+    Returns the document names in row order.
+    """
+    names, matrix = corpus_relevance_matrix(input_dir, output_dir, n_bins, spans=spans)
+    dpi = 100
+    fig = Figure(figsize=(max(n_bins, 100) / dpi, max(len(names) * pixel_per_row, 20) / dpi), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    ax.imshow(matrix, cmap='binary', aspect='auto', interpolation='nearest', vmin=0, vmax=1)
+    fig.savefig(image_file, dpi=dpi)
+    return names
@@ -1,9 +1,74 @@
 import os
+import time
 import lxml.etree as ET
 import tqdm
 import glob
 import re
 import html
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from .metrics import registry as metrics
+
+
+@functools.lru_cache(maxsize=None)
+def entity_declarations():
+    """The entity declarations for the internal DTD subset, built once per process."""
+    entities = DBNLParser().make_html_entity_dict()
+    return "".join(f'<!ENTITY {name} "&#{codepoint};">\n' for name, codepoint in entities.items())
+
+
+@functools.lru_cache(maxsize=None)
+def entity_declaration_bytes():
+    return ("\n[" + entity_declarations() + "]").encode("utf-8")
+
+
+class TextCollector:
+    """
+    lxml parser target that keeps only the character data inside the <text> element.
+    The data arrives in document order, exactly as ``itertext()`` on the <text> element
+    would return it, but without ever building the tree.
+    """
+    def __init__(self):
+        self.depth = 0
+        self.text_elements = 0
+        self.parts = []
+
+    def start(self, tag, attrib):
+        if tag == "text":
+            self.text_elements += 1
+        if self.depth:
+            self.depth += 1
+        elif tag == "text":
+            self.depth = 1
+
+    def end(self, tag):
+        if self.depth:
+            self.depth -= 1
+
+    def data(self, data):
+        if self.depth:
+            self.parts.append(data)
+
+    def comment(self, text):
+        pass
+
+    def close(self):
+        return "".join(self.parts)
+
+
+def _convert_file(job):
+    """
+    Worker for the process pool: convert one file, return (file name, error or None,
+    seconds, error type or None).
+    """
+    f_name, input_dir, output_dir = job
+    started = time.perf_counter()
+    try:
+        parser.get_text_dbnl(os.path.join(input_dir, f_name), parser.extract_dbnl_id(f_name), output_dir)
+    except Exception as e:
+        return f_name, str(e), time.perf_counter() - started, type(e).__name__
+    return f_name, None, time.perf_counter() - started, None
+
 
 class DBNLParser:
     @staticmethod
@@ -96,14 +161,20 @@ class DBNLParser:
         Note that this function is written for conversion of html character entities
         to numerical representations. For other use, some tweaks might be needed.
         """
-        html_decimal_dict = self.make_html_entity_dict()
-        new_declaration = ""
+        return '.dtd"' + "\n[" + entity_declarations() + "]"
 
-        for item in html_decimal_dict.items():
-            new_str = f'<!ENTITY {item[0]} "&#{item[1]};">\n'
-            new_declaration += new_str
-
-        return '.dtd"' + "\n[" + new_declaration + "]"
+    @staticmethod
+    def inject_declaration(head):
+        """
+        In-memory counterpart of add_declaration_to_xml for the first bytes of a file:
+        returns ``head`` with the entity declarations added to its DOCTYPE. Files without
+        a DOCTYPE, or that already have an internal subset, are returned unchanged.
+        """
+        start = head.find(b'<!DOCTYPE')
+        end = head.find(b'.dtd"', start) + len(b'.dtd"')
+        if start == -1 or end < len(b'.dtd"') or head[end:].lstrip().startswith(b'['):
+            return head
+        return head[:start] + head[start:end] + entity_declaration_bytes() + head[end:]
 
 
     def add_declaration_to_xml(self, xml_dir):
@@ -139,38 +210,78 @@ class DBNLParser:
             raise ValueError(f"Expected exactly 1 <text> element, but found {len(text_elements)}.")
         return text_elements[0]
 
+    @staticmethod
+    def read_blocks(xml_source, block_size=1 << 20):
+        """
+        Yield the bytes of ``xml_source`` (a path, or a bytes-like object such as an mmap)
+        block by block, with the entity declarations injected into the first block.
+        Nothing is written back, so read-only sources work.
+        """
+        # The first block must hold the whole DOCTYPE.
+        head_size = max(block_size, 1 << 16)
+        if isinstance(xml_source, (str, os.PathLike)):
+            with open(xml_source, "rb") as f:
+                yield DBNLParser.inject_declaration(f.read(head_size))
+                yield from iter(lambda: f.read(block_size), b"")
+        else:
+            data = memoryview(xml_source)
+            yield DBNLParser.inject_declaration(bytes(data[:head_size]))
+            for offset in range(head_size, len(data), block_size):
+                yield data[offset:offset + block_size]
+
+    @staticmethod
+    def stream_text(xml_source, block_size=1 << 20):
+        """
+        Streaming counterpart of ``find_text_element(root).itertext()``: feeds the file to
+        the parser block by block and only keeps the text inside <text>.
+        """
+        collector = TextCollector()
+        xml_parser = ET.XMLParser(target=collector)
+        for block in DBNLParser.read_blocks(xml_source, block_size):
+            xml_parser.feed(bytes(block))
+        text = xml_parser.close()
+        # Same check as find_text_element; done here so parse errors are not masked.
+        if collector.text_elements != 1:
+            raise ValueError(f"Expected exactly 1 <text> element, but found {collector.text_elements}.")
+        return text
+
     def get_text_dbnl(self, xml_file, id, output_dir):
         """
         Extracts text from a dbnl xml-file and saves it as a .txt file.
         In this setup, notes in the texts (e.g. explanations, references) are not removed!
         """
-        # Parse the XML file
-        tree = ET.parse(xml_file)
-        root = tree.getroot()
-
-    # Find the <text> element and extract main text
-        text_element = self.find_text_element(root)
-        main_text = self.clean_whitespace("".join(text_element.itertext()))
+        main_text = self.clean_whitespace(self.stream_text(xml_file))
 
         # Save the combined text to a file
         with open(f"{output_dir}/{id}.txt", "w", encoding="utf-8") as f:
             f.write(main_text)
 
 
-    def dbnl_to_txt(self, input_dir, output_dir="dbnl_txt_files"):
+    def dbnl_to_txt(self, input_dir, output_dir="dbnl_txt_files", jobs=1):
         """
-        Puts the pieces of the pipeline together.
+        Puts the pieces of the pipeline together. With ``jobs`` > 1 the files are
+        converted in a pool of that many processes.
+
+        Returns a dict mapping the names of files that could not be parsed to the error.
+        The entity declarations are added while reading, the XML files are left untouched.
         """
-        self.add_declaration_to_xml(input_dir)
         xml_files = self.get_files_with_extension(input_dir, "xml")
         self.create_if_absent(output_dir)
-        for f in tqdm.tqdm(xml_files):
-            id = self.extract_dbnl_id(f)
-            p = os.path.join(input_dir, f)
-            try:
-                self.get_text_dbnl(p, id, output_dir)
-            except Exception as e:
-                error_message = f"file {id} could not be parsed because of: {e}"
-                print(error_message)
-
-parser = DBNLParser()
\ No newline at end of file
+        work = [(f, input_dir, output_dir) for f in xml_files]
+        if jobs > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                outcomes = list(tqdm.tqdm(executor.map(_convert_file, work, chunksize=8), total=len(work)))
+        else:
+            outcomes = [_convert_file(job) for job in tqdm.tqdm(work)]
+        # The workers can't record metrics in this process, so it is done from their outcomes.
+        for _, error, seconds, error_type in outcomes:
+            metrics.observe("dbnl_bear_stage_seconds", seconds, stage="parse")
+            metrics.inc("dbnl_bear_documents_total", outcome="parse_failed" if error is not None else "parsed")
+            if error is not None:
+                metrics.inc("dbnl_bear_errors_total", stage="parse", type=error_type)
+        errors = {f: error for f, error, _, _ in outcomes if error is not None}
+        if errors:
+            print(f"{len(errors)} of {len(xml_files)} files could not be parsed")
+        return errors
+
+parser = DBNLParser()
@@ -0,0 +1,93 @@
+import re
+import math
+import random
+
+"""
+Cheap lexical pre-filter that runs between splitting and the LLM.
+
+Chunks are scored by how often they mention one of the seed terms. The seed terms are
+expanded with common Early Modern Dutch spelling variation first (y/ij, ae/aa, ck/k, ...)
+and matched as word prefixes, so "tulp" also finds "thulp", "tulpe", "tulpen" and "tulpaen".
+Forms that differ more (like "tulipaen") have to be given as seed terms themselves.
+
+Only chunks that score at least ``threshold`` (or, with ``top_fraction``, the best scoring
+fraction of a document) are sent to the LLM. To measure what the filter costs in recall,
+``audit_rate`` sends a random sample of the skipped chunks anyway.
+"""
+
+# Groups of spellings that are used interchangeably.
+SPELLING_VARIANTS = [
+    ("ij", "y"),
+    ("ae", "aa"),
+    ("ck", "k"),
+    ("uy", "ui"),
+    ("gh", "g"),
+    ("ph", "f"),
+    ("th", "t"),
+]
+
+_VARIANT_GROUPS = {spelling: group for group in SPELLING_VARIANTS for spelling in group}
+_VARIANT_SPLITTER = re.compile("|".join(sorted(_VARIANT_GROUPS, key=len, reverse=True)))
+
+
+def spelling_pattern(term: str) -> str:
+    """
+    Regular expression matching ``term`` in all its spellings: every part of the term that
+    has variants (see SPELLING_VARIANTS) is replaced by an alternation of those variants,
+    so "tuyn" becomes "(?:th|t)(?:uy|ui)n" and "ackerbouw" becomes "a(?:ck|k)erbouw".
+    """
+    term = term.lower()
+    parts = []
+    position = 0
+    for match in _VARIANT_SPLITTER.finditer(term):
+        parts.append(re.escape(term[position:match.start()]))
+        group = sorted(_VARIANT_GROUPS[match.group()], key=len, reverse=True)
+        parts.append("(?:" + "|".join(group) + ")")
+        position = match.end()
+    parts.append(re.escape(term[position:]))
+    return "".join(parts)
+
+
+class LexicalPrefilter:
+    def __init__(self, seed_terms, threshold: int = 1, top_fraction: float = None,
+                 audit_rate: float = 0.0, seed: int = 0):
+        if not seed_terms:
+            raise ValueError("The pre-filter needs at least one seed term.")
+        self.pattern = re.compile(r"\b(?:" + "|".join(spelling_pattern(term) for term in seed_terms) + r")\w*",
+                                  re.IGNORECASE)
+        self.threshold = threshold
+        self.top_fraction = top_fraction
+        self.audit_rate = audit_rate
+        self.seed = seed
+
+    def score(self, chunk: str) -> int:
+        return sum(1 for _ in self.pattern.finditer(chunk))
+
+    def is_audited(self, index: int, chunk: str) -> bool:
+        """Whether skipped chunk ``index`` is in the audit sample (the same in a resumed run)."""
+        return self.audit_rate > 0 and random.Random(f"{self.seed}:{index}:{chunk}").random() < self.audit_rate
+
+    def select(self, chunks):
+        """
+        Decide which chunks go to the LLM. Returns (kept, audited): the indices that pass
+        the filter and the sample of skipped indices that is sent anyway for auditing.
+        """
+        scores = [self.score(chunk) for chunk in chunks]
+        if self.top_fraction is not None:
+            k = math.ceil(self.top_fraction * len(chunks))
+            ranked = sorted(range(len(chunks)), key=lambda i: (-scores[i], i))
+            kept = set(ranked[:k])
+        else:
+            kept = {i for i, score in enumerate(scores) if score >= self.threshold}
+        audited = {i for i, chunk in enumerate(chunks) if i not in kept and self.is_audited(i, chunk)}
+        return kept, audited
+
+    def decide(self, index: int, chunk: str):
+        """
+        ``select`` for a single chunk, for when the chunks of a document are streamed:
+        returns (kept, audited). Not possible with ``top_fraction``, which ranks whole documents.
+        """
+        if self.top_fraction is not None:
+            raise ValueError("top_fraction needs all chunks of a document; use a threshold when streaming.")
+        kept = self.score(chunk) >= self.threshold
+        return kept, not kept and self.is_audited(index, chunk)
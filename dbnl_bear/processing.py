@@ -1,34 +1,403 @@
 import os
+import json
+import time
 import asyncio
+import cProfile
 from . import ai_read
+from .cache import JudgementCache, DEFAULT_CACHE_PATH
+from .scheduler import RequestScheduler
+from .manifest import RunManifest
+from .prefilter import LexicalPrefilter
+from .dedup import ChunkDeduplicator
+from .cascade import EscalationPolicy
+from .token_cost import TokenCostTracker, CostBudget
+from .results_store import ResultsStore, STORE_NAME
+from .metrics import registry as metrics, MetricsExporter, TaskSampler
+from .segment import DEFAULT_CHUNK_TOKENS
 
-async def _process_file(path: str, phenomenon: str, output_dir: str):
-    result, _ = await ai_read.analyze_document(path, phenomenon)
-    relevant = [r.original_sentence for r in result if r.judgement]
+RELEVANT_SUFFIX = "_relevant.txt"
+SPANS_SUFFIX = "_relevant_spans.jsonl"
+METRICS_SUMMARY_NAME = "metrics_summary.json"
+# Answer tokens allowed per chunk and phenomenon when a cost budget is set.
+COMPLETION_TOKEN_CAP = 400
+
+def write_relevant_passages(path: str, output_dir: str, relevant, spans=None) -> None:
+    """
+    Write the relevant passages of the document at ``path`` to ``<name>_relevant.txt``
+    and, if known, their (start, end) character offsets to ``<name>_relevant_spans.jsonl``.
+    """
     if relevant:
-        out_path = os.path.join(output_dir, os.path.basename(path) + "_relevant.txt")
+        out_path = os.path.join(output_dir, os.path.basename(path) + RELEVANT_SUFFIX)
         with open(out_path, "w", encoding="utf-8") as f:
             for passage in relevant:
                 f.write(f"{passage}\n")
+        if spans is not None:
+            with open(os.path.join(output_dir, os.path.basename(path) + SPANS_SUFFIX), "w", encoding="utf-8") as f:
+                for start, end in spans:
+                    f.write(json.dumps([start, end]) + "\n")
     else:
         print(f"No relevant passages found in file {os.path.basename(path)}")
 
-async def _run(paths, phenomenon: str, output_dir: str, max_tasks: int):
-    os.makedirs(output_dir, exist_ok=True)
+class RelevantPassageWriter:
+    """
+    Appends the relevant passages of one document to ``<name>_relevant.txt`` (and their
+    offsets to ``<name>_relevant_spans.jsonl``) while the results come in. Results may
+    arrive out of order; they are held back until all earlier chunks are known, so the
+    files are always in document order. Lines are flushed as they are written and fsynced
+    when the writer is closed: after a crash, a resumed run writes the files again from
+    the run manifest.
+    """
+
+    def __init__(self, path: str, output_dir: str):
+        self.out_path = os.path.join(output_dir, os.path.basename(path) + RELEVANT_SUFFIX)
+        self.spans_path = os.path.join(output_dir, os.path.basename(path) + SPANS_SUFFIX)
+        for stale in (self.out_path, self.spans_path):
+            if os.path.exists(stale):
+                os.remove(stale)
+        self.next_index = 0
+        self.pending = {}
+        self.count = 0
+        self._handles = None
+
+    def add(self, index: int, passage=None) -> None:
+        """Register chunk ``index``: a (passage, start, end) tuple if relevant, None otherwise."""
+        self.pending[index] = passage
+        while self.next_index in self.pending:
+            passage = self.pending.pop(self.next_index)
+            if passage is not None:
+                self._write(*passage)
+            self.next_index += 1
+
+    def _write(self, passage: str, start: int, end: int) -> None:
+        if self._handles is None:
+            self._handles = (open(self.out_path, "a", encoding="utf-8"),
+                             open(self.spans_path, "a", encoding="utf-8"))
+        for handle, line in zip(self._handles, (passage, json.dumps([start, end]))):
+            handle.write(f"{line}\n")
+            handle.flush()
+        self.count += 1
+
+    def close(self) -> None:
+        if self._handles is not None:
+            for handle in self._handles:
+                os.fsync(handle.fileno())
+                handle.close()
+
+def phenomenon_output_dirs(phenomena, output_dir: str) -> dict:
+    """Output directory of every phenomenon: ``output_dir`` itself, or a subdirectory per phenomenon."""
+    if len(phenomena) == 1:
+        return {phenomena[0]: output_dir}
+    return {phenomenon: os.path.join(output_dir, ai_read.phenomenon_field_name(phenomenon)) for phenomenon in phenomena}
+
+async def _process_file(path: str, session, output_dirs: dict, cache=None, scheduler=None,
+                        batch_size: int = 1, manifests=None, prefilter=None, deduplicator=None,
+                        store=None, run_id=None):
+    """
+    Analyze one document for all phenomena of ``session``. ``output_dirs`` and
+    ``manifests`` map every phenomenon to its output directory and run manifest; every
+    verdict also goes to run ``run_id`` of the results ``store``.
+    """
+    name = os.path.basename(path)
+    if manifests is not None and all(manifest.is_done(name) for manifest in manifests.values()):
+        return
+    completed = {phenomenon: manifest.completed_chunks(name) for phenomenon, manifest in (manifests or {}).items()}
+    # Only chunks that are done for every phenomenon are skipped.
+    done = set.intersection(*(set(chunks) for chunks in completed.values())) if completed else set()
+    writers = {phenomenon: RelevantPassageWriter(path, directory) for phenomenon, directory in output_dirs.items()}
+    for phenomenon, writer in writers.items():
+        for index in sorted(done):
+            writer.add(index, completed[phenomenon][index])
+    failed = []
+    handled = 0
+    started = time.perf_counter()
+    metrics.add("dbnl_bear_documents_in_progress", 1)
+
+    def on_result(index, result):
+        nonlocal handled
+        handled += 1
+        with metrics.timer("write"):
+            write_result(index, result)
+
+    def write_result(index, result):
+        if result is None:
+            failed.append(index)
+            for writer in writers.values():
+                writer.add(index, None)
+            return
+        for phenomenon, (judgement, explanation) in session.judgements(result).items():
+            passage = (result.original_sentence, result.start, result.end) if judgement else None
+            if store is not None:
+                store.record(run_id, path, index, phenomenon, judgement, explanation, start=result.start,
+                             end=result.end, passage=result.original_sentence, model=result.judged_by)
+            if manifests is not None:
+                manifests[phenomenon].record_chunk(name, index, judgement, passage)
+            writers[phenomenon].add(index, passage)
+
+    try:
+        if prefilter is not None and prefilter.top_fraction is not None:
+            # Ranking the chunks needs the whole document at once.
+            await session.analyze_file(path, cache=cache, scheduler=scheduler, batch_size=batch_size,
+                                       skip_chunks=done, on_result=on_result, prefilter=prefilter,
+                                       deduplicator=deduplicator)
+        else:
+            async for index, result in session.stream_file(path, cache=cache, scheduler=scheduler,
+                                                           batch_size=batch_size, skip_chunks=done,
+                                                           prefilter=prefilter, deduplicator=deduplicator):
+                on_result(index, result)
+    finally:
+        for writer in writers.values():
+            writer.close()
+        if store is not None:
+            store.commit()
+        metrics.add("dbnl_bear_documents_in_progress", -1)
+        metrics.record_document(name, handled, time.perf_counter() - started)
+    metrics.inc("dbnl_bear_documents_total", outcome="incomplete" if failed else "done")
+    if manifests is not None and not failed:
+        for manifest in manifests.values():
+            manifest.finish_file(name)
+    for phenomenon, writer in writers.items():
+        if writer.count == 0:
+            if len(writers) == 1:
+                print(f"No relevant passages found in file {name}")
+            else:
+                print(f"No relevant passages about {phenomenon} found in file {name}")
+
+async def _run(paths, phenomena, output_dirs: dict, max_tasks: int, cache=None, scheduler_options=None,
+               batch_size: int = 1, manifests=None, prefilter=None, deduplicator=None, session_options=None,
+               store=None, run_id=None, task_sampler=None):
+    if task_sampler is not None:
+        task_sampler.start()
     semaphore = asyncio.Semaphore(max_tasks)
+    scheduler = RequestScheduler(**(scheduler_options or {}))
+    # One session (client, connection pool, models and chains) for all documents.
+    session = ai_read.AnalysisSession(phenomena, max_connections=scheduler.max_in_flight, **(session_options or {}))
 
     async def sem_task(p):
         async with semaphore:
-            await _process_file(p, phenomenon, output_dir)
+            await _process_file(p, session, output_dirs, cache=cache, scheduler=scheduler,
+                                batch_size=batch_size, manifests=manifests, prefilter=prefilter,
+                                deduplicator=deduplicator, store=store, run_id=run_id)
 
-    await asyncio.gather(*(sem_task(p) for p in paths))
+    async with session:
+        await asyncio.gather(*(sem_task(p) for p in paths))
+    if task_sampler is not None:
+        task_sampler.stop()
+    stats = scheduler.stats()
+    print(f"Requests sent: {stats['requests']}, retried: {stats['retries']}, failed: {stats['failures']}")
+    if scheduler.budget is not None:
+        print(f"Spent ${scheduler.budget.spent:.4f} of the ${scheduler.budget.max_cost_usd:.4f} budget")
+    if deduplicator is not None:
+        stats = deduplicator.stats()
+        print(f"Near-duplicate chunks: {stats['duplicates']} in {stats['clusters']} clusters, "
+              f"requests saved: {stats['calls_saved']}")
 
 
-def run_processing(phenomenon_of_interest: str, input_dir: str, output_dir: str,
-                   max_document_tasks: int = 1):
-    """Analyze all text files in ``input_dir`` and save relevant passages."""
+def estimate_run_cost(paths, phenomena, model: str = ai_read.DEFAULT_MODEL, batch_size: int = 1,
+                      prefilter=None, screening_model: str = None, escalation_rate: float = 0.2,
+                      completion_tokens: int = 150, text_splitter=ai_read.text_splitter) -> dict:
+    """
+    Pre-flight estimate of the tokens and cost of analyzing ``paths``, from the chunks of
+    every document, before anything is sent. Chunks rejected by ``prefilter`` are not
+    counted; cached judgements are (so a re-run costs less than estimated). In a cascade,
+    ``escalation_rate`` is the expected fraction of chunks that goes to ``model``.
+    """
+    if len(phenomena) == 1:
+        system_prompt = ai_read.get_system_prompt(phenomena[0])
+        LLMAnalysisModel = ai_read.create_llm_analysis_model(phenomena[0])
+    else:
+        system_prompt = ai_read.get_multi_system_prompt(phenomena)
+        LLMAnalysisModel = ai_read.create_multi_analysis_model(phenomena)
+    if batch_size > 1:
+        system_prompt += ai_read.BATCH_INSTRUCTIONS
+    overhead = TokenCostTracker.count_tokens(json.dumps(LLMAnalysisModel.model_json_schema())) + 25
+
+    chunks = requests = chunk_tokens = 0
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            sentences = [chunk for chunk, _, _ in ai_read.split_with_offsets(f.read(), text_splitter)]
+        if prefilter is not None:
+            kept, audited = prefilter.select(sentences)
+            sentences = [sentences[i] for i in sorted(kept | audited)]
+        chunks += len(sentences)
+        requests += -(-len(sentences) // batch_size)
+        chunk_tokens += sum(TokenCostTracker.count_tokens(sentence) for sentence in sentences)
+
+    prompt_tokens = chunk_tokens + requests * (TokenCostTracker.count_tokens(system_prompt) + overhead)
+    answer_tokens = chunks * completion_tokens * len(phenomena)
+    tiers = {}
+    if screening_model is not None:
+        tiers["screen"] = (screening_model, 1.0)
+        tiers["confirm"] = (model, escalation_rate)
+    else:
+        tiers["main"] = (model, 1.0)
+    report = {"files": len(paths), "chunks": chunks, "requests": 0, "prompt_tokens": 0,
+              "completion_tokens": 0, "estimated_cost_usd": 0.0, "tiers": {}}
+    for name, (tier_model, fraction) in tiers.items():
+        tracker = TokenCostTracker(tier_model)
+        tier = {
+            "model": tier_model,
+            "requests": round(requests * fraction),
+            "prompt_tokens": round(prompt_tokens * fraction),
+            "completion_tokens": round(answer_tokens * fraction),
+        }
+        tier["estimated_cost_usd"] = tracker.cost(tier["prompt_tokens"], tier["completion_tokens"])
+        for key in ("requests", "prompt_tokens", "completion_tokens", "estimated_cost_usd"):
+            report[key] += tier[key]
+        report["tiers"][name] = tier
+    return report
+
+def print_cost_estimate(report: dict) -> None:
+    print(f"Estimated for {report['chunks']} chunks in {report['files']} files: "
+          f"{report['requests']} requests, {report['prompt_tokens']} prompt tokens, "
+          f"{report['completion_tokens']} completion tokens, ${report['estimated_cost_usd']:.2f}")
+    if len(report["tiers"]) > 1:
+        for name, tier in report["tiers"].items():
+            print(f"  {name} ({tier['model']}): {tier['requests']} requests, ${tier['estimated_cost_usd']:.2f}")
+
+def run_processing(phenomenon_of_interest, input_dir: str, output_dir: str,
+                   max_document_tasks: int = 1, use_cache: bool = True,
+                   cache_path: str = DEFAULT_CACHE_PATH, clear_cache: bool = False,
+                   requests_per_minute: float = 500, tokens_per_minute: float = 200_000,
+                   max_concurrent_requests: int = 50, batch_size: int = 1,
+                   resume: bool = False, seed_terms=None, prefilter_threshold: int = 1,
+                   prefilter_top_fraction: float = None, audit_rate: float = 0.0,
+                   dedup_threshold: float = None, model: str = ai_read.DEFAULT_MODEL,
+                   screening_model: str = None, escalation_confidence: float = 0.75,
+                   escalate_relevant: bool = True, max_cost: float = None, store_path: str = None,
+                   metrics_file: str = None, metrics_interval: float = 15.0, profile: str = None,
+                   splitter: str = "recursive", chunk_tokens: int = DEFAULT_CHUNK_TOKENS):
+    """
+    Analyze all text files in ``input_dir`` and save relevant passages.
+
+    ``phenomenon_of_interest`` may also be a list of phenomena: every chunk is then judged
+    for all of them in one request, and the passages of each phenomenon are written to
+    (and its manifest kept in) a subdirectory of ``output_dir`` named after it.
+
+    Judgements are cached on disk (see ``JudgementCache``), so re-running the same
+    corpus only sends chunks that have not been judged before. Use ``use_cache=False``
+    to bypass the cache and ``clear_cache=True`` to empty it before the run.
+
+    ``max_document_tasks`` limits how many documents are open at once; the request
+    limits (``requests_per_minute``, ``tokens_per_minute``, ``max_concurrent_requests``)
+    hold for all documents together. With ``batch_size`` > 1, that many consecutive chunks
+    share a single request.
+
+    Progress is recorded in a run manifest in ``output_dir`` and passages are written
+    as soon as they are known. After a crash, ``resume=True`` continues where the run
+    stopped: finished files and chunks are not analyzed again.
+
+    With ``seed_terms``, a lexical pre-filter (see ``LexicalPrefilter``) only sends chunks
+    that mention a seed term at least ``prefilter_threshold`` times, or the best scoring
+    ``prefilter_top_fraction`` of every document. ``audit_rate`` sends that fraction of the
+    skipped chunks anyway, to measure the recall of the filter.
+
+    With ``dedup_threshold``, chunks whose estimated Jaccard similarity (over character
+    shingles) with another chunk of the corpus is at least that high share one request
+    (see ``ChunkDeduplicator``).
+
+    With a ``screening_model``, every chunk is first judged by that (cheaper) model, and only
+    chunks it judges relevant (unless ``escalate_relevant=False``) or judges with a confidence
+    below ``escalation_confidence`` are sent to ``model`` for the final judgement.
+
+    ``max_cost`` (USD) is a hard budget for the run: every request reserves its worst-case
+    cost before it is sent, and once the budget could be exceeded no new requests are
+    sent. The chunks that were not analyzed are picked up by a later run with ``resume=True``.
+
+    Every verdict (judgement, explanation, offsets, model) is kept in a ``ResultsStore`` at
+    ``store_path`` (by default ``results.sqlite`` in ``output_dir``), from which the outputs
+    can be regenerated without a new run (see ``results_store.export``).
+
+    Run metrics (see ``metrics``) are summarized in ``metrics_summary.json`` in ``output_dir``
+    at the end; with ``metrics_file`` they are also written to that Prometheus text file
+    every ``metrics_interval`` seconds. With ``profile`` (a path prefix), the run is profiled
+    with cProfile (``<profile>.pstats``) and its asyncio tasks are sampled
+    (``<profile>_tasks.json``).
+
+    ``splitter`` chooses how documents are cut into chunks (see ``ai_read.make_text_splitter``):
+    "recursive" (400 characters) or "segment" (whole sentences and verse lines, packed up to
+    ``chunk_tokens`` tokens). A resumed run must use the same splitter.
+    """
+    text_splitter = ai_read.make_text_splitter(splitter, chunk_tokens)
     paths = [os.path.join(input_dir, f) for f in os.listdir(input_dir) if f.endswith('.txt')]
     if not paths:
         raise ValueError(f"No .txt files found in {input_dir}")
-    asyncio.run(_run(paths, phenomenon_of_interest, output_dir, max_document_tasks))
-
+    prefilter = LexicalPrefilter(seed_terms, threshold=prefilter_threshold, top_fraction=prefilter_top_fraction,
+                                 audit_rate=audit_rate) if seed_terms else None
+    deduplicator = None
+    if dedup_threshold is not None:
+        if batch_size > 1:
+            raise ValueError("Near-duplicate sharing works per chunk; use it with batch_size 1.")
+        deduplicator = ChunkDeduplicator.from_corpus(paths, text_splitter, threshold=dedup_threshold)
+    phenomena = [phenomenon_of_interest] if isinstance(phenomenon_of_interest, str) else list(phenomenon_of_interest)
+    output_dirs = phenomenon_output_dirs(phenomena, output_dir)
+    budget = None
+    if max_cost is not None:
+        for tier_model in filter(None, (model, screening_model)):
+            if not TokenCostTracker(tier_model).has_pricing():
+                raise ValueError(f"No pricing known for model {tier_model}; add it to TokenCostTracker.MODEL_PRICING "
+                                 f"to use a cost budget.")
+        print_cost_estimate(estimate_run_cost(paths, phenomena, model=model, batch_size=batch_size,
+                                              prefilter=prefilter, screening_model=screening_model,
+                                              text_splitter=text_splitter))
+        print(f"Cost budget: ${max_cost:.4f}")
+        budget = CostBudget(max_cost)
+    if clear_cache:
+        stale = JudgementCache(cache_path)
+        stale.clear()
+        stale.close()
+    cache = JudgementCache(cache_path) if use_cache else None
+    manifests = {}
+    for phenomenon, directory in output_dirs.items():
+        os.makedirs(directory, exist_ok=True)
+        manifests[phenomenon] = RunManifest(directory, resume=resume)
+    store = ResultsStore(store_path or os.path.join(output_dir, STORE_NAME))
+    run_id = store.start_run(phenomena, model=model, screening_model=screening_model, input_dir=input_dir,
+                             settings={"batch_size": batch_size, "seed_terms": seed_terms,
+                                       "prefilter_threshold": prefilter_threshold,
+                                       "prefilter_top_fraction": prefilter_top_fraction, "audit_rate": audit_rate,
+                                       "dedup_threshold": dedup_threshold,
+                                       "escalation_confidence": escalation_confidence,
+                                       "escalate_relevant": escalate_relevant, "max_cost": max_cost,
+                                       "splitter": splitter, "chunk_tokens": chunk_tokens},
+                             resume=resume)
+    metrics.reset()
+    exporter = MetricsExporter(metrics_file, interval=metrics_interval).start() if metrics_file else None
+    profiler = cProfile.Profile() if profile else None
+    task_sampler = TaskSampler() if profile else None
+    try:
+        scheduler_options = {
+            "requests_per_minute": requests_per_minute,
+            "tokens_per_minute": tokens_per_minute,
+            "max_in_flight": max_concurrent_requests,
+            "budget": budget,
+        }
+        session_options = {
+            "model": model,
+            "text_splitter": text_splitter,
+            "screening_model": screening_model,
+            "escalation": EscalationPolicy(escalate_relevant=escalate_relevant, min_confidence=escalation_confidence),
+            # With a budget, the answer length must be capped to know the worst-case cost of a request.
+            "max_completion_tokens": COMPLETION_TOKEN_CAP * batch_size * len(phenomena) if budget is not None else None,
+        }
+        run = _run(paths, phenomena, output_dirs, max_document_tasks, cache=cache,
+                   scheduler_options=scheduler_options, batch_size=batch_size, manifests=manifests,
+                   prefilter=prefilter, deduplicator=deduplicator, session_options=session_options,
+                   store=store, run_id=run_id, task_sampler=task_sampler)
+        if profiler is not None:
+            profiler.runcall(asyncio.run, run)
+        else:
+            asyncio.run(run)
+    finally:
+        if exporter is not None:
+            exporter.stop()
+        metrics.write_summary(os.path.join(output_dir, METRICS_SUMMARY_NAME))
+        if profiler is not None:
+            profiler.dump_stats(profile + ".pstats")
+            with open(profile + "_tasks.json", "w", encoding="utf-8") as f:
+                json.dump(task_sampler.report(), f, indent=2)
+            print(f"Profile written to {profile}.pstats and {profile}_tasks.json")
+        for manifest in manifests.values():
+            manifest.close()
+        store.close()
+        if cache is not None:
+            cache.close()
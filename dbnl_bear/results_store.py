@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import sqlite3
+from .parse import DBNLParser
+
+"""
+Results store: every chunk verdict of a run in one SQLite file.
+
+The ``_relevant.txt`` files only keep the relevant passages. The store keeps the verdict
+on every chunk for every phenomenon: the file and its DBNL id, the chunk's index and
+character offsets, the judgement, the explanation, the model that gave it and when, and
+the text of the relevant passages. Verdicts are indexed by file and by phenomenon, so
+explanations can be read back and phenomena compared without paying for the run again,
+and the text, Word and barcode outputs can be regenerated from it (see ``export``).
+
+A run writes ``results.sqlite`` in its output directory. Every run gets a row in
+``runs``; a resumed run keeps adding to the run it continues.
+"""
+
+STORE_NAME = "results.sqlite"
+
+VERDICT_COLUMNS = ("run", "file", "dbnl_id", "chunk", "start", "end", "phenomenon", "judgement",
+                   "explanation", "passage", "model", "created")
+_COLUMNS = ", ".join(f'"{column}"' for column in VERDICT_COLUMNS)
+
+
+class ResultsStore:
+    def __init__(self, path: str, commit_every: int = 200):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.commit_every = commit_every
+        self._uncommitted = 0
+        self._connection = sqlite3.connect(path, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS runs (
+                   id INTEGER PRIMARY KEY,
+                   started REAL NOT NULL,
+                   input_dir TEXT,
+                   phenomena TEXT NOT NULL,
+                   model TEXT,
+                   screening_model TEXT,
+                   settings TEXT
+               )"""
+        )
+        # "start" and "end" are offsets in the text file; passage is only kept for relevant chunks
+        # (the text of the others is in the input file).
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS verdicts (
+                   run INTEGER NOT NULL REFERENCES runs (id),
+                   file TEXT NOT NULL,
+                   dbnl_id TEXT,
+                   chunk INTEGER NOT NULL,
+                   "start" INTEGER,
+                   "end" INTEGER,
+                   phenomenon TEXT NOT NULL,
+                   judgement INTEGER NOT NULL,
+                   explanation TEXT,
+                   passage TEXT,
+                   model TEXT,
+                   created REAL NOT NULL,
+                   PRIMARY KEY (run, file, phenomenon, chunk)
+               )"""
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS idx_file ON verdicts (file, phenomenon)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS idx_phenomenon ON verdicts (phenomenon, judgement)")
+        self._connection.commit()
+
+    def start_run(self, phenomena, model: str = None, screening_model: str = None, input_dir: str = None,
+                  settings: dict = None, resume: bool = False) -> int:
+        """
+        Register a run and return its id. With ``resume``, the latest run for the same
+        phenomena is continued instead (a new one is started if there is none).
+        """
+        phenomena = json.dumps(list(phenomena), ensure_ascii=False)
+        if resume:
+            row = self._connection.execute(
+                "SELECT id FROM runs WHERE phenomena = ? ORDER BY id DESC LIMIT 1", (phenomena,)
+            ).fetchone()
+            if row is not None:
+                return row[0]
+        cursor = self._connection.execute(
+            "INSERT INTO runs (started, input_dir, phenomena, model, screening_model, settings) VALUES (?, ?, ?, ?, ?, ?)",
+            (time.time(), input_dir, phenomena, model, screening_model,
+             json.dumps(settings or {}, ensure_ascii=False)),
+        )
+        self._connection.commit()
+        return cursor.lastrowid
+
+    def record(self, run: int, path: str, index: int, phenomenon: str, judgement: bool, explanation: str = None,
+               start: int = None, end: int = None, passage: str = None, model: str = None) -> None:
+        """Store the verdict on chunk ``index`` of the document at ``path`` (replacing an earlier one)."""
+        name = os.path.basename(path)
+        self._connection.execute(
+            f"INSERT OR REPLACE INTO verdicts ({_COLUMNS}) "
+            f"VALUES ({', '.join('?' * len(VERDICT_COLUMNS))})",
+            (run, name, DBNLParser.extract_dbnl_id(name), index, start, end, phenomenon, int(judgement),
+             explanation, passage if judgement else None, model, time.time()),
+        )
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self) -> None:
+        self._connection.commit()
+        self._uncommitted = 0
+
+    def runs(self) -> list:
+        rows = self._connection.execute(
+            "SELECT id, started, input_dir, phenomena, model, screening_model, settings FROM runs ORDER BY id"
+        ).fetchall()
+        return [{"id": id, "started": started, "input_dir": input_dir, "phenomena": json.loads(phenomena),
+                 "model": model, "screening_model": screening_model, "settings": json.loads(settings or "{}")}
+                for id, started, input_dir, phenomena, model, screening_model, settings in rows]
+
+    def latest_run(self, phenomenon: str = None):
+        """Id of the most recent run (that judged ``phenomenon``), or None."""
+        for run in reversed(self.runs()):
+            if phenomenon is None or phenomenon in run["phenomena"]:
+                return run["id"]
+        return None
+
+    def verdicts(self, run: int = None, file: str = None, phenomenon: str = None, relevant: bool = None) -> list:
+        """
+        Verdicts as dicts (see VERDICT_COLUMNS) in document order, filtered on any of the
+        arguments. Without ``run`` the latest run (that judged ``phenomenon``) is used.
+        """
+        if run is None:
+            run = self.latest_run(phenomenon)
+        conditions = {"run": run, "file": file, "phenomenon": phenomenon,
+                      "judgement": None if relevant is None else int(relevant)}
+        conditions = {column: value for column, value in conditions.items() if value is not None}
+        where = " AND ".join(f"{column} = ?" for column in conditions) or "1"
+        rows = self._connection.execute(
+            f"SELECT {_COLUMNS} FROM verdicts WHERE {where} "
+            f"ORDER BY file, phenomenon, chunk",
+            tuple(conditions.values()),
+        ).fetchall()
+        verdicts = [dict(zip(VERDICT_COLUMNS, row)) for row in rows]
+        for verdict in verdicts:
+            verdict["judgement"] = bool(verdict["judgement"])
+        return verdicts
+
+    def relevant_passages(self, phenomenon: str, run: int = None) -> dict:
+        """File name -> list of (passage, start, end) of its relevant chunks, in document order."""
+        passages = {}
+        for verdict in self.verdicts(run=run, phenomenon=phenomenon, relevant=True):
+            passages.setdefault(verdict["file"], []).append((verdict["passage"], verdict["start"], verdict["end"]))
+        return passages
+
+    def summary(self, run: int = None) -> list:
+        """Per file and phenomenon: the number of chunks judged and the number judged relevant."""
+        if run is None:
+            run = self.latest_run()
+        rows = self._connection.execute(
+            """SELECT file, dbnl_id, phenomenon, COUNT(*), SUM(judgement) FROM verdicts WHERE run = ?
+               GROUP BY file, phenomenon ORDER BY file, phenomenon""",
+            (run,),
+        ).fetchall()
+        return [{"file": file, "dbnl_id": dbnl_id, "phenomenon": phenomenon, "chunks": chunks, "relevant": relevant}
+                for file, dbnl_id, phenomenon, chunks, relevant in rows]
+
+    def close(self) -> None:
+        self.commit()
+        self._connection.close()
+
+
+def export(store: ResultsStore, phenomenon: str, output_dir: str, run: int = None, input_dir: str = None,
+           word: bool = False, barcode_file: str = None, n_bins: int = 1000) -> list:
+    """
+    Regenerate the outputs of a run from ``store`` without asking a model again: the
+    ``_relevant.txt`` and ``_relevant_spans.jsonl`` files in ``output_dir``, and with
+    ``input_dir`` (which must hold the original text files) optionally a Word document per
+    file with the relevant passages highlighted (``word``) and a barcode image of the
+    corpus (``barcode_file``). Returns the names of the files with relevant passages.
+    """
+    from .processing import write_relevant_passages
+    from . import overview
+
+    if (word or barcode_file) and input_dir is None:
+        raise ValueError("The Word and barcode outputs need the input_dir with the original texts.")
+    os.makedirs(output_dir, exist_ok=True)
+    passages = store.relevant_passages(phenomenon, run=run)
+    for name, found in passages.items():
+        write_relevant_passages(name, output_dir, [passage for passage, _, _ in found],
+                                spans=[(start, end) for _, start, end in found])
+        if word:
+            overview.highlight_relevant_passages(os.path.join(input_dir, name),
+                                                 os.path.join(output_dir, name + "_highlighted.docx"),
+                                                 spans=[(start, end) for _, start, end in found])
+    if barcode_file is not None:
+        spans = {name: [(start, end) for _, start, end in found] for name, found in passages.items()}
+        overview.render_corpus_barcode(input_dir, None, barcode_file, n_bins=n_bins, spans=spans)
+    return sorted(passages)
@@ -0,0 +1,175 @@
+import time
+import random
+import asyncio
+from .token_cost import BudgetExceeded
+from .metrics import registry as metrics, error_reason
+
+"""
+A process-wide request scheduler. All chunk requests of a run go through a single
+RequestScheduler, which keeps requests-per-minute and tokens-per-minute below the
+account limits (token buckets), caps the number of requests in flight and retries
+rate-limit (429) and server (5xx) errors with jittered exponential backoff.
+"""
+
+
+class TokenBucket:
+    """
+    Token bucket that refills continuously at ``rate_per_minute``. ``clock`` and ``sleep``
+    can be replaced by a fake clock in tests.
+    """
+
+    def __init__(self, rate_per_minute: float, clock=time.monotonic, sleep=asyncio.sleep):
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.rate = rate_per_minute / 60.0
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1) -> None:
+        # Requests larger than the bucket would never fit, so they wait for a full bucket.
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await self.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+
+def is_retryable(error: Exception) -> bool:
+    """Rate limits, server errors, timeouts and dropped connections are worth retrying."""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(error, (asyncio.TimeoutError, ConnectionError)) or \
+        type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+
+
+def retry_after(error: Exception):
+    """Seconds the server asked us to wait, if it said so."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestScheduler:
+    """
+    Shared scheduler that every request of a run is submitted to. ``clock`` and ``sleep``
+    (for rate-limit waits and retry backoff) can be replaced by a fake clock in tests.
+    """
+
+    def __init__(self, requests_per_minute: float = 500, tokens_per_minute: float = 200_000,
+                 max_in_flight: int = 50, max_retries: int = 6, base_delay: float = 1.0,
+                 max_delay: float = 60.0, budget=None, clock=time.monotonic, sleep=asyncio.sleep):
+        self.request_bucket = TokenBucket(requests_per_minute, clock=clock, sleep=sleep)
+        self.token_bucket = TokenBucket(tokens_per_minute, clock=clock, sleep=sleep)
+        self.sleep = sleep
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._waiting = 0
+        self._in_flight = 0
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+
+    @staticmethod
+    def estimate_tokens(text: str, completion_tokens: int = 150) -> int:
+        """Rough token estimate (about four characters per token) plus room for the answer."""
+        return len(text) // 4 + completion_tokens
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of requests waiting for a slot or for rate budget."""
+        return self._waiting
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def _set_waiting(self, change: int) -> None:
+        self._waiting += change
+        metrics.set("dbnl_bear_scheduler_queue_depth", self._waiting)
+
+    def _set_in_flight(self, change: int) -> None:
+        self._in_flight += change
+        metrics.set("dbnl_bear_requests_in_flight", self._in_flight)
+
+    async def submit(self, request_factory, tokens: int = 0, cost: float = 0.0):
+        """
+        Run ``request_factory()`` (a coroutine function) within the limits, retrying
+        retryable errors. Other errors, and the last retryable one, are raised.
+
+        With a ``budget`` (a ``CostBudget``), every attempt first reserves ``cost``, the
+        worst-case cost of the request; ``BudgetExceeded`` is raised instead of sending
+        when that would exceed the budget.
+        """
+        started = time.perf_counter()
+        try:
+            return await self._submit(request_factory, tokens, cost)
+        finally:
+            # What the caller waited: queueing, rate limits, retry backoff and every attempt.
+            metrics.observe("dbnl_bear_request_end_to_end_seconds", time.perf_counter() - started)
+
+    async def _submit(self, request_factory, tokens: int, cost: float):
+        for attempt in range(self.max_retries + 1):
+            queued = time.perf_counter()
+            # Rate budget first: a request waiting for it does not hold an in-flight slot
+            # that a request with budget could use.
+            self._set_waiting(1)
+            try:
+                await self.request_bucket.acquire(1)
+                await self.token_bucket.acquire(tokens)
+                await self._semaphore.acquire()
+            finally:
+                self._set_waiting(-1)
+            try:
+                metrics.observe("dbnl_bear_stage_seconds", time.perf_counter() - queued, stage="queue")
+                reservation = await self.budget.reserve(cost) if self.budget is not None else 0.0
+                self._set_in_flight(1)
+                self.requests += 1
+                try:
+                    return await request_factory()
+                finally:
+                    self._set_in_flight(-1)
+                    if self.budget is not None:
+                        self.budget.release(reservation)
+            except BudgetExceeded:
+                raise
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    self.failures += 1
+                    metrics.inc("dbnl_bear_errors_total", stage="request", type=error_reason(e))
+                    raise
+                delay = retry_after(e)
+                if delay is None:
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                self.retries += 1
+                metrics.inc("dbnl_bear_retries_total", reason=error_reason(e))
+            finally:
+                self._semaphore.release()
+            await self.sleep(delay)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "failures": self.failures,
+            "queue_depth": self.queue_depth,
+            "in_flight": self.in_flight,
+            "spent": self.budget.spent if self.budget is not None else None,
+        }
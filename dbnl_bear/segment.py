@@ -0,0 +1,131 @@
+import re
+from .token_cost import TokenCostTracker
+
+"""
+Sentence and verse segmentation for Early Modern Dutch texts, with chunks packed up to a
+token budget.
+
+The DBNL text files have every verse line and paragraph on a line of its own. A text is
+cut into pieces at line breaks, at sentence ends (``.``, ``!`` or ``?``, possibly followed
+by closing quotes or brackets, before a capital) and at ``;`` and ``:`` within a line. A
+piece whose last character ends a sentence closes a sentence, unless the word before the
+full stop is a known abbreviation or an initial (``St.``, ``Joh.``, ``H.``). A verse
+sentence thus runs over as many lines as it takes.
+
+``SegmentSplitter`` packs whole sentences into chunks of at most ``max_tokens`` tokens.
+A sentence that does not fit in the budget by itself is packed by its pieces, and a piece
+that does not fit is packed by its words. All rules are precompiled regular expressions,
+applied in one pass over the text, and every chunk is returned with its offsets in the
+text instead of being searched for afterwards.
+"""
+
+DEFAULT_CHUNK_TOKENS = 256
+
+# Whitespace with a line break, a sentence end inside a line, or a clause end inside a line.
+_GAP = re.compile(r"""
+    [^\S\n]*\n\s*
+  | (?<=[.!?…"'”’»)\]])[^\S\n]+(?=["'“‘«(\[]*[A-ZÀ-ÖØ-ÞĲ0-9])
+  | (?<=[;:])[^\S\n]+
+""", re.VERBOSE)
+_CLOSERS = "\"'”’»)]"
+_SENTENCE_END = frozenset(".!?…")
+# Abbreviations common in Early Modern Dutch prints, and initials.
+_ABBREVIATION = re.compile(
+    r"(?:^|[\s(\[])(?:[A-Z]|St|Sr|Sint|Mr|Dr|Jr|Hr|Ed|Joh|Matth|Marc|Luc|Hebr|Rom|Cor|Gal|Eph|Gen|Exod|Lev|"
+    r"Num|Deut|Ps|Prov|Pred|Apoc|Openb|cap|kap|vers|fol|bl|pag|blz|art|no|nr|ibid|vgl|N\.B)\.$"
+)
+_WORD = re.compile(r"\S+")
+_NON_SPACE = re.compile(r"\S")
+
+
+class SegmentSplitter:
+    """
+    Splits texts into chunks of whole sentences (see the module docstring) of at most
+    ``max_tokens`` tokens, counted with ``count_tokens``. Usable wherever a langchain text
+    splitter is: ``split_text`` returns the chunks, ``split_with_offsets`` the chunks with
+    their offsets.
+    """
+
+    def __init__(self, max_tokens: int = DEFAULT_CHUNK_TOKENS, count_tokens=TokenCostTracker.count_tokens):
+        if max_tokens < 1:
+            raise ValueError(f"max_tokens must be at least 1, got {max_tokens}")
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens
+
+    def _ends_sentence(self, text: str, gap) -> bool:
+        end = gap.start()
+        while end > 0 and text[end - 1] in _CLOSERS:
+            end -= 1
+        if end == 0 or text[end - 1] not in _SENTENCE_END:
+            return False
+        return text[end - 1] != "." or not _ABBREVIATION.search(text, max(0, end - 8), end)
+
+    def pieces(self, text: str):
+        """(start, end, ends_sentence) of every line or clause of ``text``, in order."""
+        position = len(text) - len(text.lstrip())
+        for gap in _GAP.finditer(text, position):
+            if gap.start() > position:
+                yield position, gap.start(), self._ends_sentence(text, gap)
+            position = gap.end()
+        end = len(text.rstrip())
+        if end > position:
+            yield position, end, True
+
+    def sentences(self, text: str):
+        """Lists of the pieces of every sentence of ``text``."""
+        sentence = []
+        for piece in self.pieces(text):
+            sentence.append(piece)
+            if piece[2]:
+                yield sentence
+                sentence = []
+        if sentence:
+            yield sentence
+
+    def _units(self, text: str, sentence: list):
+        """(start, end, tokens) of the sentence, or of its pieces or words if it is over budget."""
+        tokens = self.count_tokens(text[sentence[0][0]:sentence[-1][1]])
+        if tokens <= self.max_tokens:
+            yield sentence[0][0], sentence[-1][1], tokens
+            return
+        for start, end, _ in sentence:
+            tokens = self.count_tokens(text[start:end])
+            if tokens <= self.max_tokens:
+                yield start, end, tokens
+            else:
+                for word in _WORD.finditer(text, start, end):
+                    yield word.start(), word.end(), self.count_tokens(word.group())
+
+    def split_with_offsets(self, text: str) -> list:
+        """(chunk, start, end) for every chunk of ``text``; ``chunk`` is ``text[start:end]``."""
+        chunks = []
+        start = end = None
+        tokens = 0
+        for sentence in self.sentences(text):
+            for unit_start, unit_end, unit_tokens in self._units(text, sentence):
+                if start is not None and tokens + unit_tokens <= self.max_tokens:
+                    end = unit_end
+                    tokens += unit_tokens
+                    continue
+                if start is not None:
+                    chunks.append((text[start:end], start, end))
+                start, end, tokens = unit_start, unit_end, unit_tokens
+        if start is not None:
+            chunks.append((text[start:end], start, end))
+        return chunks
+
+    def split_text(self, text: str) -> list:
+        return [chunk for chunk, _, _ in self.split_with_offsets(text)]
+
+    def starts_sentence(self, text: str, position: int) -> bool:
+        """
+        Whether a sentence starts at ``position`` of ``text``. Splitting the text from there
+        gives the same chunks as splitting the whole text, which is what streaming a file in
+        blocks relies on.
+        """
+        if _NON_SPACE.search(text, 0, position) is None:
+            return True
+        for gap in _GAP.finditer(text, max(0, position - 64), min(len(text), position + 8)):
+            if gap.end() == position:
+                return self._ends_sentence(text, gap)
+        return False
@@ -1,5 +1,136 @@
+import time
+import asyncio
+import threading
+from langchain_core.callbacks import BaseCallbackHandler
+from .metrics import registry as metrics, error_reason
+
+"""
+Token usage, cost and budget bookkeeping.
+
+Usage is taken from the usage metadata that the API returns with every response (see
+``UsageCallbackHandler``), not estimated from the text. Before a run, ``count_tokens``
+gives a rough estimate for planning (see ``processing.estimate_run_cost``).
+"""
+
+
+class BudgetExceeded(Exception):
+    """Raised instead of sending a request that could take the run over its cost budget."""
+
+
+class CostBudget:
+    """
+    Hard cost limit for a whole run. Every request reserves its worst-case cost before it
+    is sent (``reserve``) and releases the reservation when it is done (``release``); the
+    actual cost is added with ``spend`` when the response arrives. A request is only sent
+    if the money already spent plus all open reservations stays within ``max_cost_usd``,
+    so the run can't overspend even with many requests in flight. A request that only
+    fits once open reservations are released waits for that; once a request could go
+    over the budget on its own (spent + its cost), it and all later ones are refused.
+    ``reserve``, ``release`` and ``spend`` are called from the run's event loop.
+    """
+
+    def __init__(self, max_cost_usd: float):
+        self.max_cost_usd = max_cost_usd
+        self.spent = 0.0
+        self.reserved = 0.0
+        self.exhausted = False
+        self._lock = threading.Lock()
+        self._changed = None
+
+    def _refuse(self) -> None:
+        if not self.exhausted:
+            self.exhausted = True
+            print(f"Cost budget of ${self.max_cost_usd:.4f} reached (${self.spent:.4f} spent); "
+                  f"no new requests are sent. Use --resume to continue later.")
+        raise BudgetExceeded(f"Cost budget of ${self.max_cost_usd:.4f} reached")
+
+    async def reserve(self, cost: float) -> float:
+        while True:
+            with self._lock:
+                if self.exhausted or self.spent + cost > self.max_cost_usd:
+                    self._refuse()
+                if self.spent + self.reserved + cost <= self.max_cost_usd:
+                    self.reserved += cost
+                    return cost
+                # Only the open reservations are in the way: wait until one is settled.
+                if self._changed is None:
+                    self._changed = asyncio.Event()
+                changed = self._changed
+            await changed.wait()
+
+    def _notify(self) -> None:
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    def release(self, reservation: float) -> None:
+        with self._lock:
+            self.reserved -= reservation
+            self._notify()
+
+    def spend(self, cost: float) -> None:
+        with self._lock:
+            self.spent += cost
+            self._notify()
+
+
+class UsageCallbackHandler(BaseCallbackHandler):
+    """
+    Records the token counts the API reports for every response in a ``TokenCostTracker``
+    (and, if given, the cost in a ``CostBudget``), and the latency of every request in the
+    run metrics.
+    """
+
+    # Run in the event loop instead of a worker thread, so usage is recorded before the call returns.
+    run_inline = True
+
+    def __init__(self, tracker, budget: CostBudget = None):
+        self.tracker = tracker
+        self.budget = budget
+        self._started = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs) -> None:
+        self._started[run_id] = time.perf_counter()
+        metrics.inc("dbnl_bear_requests_total", model=self.tracker.model)
+
+    def on_llm_error(self, error, *, run_id, **kwargs) -> None:
+        self._started.pop(run_id, None)
+        metrics.inc("dbnl_bear_errors_total", stage="model", type=error_reason(error))
+
+    def on_llm_end(self, response, *, run_id=None, **kwargs) -> None:
+        started = self._started.pop(run_id, None)
+        if started is not None:
+            metrics.observe("dbnl_bear_request_latency_seconds", time.perf_counter() - started,
+                            model=self.tracker.model)
+        prompt_tokens, completion_tokens = response_usage(response)
+        self.tracker.update_usage(prompt_tokens, completion_tokens)
+        if self.budget is not None:
+            self.budget.spend(self.tracker.cost(prompt_tokens, completion_tokens))
+
+
+def response_usage(response) -> tuple:
+    """(prompt_tokens, completion_tokens) of an ``LLMResult``, from the message usage metadata or the llm_output."""
+    prompt_tokens = completion_tokens = 0
+    found = False
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                prompt_tokens += usage.get("input_tokens", 0)
+                completion_tokens += usage.get("output_tokens", 0)
+                found = True
+    if not found and response.llm_output:
+        usage = response.llm_output.get("token_usage") or {}
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+    return prompt_tokens, completion_tokens
+
+
 class TokenCostTracker:
-    """Track token usage and estimated cost for OpenAI models."""
+    """
+    Track token usage and estimated cost for OpenAI models. All updates take a lock, so
+    one tracker can be shared by concurrent requests and callback threads.
+    """
 
     # Estimated costs per 1K tokens for known models
     MODEL_PRICING = {
@@ -7,35 +138,97 @@ class TokenCostTracker:
         "gpt-4-turbo-mini": {"prompt": 0.01, "completion": 0.03},
         "gpt-4-turbo-mini-2024-07-18": {"prompt": 0.01, "completion": 0.03},
         "gpt-3.5-turbo": {"prompt": 0.0005, "completion": 0.0015},
+        "gpt-4o": {"prompt": 0.0025, "completion": 0.01},
+        "gpt-4o-mini": {"prompt": 0.00015, "completion": 0.0006},
     }
 
     def __init__(self, model: str):
         self.model = model
         self.prompt_tokens = 0
         self.completion_tokens = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.chunks_skipped = 0
+        self.chunks_audited = 0
+        self.audited_relevant = 0
+        self.calls = 0
+        self.escalated = 0
+        self.tiers = {}
+        self._lock = threading.Lock()
         pricing = self.MODEL_PRICING.get(model, {"prompt": 0.0, "completion": 0.0})
         self.prompt_cost = pricing["prompt"]
         self.completion_cost = pricing["completion"]
 
-    def count_tokens(self, text: str) -> int:
-        """Rudimentary token counting by whitespace separation."""
-        return len(text.split())
+    @staticmethod
+    def count_tokens(text: str) -> int:
+        """Rough token estimate for planning (about four characters per token)."""
+        return max(1, len(text) // 4) if text else 0
+
+    def cost(self, prompt_tokens: int, completion_tokens: int) -> float:
+        """Cost in USD of that many tokens with this tracker's model."""
+        return (prompt_tokens / 1000) * self.prompt_cost + (completion_tokens / 1000) * self.completion_cost
+
+    def has_pricing(self) -> bool:
+        return self.model in self.MODEL_PRICING
 
     def update_usage(self, prompt_tokens: int, completion_tokens: int) -> None:
-        self.prompt_tokens += prompt_tokens
-        self.completion_tokens += completion_tokens
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def record_cache(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+
+    def record_call(self) -> None:
+        with self._lock:
+            self.calls += 1
+
+    def record_escalations(self, count: int) -> None:
+        with self._lock:
+            self.escalated += count
+
+    def record_audited_relevant(self) -> None:
+        with self._lock:
+            self.audited_relevant += 1
+
+    def tier(self, name: str, model: str) -> "TokenCostTracker":
+        """
+        Tracker for one tier of a model cascade. Its usage counts towards the totals of
+        this tracker and is also reported separately under ``tiers``.
+        """
+        with self._lock:
+            if name not in self.tiers:
+                self.tiers[name] = TokenCostTracker(model)
+            return self.tiers[name]
+
+    def record_prefilter(self, skipped: int, audited: int) -> None:
+        with self._lock:
+            self.chunks_skipped += skipped
+            self.chunks_audited += audited
 
     def get_usage_report(self) -> dict:
-        total_tokens = self.prompt_tokens + self.completion_tokens
-        estimated_cost = (
-            (self.prompt_tokens / 1000) * self.prompt_cost +
-            (self.completion_tokens / 1000) * self.completion_cost
-        )
+        tiers = {name: tier.get_usage_report() for name, tier in self.tiers.items()}
+        prompt_tokens = self.prompt_tokens + sum(tier["prompt_tokens"] for tier in tiers.values())
+        completion_tokens = self.completion_tokens + sum(tier["completion_tokens"] for tier in tiers.values())
+        estimated_cost = self.cost(self.prompt_tokens, self.completion_tokens) + \
+            sum(tier["estimated_cost_usd"] for tier in tiers.values())
         return {
             "model": self.model,
-            "prompt_tokens": self.prompt_tokens,
-            "completion_tokens": self.completion_tokens,
-            "total_tokens": total_tokens,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
             "estimated_cost_usd": estimated_cost,
+            "calls": self.calls + sum(tier["calls"] for tier in tiers.values()),
+            "cache_hits": self.cache_hits + sum(tier["cache_hits"] for tier in tiers.values()),
+            "cache_misses": self.cache_misses + sum(tier["cache_misses"] for tier in tiers.values()),
+            "chunks_skipped": self.chunks_skipped,
+            "chunks_audited": self.chunks_audited,
+            "audited_relevant": self.audited_relevant,
+            "escalated": self.escalated,
+            "tiers": tiers,
         }
 
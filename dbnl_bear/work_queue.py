@@ -0,0 +1,423 @@
+import os
+import json
+import time
+import socket
+import bisect
+import sqlite3
+import asyncio
+import threading
+from . import ai_read
+from .cache import JudgementCache, DEFAULT_CACHE_PATH
+from .scheduler import RequestScheduler
+from .prefilter import LexicalPrefilter
+from .cascade import EscalationPolicy
+from .results_store import ResultsStore, STORE_NAME
+from .processing import phenomenon_output_dirs, write_relevant_passages
+from .segment import DEFAULT_CHUNK_TOKENS
+
+"""
+Work-queue execution of corpus runs, for spreading a run over processes and hosts.
+
+A coordinator (``enqueue_corpus``) cuts every document of the corpus into ranges of chunks
+and puts them in a SQLite queue, together with the settings of the run. Any number of
+workers (``run_worker``, ``python -m dbnl_bear worker <queue>``) claim items from it. A
+claimed item is leased for ``lease_seconds``; the worker renews the lease while it works
+(heartbeat), and when a worker dies its lease runs out and another worker claims the item
+again. Items that fail, or whose lease runs out, are tried up to ``max_attempts`` times;
+after that they are failed until ``requeue_failed`` puts them back. Every item holds the
+point in its document where streaming the chunks can start (see
+``ai_read.iter_chunk_windows``), so a worker does not split the text before its chunks.
+
+Every finished item is written as a part file (one JSON line per chunk) under
+``<output_dir>/parts``, by writing a temporary file and renaming it, so a part file is
+either complete or absent and a retried item simply replaces it. ``merge_results`` turns
+the parts of every finished document into the usual ``_relevant.txt`` and spans files and
+the results store; running it again gives the same output.
+
+The queue file, the texts and the output directory must be on a filesystem all workers
+can reach, with working file locks (SQLite serializes the claims with them).
+"""
+
+QUEUE_NAME = "work_queue.sqlite"
+PARTS_DIR = "parts"
+
+
+class LeaseLost(Exception):
+    """The lease on a work item ran out and the item may now be someone else's."""
+
+
+class WorkQueue:
+    """SQLite queue of (file, chunk range) items with leases."""
+
+    def __init__(self, path: str, max_attempts: int = 3):
+        self.path = path
+        self.max_attempts = max_attempts
+        # Autocommit; claims take the write lock explicitly with BEGIN IMMEDIATE. Heartbeats
+        # run in a thread, so the connection is shared between threads under a lock.
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS items (
+                   id INTEGER PRIMARY KEY,
+                   file TEXT NOT NULL,
+                   first_chunk INTEGER NOT NULL,
+                   last_chunk INTEGER NOT NULL,
+                   resume TEXT,
+                   state TEXT NOT NULL DEFAULT 'pending',
+                   worker TEXT,
+                   lease_expires REAL,
+                   attempts INTEGER NOT NULL DEFAULT 0,
+                   error TEXT,
+                   updated REAL
+               )"""
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS idx_state ON items (state, lease_expires)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS merged (file TEXT PRIMARY KEY, merged REAL NOT NULL)")
+
+    @property
+    def config(self) -> dict:
+        return {key: json.loads(value) for key, value in self._connection.execute("SELECT key, value FROM config")}
+
+    def configure(self, settings: dict) -> None:
+        self._connection.executemany("INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)",
+                                     [(key, json.dumps(value, ensure_ascii=False)) for key, value in settings.items()])
+
+    def add(self, file: str, first_chunk: int, last_chunk: int, resume=None) -> None:
+        """Add an item; ``resume`` is a point at or before its first chunk to stream the file from."""
+        self._connection.execute(
+            "INSERT INTO items (file, first_chunk, last_chunk, resume, updated) VALUES (?, ?, ?, ?, ?)",
+            (file, first_chunk, last_chunk, json.dumps(resume) if resume else None, time.time()))
+
+    def claim(self, worker: str, lease_seconds: float):
+        """
+        Lease the next item that is pending, or whose lease has run out, to ``worker``.
+        Returns (id, file, first_chunk, last_chunk, resume), or None when there is nothing to claim.
+        An expired lease counts as a failed attempt: after ``max_attempts`` the item is
+        marked failed instead of leased again (its worker keeps dying on it).
+        """
+        now = time.time()
+        with self._lock:
+            row = self._claim(worker, lease_seconds, now)
+        return row if row is None else (*row[:4], json.loads(row[4]) if row[4] else None)
+
+    def _claim(self, worker: str, lease_seconds: float, now: float):
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            self._connection.execute(
+                """UPDATE items SET state = 'failed', worker = NULL, lease_expires = NULL,
+                   error = 'Lease expired on attempt ' || attempts, updated = ?
+                   WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?""",
+                (now, now, self.max_attempts),
+            )
+            row = self._connection.execute(
+                """SELECT id, file, first_chunk, last_chunk, resume FROM items
+                   WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?)
+                   ORDER BY id LIMIT 1""",
+                (now,),
+            ).fetchone()
+            if row is not None:
+                self._connection.execute(
+                    """UPDATE items SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1,
+                       updated = ? WHERE id = ?""",
+                    (worker, now + lease_seconds, now, row[0]),
+                )
+            self._connection.execute("COMMIT")
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        return row
+
+    def heartbeat(self, item_id: int, worker: str, lease_seconds: float) -> bool:
+        """Extend the lease of ``worker`` on item ``item_id``; False if the lease is no longer ours."""
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.execute(
+                """UPDATE items SET lease_expires = ?, updated = ?
+                   WHERE id = ? AND worker = ? AND state = 'leased'""",
+                (now + lease_seconds, now, item_id, worker),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, item_id: int, worker: str) -> bool:
+        with self._lock:
+            cursor = self._connection.execute(
+                "UPDATE items SET state = 'done', error = NULL, updated = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+                (time.time(), item_id, worker),
+            )
+            return cursor.rowcount == 1
+
+    def fail(self, item_id: int, worker: str, error: str) -> None:
+        """Give the item back for another attempt, or mark it failed after ``max_attempts``."""
+        with self._lock:
+            self._connection.execute(
+                """UPDATE items SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                   worker = NULL, lease_expires = NULL, error = ?, updated = ?
+                   WHERE id = ? AND worker = ? AND state = 'leased'""",
+                (self.max_attempts, error, time.time(), item_id, worker),
+            )
+
+    def requeue_failed(self) -> int:
+        """Make the failed items pending again, with a fresh set of attempts. Returns their number."""
+        with self._lock:
+            cursor = self._connection.execute(
+                """UPDATE items SET state = 'pending', attempts = 0, error = NULL, updated = ?
+                   WHERE state = 'failed'""",
+                (time.time(),),
+            )
+            return cursor.rowcount
+
+    def progress(self) -> dict:
+        """Number of items per state (pending, leased, done, failed)."""
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        counts.update(self._connection.execute("SELECT state, COUNT(*) FROM items GROUP BY state").fetchall())
+        return counts
+
+    def unfinished(self) -> int:
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM items WHERE state IN ('pending', 'leased')"
+            ).fetchone()[0]
+
+    def files(self) -> dict:
+        """File -> list of its items as (first_chunk, last_chunk, state), in chunk order."""
+        files = {}
+        for file, first, last, state in self._connection.execute(
+                "SELECT file, first_chunk, last_chunk, state FROM items ORDER BY file, first_chunk"):
+            files.setdefault(file, []).append((first, last, state))
+        return files
+
+    def is_merged(self, file: str) -> bool:
+        return self._connection.execute("SELECT 1 FROM merged WHERE file = ?", (file,)).fetchone() is not None
+
+    def mark_merged(self, file: str) -> None:
+        self._connection.execute("INSERT OR REPLACE INTO merged (file, merged) VALUES (?, ?)", (file, time.time()))
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+def enqueue_corpus(queue_path: str, phenomenon_of_interest, input_dir: str, output_dir: str,
+                   chunks_per_item: int = 500, model: str = ai_read.DEFAULT_MODEL, screening_model: str = None,
+                   escalation_confidence: float = 0.75, escalate_relevant: bool = True, batch_size: int = 1,
+                   seed_terms=None, prefilter_threshold: int = 1, audit_rate: float = 0.0,
+                   max_attempts: int = 3, splitter: str = "recursive", chunk_tokens: int = DEFAULT_CHUNK_TOKENS) -> int:
+    """
+    Create the queue at ``queue_path`` for analyzing every text file in ``input_dir``: one
+    item per ``chunks_per_item`` chunks of a document. The other arguments are those of
+    ``run_processing``. Returns the number of items.
+    """
+    paths = sorted(os.path.join(input_dir, f) for f in os.listdir(input_dir) if f.endswith('.txt'))
+    if not paths:
+        raise ValueError(f"No .txt files found in {input_dir}")
+    if os.path.exists(queue_path):
+        raise ValueError(f"There already is a queue at {queue_path}")
+    phenomena = [phenomenon_of_interest] if isinstance(phenomenon_of_interest, str) else list(phenomenon_of_interest)
+    text_splitter = ai_read.make_text_splitter(splitter, chunk_tokens)
+    os.makedirs(os.path.join(output_dir, PARTS_DIR), exist_ok=True)
+    store = ResultsStore(os.path.join(output_dir, STORE_NAME))
+    settings = {
+        "batch_size": batch_size, "seed_terms": seed_terms, "prefilter_threshold": prefilter_threshold,
+        "audit_rate": audit_rate, "escalation_confidence": escalation_confidence,
+        "escalate_relevant": escalate_relevant, "splitter": splitter, "chunk_tokens": chunk_tokens,
+    }
+    run_id = store.start_run(phenomena, model=model, screening_model=screening_model,
+                             input_dir=os.path.abspath(input_dir), settings=settings)
+    store.close()
+
+    queue = WorkQueue(queue_path, max_attempts=max_attempts)
+    try:
+        queue.configure({
+            "phenomena": phenomena, "input_dir": os.path.abspath(input_dir), "output_dir": os.path.abspath(output_dir),
+            "model": model, "screening_model": screening_model, "run_id": run_id, "max_attempts": max_attempts,
+            **settings,
+        })
+        items = 0
+        for path in paths:
+            chunks = 0
+            resume_points = [None]
+            for window, resume in ai_read.iter_chunk_windows(path, text_splitter):
+                chunks += len(window)
+                if resume is not None:
+                    resume_points.append(resume)
+            starts = [0] + [resume[0] for resume in resume_points[1:]]
+            for first in range(0, max(chunks, 1), chunks_per_item):
+                resume = resume_points[bisect.bisect_right(starts, first) - 1]
+                queue.add(os.path.basename(path), first, min(first + chunks_per_item, chunks), resume)
+                items += 1
+    finally:
+        queue.close()
+    return items
+
+
+def part_path(output_dir: str, file: str, first_chunk: int, last_chunk: int) -> str:
+    return os.path.join(output_dir, PARTS_DIR, f"{file}.{first_chunk:08d}-{last_chunk:08d}.jsonl")
+
+
+async def _analyze_item(session, config: dict, item, cache=None, scheduler=None, prefilter=None) -> list:
+    """Analyze the chunks of one item; returns a record per chunk, or raises if a chunk failed."""
+    _, file, first, last, resume = item
+    records = []
+    failed = 0
+    async for index, result in session.stream_file(os.path.join(config["input_dir"], file), cache=cache,
+                                                   scheduler=scheduler, batch_size=config["batch_size"],
+                                                   prefilter=prefilter, chunks=range(first, last), resume=resume):
+        if result is None:
+            failed += 1
+            continue
+        verdicts = session.judgements(result)
+        records.append({
+            "chunk": index, "start": result.start, "end": result.end, "model": result.judged_by,
+            # The text of irrelevant chunks is not needed for the outputs.
+            "passage": result.original_sentence if any(judgement for judgement, _ in verdicts.values()) else None,
+            "verdicts": {phenomenon: list(verdict) for phenomenon, verdict in verdicts.items()},
+        })
+    if failed:
+        raise RuntimeError(f"{failed} chunk(s) of {file} could not be analyzed")
+    return sorted(records, key=lambda record: record["chunk"])
+
+
+async def _work(queue: WorkQueue, worker: str, lease_seconds: float, poll_interval: float, exit_when_empty: bool,
+                cache=None, scheduler_options=None) -> int:
+    config = queue.config
+    prefilter = LexicalPrefilter(config["seed_terms"], threshold=config["prefilter_threshold"],
+                                 audit_rate=config["audit_rate"]) if config["seed_terms"] else None
+    scheduler = RequestScheduler(**(scheduler_options or {}))
+    session = ai_read.AnalysisSession(
+        config["phenomena"], model=config["model"], screening_model=config["screening_model"],
+        text_splitter=ai_read.make_text_splitter(config["splitter"], config["chunk_tokens"]),
+        escalation=EscalationPolicy(escalate_relevant=config["escalate_relevant"],
+                                    min_confidence=config["escalation_confidence"]),
+        max_connections=scheduler.max_in_flight,
+    )
+    done = 0
+
+    async def keep_lease(item_id):
+        while True:
+            await asyncio.sleep(lease_seconds / 3)
+            # Off the event loop: the write may wait for the database lock.
+            if not await asyncio.to_thread(queue.heartbeat, item_id, worker, lease_seconds):
+                raise LeaseLost(f"Lost the lease on item {item_id}")
+
+    async with session:
+        while True:
+            item = queue.claim(worker, lease_seconds)
+            if item is None:
+                if exit_when_empty and queue.unfinished() == 0:
+                    break
+                # Other workers hold the remaining items; wait in case their leases run out.
+                await asyncio.sleep(poll_interval)
+                continue
+            item_id, file, first, last, _ = item
+            analysis = asyncio.create_task(_analyze_item(session, config, item, cache=cache, scheduler=scheduler,
+                                                         prefilter=prefilter))
+            heartbeat = asyncio.create_task(keep_lease(item_id))
+            try:
+                await asyncio.wait((analysis, heartbeat), return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                heartbeat.cancel()
+                if not analysis.done():
+                    analysis.cancel()
+                await asyncio.gather(analysis, heartbeat, return_exceptions=True)
+            if analysis.cancelled():
+                # The item may be someone else's by now; leave it to them.
+                print(f"Gave up {file} chunks {first}-{last}: {heartbeat.exception()}")
+                continue
+            if analysis.exception() is not None:
+                print(f"Item {file} chunks {first}-{last} failed: {analysis.exception()}")
+                queue.fail(item_id, worker, str(analysis.exception()))
+                continue
+            target = part_path(config["output_dir"], file, first, last)
+            temporary = f"{target}.{worker.replace(os.sep, '_')}.tmp"
+            with open(temporary, "w", encoding="utf-8") as f:
+                for record in analysis.result():
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, target)
+            if queue.complete(item_id, worker):
+                done += 1
+    return done
+
+
+def run_worker(queue_path: str, worker: str = None, lease_seconds: float = 120.0, poll_interval: float = 5.0,
+               exit_when_empty: bool = True, use_cache: bool = True, cache_path: str = DEFAULT_CACHE_PATH,
+               requests_per_minute: float = 500, tokens_per_minute: float = 200_000,
+               max_concurrent_requests: int = 50) -> int:
+    """
+    Claim and analyze items from the queue at ``queue_path`` until none are left (or, with
+    ``exit_when_empty=False``, forever). The request limits hold for this worker only, so
+    divide the account limits over the workers. Returns the number of items this worker did.
+    """
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    queue = WorkQueue(queue_path)
+    queue.max_attempts = queue.config.get("max_attempts", queue.max_attempts)
+    cache = JudgementCache(cache_path) if use_cache else None
+    scheduler_options = {
+        "requests_per_minute": requests_per_minute,
+        "tokens_per_minute": tokens_per_minute,
+        "max_in_flight": max_concurrent_requests,
+    }
+    try:
+        done = asyncio.run(_work(queue, worker, lease_seconds, poll_interval, exit_when_empty, cache=cache,
+                                 scheduler_options=scheduler_options))
+    finally:
+        queue.close()
+        if cache is not None:
+            cache.close()
+    print(f"Worker {worker} finished {done} item(s)")
+    return done
+
+
+def requeue_failed(queue_path: str) -> int:
+    """Put the failed items of the queue at ``queue_path`` back for the workers; returns their number."""
+    queue = WorkQueue(queue_path)
+    try:
+        return queue.requeue_failed()
+    finally:
+        queue.close()
+
+
+def merge_results(queue_path: str, force: bool = False) -> dict:
+    """
+    Write the outputs of every document whose items are all done: the relevant passages
+    and spans files of every phenomenon, and all verdicts into the results store. Merged
+    documents are skipped the next time unless ``force``. Returns the queue progress with
+    the number of documents merged now, complete and still open.
+    """
+    queue = WorkQueue(queue_path)
+    config = queue.config
+    output_dirs = phenomenon_output_dirs(config["phenomena"], config["output_dir"])
+    for directory in output_dirs.values():
+        os.makedirs(directory, exist_ok=True)
+    store = ResultsStore(os.path.join(config["output_dir"], STORE_NAME))
+    merged = complete = 0
+    files = queue.files()
+    try:
+        for file, items in files.items():
+            if any(state != "done" for _, _, state in items):
+                continue
+            complete += 1
+            if not force and queue.is_merged(file):
+                continue
+            relevant = {phenomenon: [] for phenomenon in output_dirs}
+            for first, last, _ in items:
+                with open(part_path(config["output_dir"], file, first, last), "r", encoding="utf-8") as f:
+                    for record in map(json.loads, f):
+                        for phenomenon, (judgement, explanation) in record["verdicts"].items():
+                            store.record(config["run_id"], file, record["chunk"], phenomenon, judgement, explanation,
+                                         start=record["start"], end=record["end"], passage=record["passage"],
+                                         model=record["model"])
+                            if judgement:
+                                relevant[phenomenon].append((record["passage"], record["start"], record["end"]))
+            for phenomenon, passages in relevant.items():
+                write_relevant_passages(file, output_dirs[phenomenon], [passage for passage, _, _ in passages],
+                                        spans=[(start, end) for _, start, end in passages])
+            store.commit()
+            queue.mark_merged(file)
+            merged += 1
+        progress = queue.progress()
+    finally:
+        store.close()
+        queue.close()
+    return {**progress, "files_merged": merged, "files_complete": complete, "files_open": len(files) - complete}
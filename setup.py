@@ -6,7 +6,7 @@ setup(
     packages=find_packages(),
     install_requires=["lxml", "tqdm", "python-dotenv", "langchain_core", "langchain_openai", "tqdm",
                       "typing", "langchain_text_splitters", "docx", "fuzzywuzzy", "pydantic",
-                     "python-docx", "python-Levenshtein"],
+                     "python-docx", "python-Levenshtein", "numpy", "matplotlib", "httpx"],
     description='A Python package to use an AI assistant for historical analysis',
     long_description=open('README.md').read(),
     long_description_content_type='text/markdown',
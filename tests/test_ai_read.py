@@ -0,0 +1,144 @@
+import random
+import asyncio
+import pytest
+from dbnl_bear import ai_read
+from dbnl_bear.segment import SegmentSplitter
+
+WORDS = ("de", "tulp", "bloeyt", "in", "den", "hof", "ende", "wy", "sien", "haer", "schoonheyt", "soet", "Godt")
+
+
+def make_text(paragraph_break: str, line_break: str, lines: int = 1500, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    paragraphs = []
+    for _ in range(lines // 6):
+        verse = []
+        for _ in range(6):
+            words = [rng.choice(WORDS) for _ in range(rng.randint(3, 12))]
+            verse.append(" ".join(words).capitalize() + rng.choice((",", ",", ";", ".", "!")))
+        paragraphs.append(line_break.join(verse))
+    return paragraph_break.join(paragraphs)
+
+
+@pytest.mark.parametrize("paragraph_break,line_break", [
+    ("\n\n", "\n\n"),  # DBNL conversions: a blank line after every verse line
+    ("\n", "\n"),  # no blank lines at all
+    (" ", " "),  # no line breaks at all
+])
+@pytest.mark.parametrize("splitter", [ai_read.text_splitter, SegmentSplitter(64)])
+@pytest.mark.parametrize("block_size", [500, 4096])
+def test_streaming_equals_whole_text_split(tmp_path, paragraph_break, line_break, splitter, block_size):
+    text = make_text(paragraph_break, line_break)
+    path = tmp_path / "text.txt"
+    path.write_text(text, encoding="utf-8")
+    expected = ai_read.split_with_offsets(text, splitter)
+    assert list(ai_read.iter_chunks_with_offsets(str(path), splitter, block_size=block_size)) == expected
+
+
+def test_streaming_window_stays_bounded(tmp_path, monkeypatch):
+    text = make_text("\n", "\n", lines=6000)
+    path = tmp_path / "text.txt"
+    path.write_text(text, encoding="utf-8")
+    windows = []
+    split = ai_read.split_with_offsets
+    monkeypatch.setattr(ai_read, "split_with_offsets", lambda window, splitter: windows.append(len(window))
+                        or split(window, splitter))
+    chunks = list(ai_read.iter_chunks_with_offsets(str(path), block_size=4096))
+    assert chunks == split(text, ai_read.text_splitter)
+    assert max(windows) < 3 * 4096
+
+
+@pytest.mark.parametrize("splitter", [ai_read.text_splitter, SegmentSplitter(64)])
+def test_resumed_stream_gives_the_rest(tmp_path, splitter):
+    # Multi-byte characters and Windows line ends: file positions are not text offsets.
+    text = make_text("\n\n", "\n", lines=600).replace("tulp", "tülp ĳ")
+    path = tmp_path / "text.txt"
+    path.write_bytes(text.replace("\n", "\r\n").encode("utf-8"))
+    windows = list(ai_read.iter_chunk_windows(str(path), splitter, block_size=700))
+    chunks = [chunk for window, _ in windows for chunk in window]
+    assert chunks == ai_read.split_with_offsets(text, splitter)
+    assert len(windows) > 5
+    for _, resume in windows[:-1]:
+        assert list(ai_read.iter_chunks_with_offsets(str(path), splitter, block_size=700, resume=resume)) == \
+            chunks[resume[0]:]
+
+
+class DictCache:
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, value):
+        self.entries[key] = value
+
+
+class EchoModel:
+    """Stand-in for a structured LLM: judges every text relevant and names it in the explanation."""
+
+    def __init__(self, LLMAnalysisModel):
+        self.LLMAnalysisModel = LLMAnalysisModel
+        self.calls = []
+
+    async def ainvoke(self, text):
+        self.calls.append(text)
+        await asyncio.sleep(0.01)
+        return self.LLMAnalysisModel(explanation=text, judgement=True)
+
+
+def test_shared_result_is_cached_for_its_own_text_only():
+    from dbnl_bear.dedup import ChunkDeduplicator
+    LLMAnalysisModel = ai_read.create_llm_analysis_model("tulips")
+    FullAnalysisModel = ai_read.create_full_analysis_model("tulips")
+    model = EchoModel(LLMAnalysisModel)
+    cache = DictCache()
+    deduplicator = ChunkDeduplicator({("a", 0): ("a", 0), ("b", 0): ("a", 0)})
+
+    async def run():
+        return await asyncio.gather(*(
+            ai_read.analyze_sentence(text, model, FullAnalysisModel, cache=cache, cache_key=text,
+                                     deduplicator=deduplicator, dedup_key=key)
+            for key, text in [(("a", 0), "Een tulp."), (("b", 0), "Een tulpe.")]))
+
+    first, second = asyncio.run(run())
+    assert model.calls == ["Een tulp."]
+    assert first.explanation == second.explanation == "Een tulp."
+    assert list(cache.entries) == ["Een tulp."]
+
+
+class DroppingBatchModel:
+    """
+    Stand-in for a structured batch LLM that drops the last passage of every batch of more
+    than one passage (and fails on a passage saying "onleesbaar"), so batches must be halved.
+    """
+
+    def __init__(self, BatchModel):
+        self.ItemModel = BatchModel.model_fields["items"].annotation.__args__[0]
+        self.BatchModel = BatchModel
+        self.batches = []
+
+    async def ainvoke(self, passages):
+        texts = [block.split("\n", 1)[1] for block in passages.split("\n\n")]
+        self.batches.append(texts)
+        if any(text == "onleesbaar" for text in texts):
+            raise ValueError("unreadable answer")
+        items = [self.ItemModel(passage_number=n, explanation=text, judgement="tulp" in text)
+                 for n, text in enumerate(texts, start=1)]
+        return self.BatchModel(items=items[:-1] if len(items) > 1 else items)
+
+
+def test_batches_are_halved_down_to_single_passages():
+    model = DroppingBatchModel(ai_read.create_llm_batch_analysis_model("tulips"))
+    sentences = [f"Passage {n} met een tulp" if n % 2 else f"Passage {n}" for n in range(6)]
+    items = asyncio.run(ai_read._analyze_passages(sentences, model))
+    assert [item.explanation for item in items] == sentences
+    assert [item.judgement for item in items] == [n % 2 == 1 for n in range(6)]
+    assert [len(batch) for batch in model.batches] == [6, 3, 1, 2, 1, 1, 3, 1, 2, 1, 1]
+
+
+def test_a_failing_passage_only_loses_itself():
+    model = DroppingBatchModel(ai_read.create_llm_batch_analysis_model("tulips"))
+    sentences = ["een", "twee", "onleesbaar", "vier"]
+    items = asyncio.run(ai_read._analyze_passages(sentences, model))
+    assert items[2] is None
+    assert [item.explanation for item in items if item is not None] == ["een", "twee", "vier"]
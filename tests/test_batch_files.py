@@ -0,0 +1,118 @@
+import json
+import pytest
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from dbnl_bear import batch_files
+from dbnl_bear.processing import RELEVANT_SUFFIX, SPANS_SUFFIX
+
+TEXTS = {
+    "a.txt": "Een tulp in de hof.\n\nNiets hier.\n\nNog een tulp.",
+    "b|c.txt": "Niets.\n\nDe tulpen bloeyen.",
+}
+# One paragraph per chunk.
+SPLITTER = RecursiveCharacterTextSplitter(chunk_size=20, chunk_overlap=0)
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    for name, text in TEXTS.items():
+        (input_dir / name).write_text(text, encoding="utf-8")
+    return input_dir
+
+
+def read_requests(shards):
+    requests = []
+    for shard in shards:
+        with open(shard, encoding="utf-8") as f:
+            requests.extend(json.loads(line) for line in f)
+    return requests
+
+
+def result_line(custom_id, content, status_code=200):
+    body = {"choices": [{"message": {"content": json.dumps(content)}}]}
+    return json.dumps({"custom_id": custom_id, "response": {"status_code": status_code, "body": body}, "error": None})
+
+
+def answer(request, judge):
+    """A result line that judges the chunk of ``request`` with ``judge(chunk) -> judgement fields``."""
+    chunk = request["body"]["messages"][1]["content"]
+    return result_line(request["custom_id"], judge(chunk))
+
+
+@pytest.mark.parametrize("file_name, index, start, end", [
+    ("a.txt", 0, 0, 19),
+    ("b|c.txt", 12, 340, 781),
+    ("with spaces.txt", 3, 0, 0),
+])
+def test_custom_id_round_trip(file_name, index, start, end):
+    assert batch_files.parse_custom_id(batch_files.make_custom_id(file_name, index, start, end)) == (file_name, index, start, end)
+
+
+@pytest.mark.parametrize("custom_id", ["a.txt", "a.txt|1|2", "a.txt|x|0|5"])
+def test_bad_custom_id(custom_id):
+    with pytest.raises(ValueError):
+        batch_files.parse_custom_id(custom_id)
+
+
+def test_export_ingest_round_trip(corpus, tmp_path):
+    shards = batch_files.export_batch_requests(str(corpus), "tulips", str(tmp_path / "batch"), shard_size=2,
+                                                 text_splitter=SPLITTER)
+    requests = read_requests(shards)
+    assert len(shards) == (len(requests) + 1) // 2
+    for request in requests:
+        file_name, _, start, end = batch_files.parse_custom_id(request["custom_id"])
+        assert TEXTS[file_name][start:end] == request["body"]["messages"][1]["content"]
+    assert requests[0]["body"]["response_format"]["json_schema"]["strict"] is True
+
+    results = tmp_path / "results.jsonl"
+    results.write_text("\n".join(
+        answer(request, lambda chunk: {"explanation": "", "judgement": "tulp" in chunk})
+        for request in reversed(requests)) + "\n", encoding="utf-8")
+    out = tmp_path / "out"
+    assert batch_files.ingest_batch_results([str(results)], str(corpus), "tulips", str(out)) == []
+
+    for name, text in TEXTS.items():
+        spans = [json.loads(line) for line in (out / (name + SPANS_SUFFIX)).read_text(encoding="utf-8").splitlines()]
+        passages = (out / (name + RELEVANT_SUFFIX)).read_text(encoding="utf-8").splitlines()
+        assert spans == sorted(spans)
+        assert passages == [text[start:end] for start, end in spans]
+        assert all("tulp" in passage for passage in passages)
+
+
+def test_failed_and_malformed_results(tmp_path):
+    content = {"explanation": "", "judgement": True}
+    results = tmp_path / "results.jsonl"
+    results.write_text("\n".join([
+        result_line("a.txt|0|0|19", content),
+        result_line("a.txt|1|21|32", content, status_code=500),
+        json.dumps({"custom_id": "a.txt|2|34|47", "response": None, "error": {"message": "expired"}}),
+        result_line("a.txt|3|0|5", {"explanation": "no judgement"}),
+        json.dumps({"custom_id": "a.txt|4|0|5", "response": {"status_code": 200, "body": {"choices": []}}}),
+        result_line("not an id", content),
+        "{not json",
+        json.dumps({"no": "custom_id"}),
+        "",
+    ]) + "\n", encoding="utf-8")
+
+    results_by_file, failed = batch_files.read_batch_results([str(results)], "tulips")
+    assert [(index, start, end) for index, start, end, _ in results_by_file["a.txt"]] == [(0, 0, 19)]
+    assert failed == ["a.txt|1|21|32", "a.txt|2|34|47", "a.txt|3|0|5", "a.txt|4|0|5", "not an id", None, None]
+
+
+def test_several_phenomena(corpus, tmp_path):
+    phenomena = ["tulips", "nothing"]
+    requests = read_requests(batch_files.export_batch_requests(str(corpus), phenomena, str(tmp_path / "batch"),
+                                                                  text_splitter=SPLITTER))
+    schema = requests[0]["body"]["response_format"]["json_schema"]["schema"]
+    assert {"tulips_judgement", "nothing_judgement"} <= set(schema["properties"])
+
+    results = tmp_path / "results.jsonl"
+    results.write_text("\n".join(
+        answer(request, lambda chunk: {"tulips_explanation": "", "tulips_judgement": "tulp" in chunk,
+                                       "nothing_explanation": "", "nothing_judgement": "Niets" in chunk})
+        for request in requests) + "\n", encoding="utf-8")
+    out = tmp_path / "out"
+    assert batch_files.ingest_batch_results([str(results)], str(corpus), phenomena, str(out)) == []
+    assert (out / "tulips" / ("a.txt" + RELEVANT_SUFFIX)).read_text(encoding="utf-8").count("tulp") == 2
+    assert (out / "nothing" / ("b|c.txt" + RELEVANT_SUFFIX)).read_text(encoding="utf-8") == "Niets.\n"
@@ -0,0 +1,46 @@
+import sqlite3
+from dbnl_bear.cache import JudgementCache
+
+
+def read_back(path):
+    connection = sqlite3.connect(path)
+    try:
+        return dict(connection.execute("SELECT key, last_used FROM judgements"))
+    finally:
+        connection.close()
+
+
+def test_writes_are_batched(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = JudgementCache(path, commit_every=3, commit_interval=3600)
+    cache.set("a", {"judgement": True})
+    cache.set("b", {"judgement": False})
+    assert read_back(path) == {}
+    cache.set("c", {"judgement": False})
+    assert set(read_back(path)) == {"a", "b", "c"}
+    cache.close()
+
+
+def test_hits_update_last_used_on_commit(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = JudgementCache(path, commit_interval=3600)
+    cache.set("a", {"judgement": True})
+    cache.commit()
+    before = read_back(path)["a"]
+    assert cache.get("a") == {"judgement": True}
+    assert cache.get("missing") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert read_back(path)["a"] == before
+    cache.close()
+    assert read_back(path)["a"] > before
+
+
+def test_entries_survive_reopening(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = JudgementCache(path)
+    cache.set("a", {"judgement": True})
+    cache.close()
+    cache = JudgementCache(path)
+    assert cache.get("a") == {"judgement": True}
+    assert cache._connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    cache.close()
@@ -0,0 +1,56 @@
+import json
+import pytest
+from dbnl_bear import overview
+
+TEXTS = {
+    "a.txt": "Een tulp in de hof.\n\nNiets hier.\n\nNog een tulp.",
+    "b.txt": "Niets.\n\nDe tulpen bloeyen.",
+    "c.txt": "Geen bloemen in dit boeck.",
+}
+SPANS = {"a.txt": [(0, 19), (33, 47)], "b.txt": [(8, 26)]}
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    for name, text in TEXTS.items():
+        (input_dir / name).write_text(text, encoding="utf-8")
+    return input_dir
+
+
+def check_matrix(names, matrix):
+    assert names == ["a.txt", "b.txt", "c.txt"]
+    assert matrix[0].any() and matrix[1].any()
+    assert not matrix[2].any()
+    # The first span of a.txt starts at the beginning, the span of b.txt ends at the end.
+    assert matrix[0][0] == 1 and matrix[1][-1] == 1 and matrix[1][0] == 0
+
+
+def test_matrix_from_spans(corpus):
+    check_matrix(*overview.corpus_relevance_matrix(str(corpus), None, n_bins=20, spans=SPANS))
+
+
+def test_matrix_from_spans_files(corpus, tmp_path):
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    for name, spans in SPANS.items():
+        with open(output_dir / (name + "_relevant_spans.jsonl"), "w", encoding="utf-8") as f:
+            for span in spans:
+                f.write(json.dumps(list(span)) + "\n")
+    check_matrix(*overview.corpus_relevance_matrix(str(corpus), str(output_dir), n_bins=20))
+
+
+def test_matrix_from_passage_files(corpus, tmp_path):
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    for name, spans in SPANS.items():
+        passages = [TEXTS[name][start:end] for start, end in spans]
+        (output_dir / (name + "_relevant.txt")).write_text("\n".join(passages) + "\n", encoding="utf-8")
+    check_matrix(*overview.corpus_relevance_matrix(str(corpus), str(output_dir), n_bins=20))
+
+
+def test_render_corpus_barcode(corpus, tmp_path):
+    image = tmp_path / "barcode.png"
+    assert overview.render_corpus_barcode(str(corpus), None, str(image), n_bins=20, spans=SPANS) == sorted(TEXTS)
+    assert image.stat().st_size > 0
@@ -0,0 +1,115 @@
+import re
+import itertools
+import pytest
+from dbnl_bear.prefilter import LexicalPrefilter, spelling_pattern, SPELLING_VARIANTS
+
+
+@pytest.mark.parametrize("term, pattern", [
+    ("tuyn", "(?:th|t)(?:uy|ui)n"),
+    ("ackerbouw", "a(?:ck|k)erbouw"),
+    ("vrij", "vr(?:ij|y)"),
+    ("maen", "m(?:ae|aa)n"),
+    ("hoogh", "hoo(?:gh|g)"),
+    ("phenix", "(?:ph|f)enix"),
+    ("Thoon", "(?:th|t)oon"),
+    ("bloem", "bloem"),
+    ("st. jan", r"s(?:th|t)\.\ jan"),
+])
+def test_spelling_pattern(term, pattern):
+    assert spelling_pattern(term) == pattern
+
+
+# Every spelling variant, both ways round: (seed term, spelling in the text).
+VARIANTS = [
+    ("vrijheyt", "vryheyt"), ("vryheyt", "vrijheyt"),  # y/ij
+    ("maen", "maan"), ("maan", "maen"),  # ae/aa
+    ("ackerbouw", "akerbouw"), ("akerbouw", "ackerbouw"),  # ck/k
+    ("tuyn", "tuin"), ("tuin", "tuyn"),  # uy/ui
+    ("hoogh", "hoog"), ("hoog", "hoogh"),  # gh/g
+    ("phenix", "fenix"), ("fenix", "phenix"),  # ph/f
+    ("thoon", "toon"), ("toon", "thoon"),  # th/t
+    ("tulp", "Thulpen"),  # variants, inflections and capitals together
+    ("tulp", "tulpaen"),
+]
+
+
+@pytest.mark.parametrize("term, spelling", VARIANTS)
+def test_variant_spellings_match(term, spelling):
+    assert re.fullmatch(spelling_pattern(term) + r"\w*", spelling, re.IGNORECASE)
+    assert LexicalPrefilter([term]).score(f"Int jaer 1637 sagh men {spelling} overal.") == 1
+
+
+@pytest.mark.parametrize("term, text", [
+    ("tulp", "Een stulp in 't velt."),  # only at the start of a word
+    ("tulp", "Tulipaen"),  # forms that differ more must be seed terms themselves
+    ("maen", "men"),
+    ("hoogh", "hooi"),
+])
+def test_other_words_do_not_match(term, text):
+    assert LexicalPrefilter([term]).score(text) == 0
+
+
+RELEVANT = [
+    "De Thulpen bloeyden in den hof van mijn heer.",
+    "Hy kocht een tulpaen voor duysent gulden.",
+    "Soo schoon als TULPEN in de Mey.",
+    "Waer is de tulp\ndie gister stondt?",
+    "In den thuyn stonden roosen ende tulpen.",
+]
+IRRELEVANT = [
+    "Godt is mijn toeverlaet.",
+    "Het schip voer naer Oost-Indien.",
+    "Een stulp van stroo.",
+]
+
+
+@pytest.mark.parametrize("seed_terms", [["tulp"], ["tulp", "tuyn"], ["TULP"]])
+def test_keep_and_skip(seed_terms):
+    prefilter = LexicalPrefilter(seed_terms)
+    chunks = RELEVANT + IRRELEVANT
+    kept, audited = prefilter.select(chunks)
+    # No false negatives: every chunk about tulips goes to the LLM.
+    assert kept == set(range(len(RELEVANT)))
+    assert audited == set()
+    for index, chunk in enumerate(chunks):
+        assert prefilter.decide(index, chunk) == (index in kept, False)
+
+
+def spellings(term: str):
+    """Every spelling of ``term`` that swaps variants of SPELLING_VARIANTS."""
+    pieces = re.split("(" + "|".join(sorted((s for group in SPELLING_VARIANTS for s in group), key=len, reverse=True))
+                      + ")", term)
+    options = [next((group for group in SPELLING_VARIANTS if piece in group), (piece,)) if i % 2 else (piece,)
+               for i, piece in enumerate(pieces)]
+    return {"".join(choice) for choice in itertools.product(*options)}
+
+
+@pytest.mark.parametrize("term", ["thuyn", "vrijheyt", "ghraeck", "philosophy", "tulp"])
+def test_no_spelling_of_a_seed_term_is_dropped(term):
+    prefilter = LexicalPrefilter([term])
+    variants = spellings(term)
+    assert len(variants) > 1
+    for index, spelling in enumerate(sorted(variants)):
+        for chunk in (spelling, f"Ick sagh {spelling.capitalize()}en, soo men seyt.", f"...\n{spelling.upper()}!"):
+            assert prefilter.decide(index, chunk) == (True, False), chunk
+
+
+def test_threshold_and_top_fraction():
+    chunks = ["tulp tulp tulp", "tulp", "niets", "tulp tulp"]
+    assert LexicalPrefilter(["tulp"], threshold=2).select(chunks)[0] == {0, 3}
+    assert LexicalPrefilter(["tulp"], top_fraction=0.5).select(chunks)[0] == {0, 3}
+    with pytest.raises(ValueError):
+        LexicalPrefilter(["tulp"], top_fraction=0.5).decide(0, "tulp")
+    with pytest.raises(ValueError):
+        LexicalPrefilter([])
+
+
+def test_audit_sample_is_stable():
+    chunks = [f"Regel {n} zonder bloemen." for n in range(2000)]
+    prefilter = LexicalPrefilter(["tulp"], audit_rate=0.1)
+    kept, audited = prefilter.select(chunks)
+    assert kept == set()
+    assert 150 < len(audited) < 250
+    # The same sample in a resumed run, and when the chunks are streamed.
+    assert LexicalPrefilter(["tulp"], audit_rate=0.1).select(chunks)[1] == audited
+    assert {i for i, chunk in enumerate(chunks) if prefilter.decide(i, chunk)[1]} == audited
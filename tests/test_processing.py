@@ -0,0 +1,80 @@
+import os
+import pytest
+from dbnl_bear import processing
+from dbnl_bear.fake_server import FakeOpenAIServer
+from dbnl_bear.manifest import RunManifest, MANIFEST_NAME
+from test_ai_read import make_text
+
+
+class Interrupted(BaseException):
+    pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    with FakeOpenAIServer(relevant_terms=("tulp",), relevant_rate=0.0) as server:
+        monkeypatch.setenv("OPENAI_BASE_URL", server.base_url)
+        monkeypatch.setenv("OPENAI_API_KEY", "x")
+        yield server
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    for seed in range(3):
+        (input_dir / f"text{seed}.txt").write_text(make_text("\n\n", "\n", lines=120, seed=seed), encoding="utf-8")
+    return input_dir
+
+
+def outputs(output_dir):
+    return {name: (output_dir / name).read_text(encoding="utf-8") for name in sorted(os.listdir(output_dir))
+            if name.endswith((processing.RELEVANT_SUFFIX, processing.SPANS_SUFFIX))}
+
+
+def run(corpus, output_dir, **options):
+    processing.run_processing("tulips", str(corpus), str(output_dir), use_cache=False, **options)
+
+
+def test_resumed_run_gives_the_same_output(server, corpus, tmp_path, monkeypatch):
+    run(corpus, tmp_path / "full")
+    expected = outputs(tmp_path / "full")
+    requests = server.stats()["requests"]
+    assert len(expected) == 6
+
+    # Stop the run halfway through the second file, as a Ctrl-C would.
+    record_chunk = RunManifest.record_chunk
+    recorded = []
+
+    def interrupt_after_25(self, *args, **kwargs):
+        if len(recorded) == 25:
+            raise Interrupted()
+        recorded.append(args)
+        record_chunk(self, *args, **kwargs)
+
+    monkeypatch.setattr(RunManifest, "record_chunk", interrupt_after_25)
+    with pytest.raises(Interrupted):
+        run(corpus, tmp_path / "resumed")
+    monkeypatch.setattr(RunManifest, "record_chunk", record_chunk)
+    with open(tmp_path / "resumed" / MANIFEST_NAME, "a", encoding="utf-8") as f:
+        f.write('{"file": "text1.txt", "chu')  # cut off by the crash
+    before_resume = server.stats()["requests"]
+
+    run(corpus, tmp_path / "resumed", resume=True)
+    assert outputs(tmp_path / "resumed") == expected
+    # The chunks finished before the interruption were not sent again.
+    assert server.stats()["requests"] - before_resume <= requests - 25
+
+
+def test_manifest_syncs_in_batches(tmp_path, monkeypatch):
+    synced = []
+    monkeypatch.setattr(os, "fsync", lambda fd: synced.append(fd))
+    manifest = RunManifest(str(tmp_path), sync_every=10, sync_interval=3600)
+    for index in range(25):
+        manifest.record_chunk("a.txt", index, False)
+    assert len(synced) == 2
+    manifest.finish_file("a.txt")
+    assert len(synced) == 3
+    manifest.close()
+    assert len(synced) == 3
+    assert RunManifest(str(tmp_path), resume=True).is_done("a.txt")
@@ -0,0 +1,126 @@
+import asyncio
+import pytest
+from dbnl_bear.scheduler import TokenBucket, RequestScheduler
+
+
+class FakeClock:
+    """Time that only moves when something sleeps."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+        await asyncio.sleep(0)
+
+
+class StatusError(Exception):
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.response = type("Response", (), {"headers": {"retry-after": retry_after} if retry_after else {}})()
+
+
+def failing(*errors, result="ok"):
+    """Request factory that raises ``errors`` one by one, then returns ``result``."""
+    errors = list(errors)
+    calls = []
+
+    async def request():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return result
+
+    request.calls = calls
+    return request
+
+
+def test_bucket_refills_at_its_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(60, clock=clock, sleep=clock.sleep)
+
+    async def run():
+        for _ in range(60):
+            await bucket.acquire(1)
+        assert clock.now == 0
+        await bucket.acquire(1)
+        assert clock.now == pytest.approx(1.0)
+        # More than the bucket holds waits for a full bucket.
+        await bucket.acquire(500)
+        assert clock.now == pytest.approx(61.0)
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("status", [429, 500, 503])
+def test_retryable_errors_are_retried_with_backoff(monkeypatch, status):
+    clock = FakeClock()
+    monkeypatch.setattr("dbnl_bear.scheduler.random.uniform", lambda low, high: high)
+    scheduler = RequestScheduler(base_delay=1.0, max_delay=3.0, clock=clock, sleep=clock.sleep)
+    request = failing(*(StatusError(status) for _ in range(3)))
+    assert asyncio.run(scheduler.submit(request)) == "ok"
+    assert len(request.calls) == 4
+    # Exponential, capped at max_delay.
+    assert clock.sleeps == [1.0, 2.0, 3.0]
+    assert scheduler.retries == 3 and scheduler.failures == 0
+
+
+def test_jittered_backoff_stays_below_the_cap():
+    clock = FakeClock()
+    scheduler = RequestScheduler(max_retries=5, base_delay=1.0, max_delay=10.0, clock=clock, sleep=clock.sleep)
+    asyncio.run(scheduler.submit(failing(*(StatusError(429) for _ in range(5)))))
+    assert all(0 <= delay <= min(10.0, 2 ** attempt) for attempt, delay in enumerate(clock.sleeps))
+
+
+def test_retry_after_header_is_honored():
+    clock = FakeClock()
+    scheduler = RequestScheduler(clock=clock, sleep=clock.sleep)
+    assert asyncio.run(scheduler.submit(failing(StatusError(429, retry_after="7")))) == "ok"
+    assert clock.sleeps == [7.0]
+
+
+def test_other_errors_are_raised_at_once():
+    clock = FakeClock()
+    scheduler = RequestScheduler(clock=clock, sleep=clock.sleep)
+    request = failing(StatusError(400))
+    with pytest.raises(StatusError):
+        asyncio.run(scheduler.submit(request))
+    assert len(request.calls) == 1 and clock.sleeps == [] and scheduler.failures == 1
+
+
+def test_last_retryable_error_is_raised():
+    clock = FakeClock()
+    scheduler = RequestScheduler(max_retries=2, clock=clock, sleep=clock.sleep)
+    request = failing(*(StatusError(500) for _ in range(3)))
+    with pytest.raises(StatusError):
+        asyncio.run(scheduler.submit(request))
+    assert len(request.calls) == 3 and scheduler.failures == 1
+
+
+def test_waiting_for_rate_budget_holds_no_slot():
+    clock = FakeClock()
+
+    async def run():
+        opened = asyncio.Event()
+
+        async def blocked_sleep(seconds):
+            await opened.wait()
+            await clock.sleep(seconds)
+
+        scheduler = RequestScheduler(requests_per_minute=1, max_in_flight=1, clock=clock, sleep=blocked_sleep)
+        assert await scheduler.submit(failing()) == "ok"
+        waiting = asyncio.create_task(scheduler.submit(failing()))
+        await asyncio.sleep(0.01)
+        # The second request waits for the request bucket, not for the only slot.
+        assert not waiting.done() and scheduler.queue_depth == 1
+        assert not scheduler._semaphore.locked()
+        opened.set()
+        assert await waiting == "ok"
+
+    asyncio.run(run())
@@ -0,0 +1,73 @@
+import pytest
+from dbnl_bear.segment import SegmentSplitter
+from test_ai_read import make_text
+
+
+def words(text: str) -> int:
+    return len(text.split())
+
+
+def sentences(text: str):
+    splitter = SegmentSplitter(count_tokens=words)
+    return [text[pieces[0][0]:pieces[-1][1]] for pieces in splitter.sentences(text)]
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Sie Joh. 3 vers 16. Soo lief heeft Godt de wereldt.",
+     ["Sie Joh. 3 vers 16.", "Soo lief heeft Godt de wereldt."]),
+    ("St. Jan ende Mr. Pieter quamen. Sy aten.", ["St. Jan ende Mr. Pieter quamen.", "Sy aten."]),
+    ("Gedruckt by H. Jansz. Te Amsterdam.", ["Gedruckt by H. Jansz.", "Te Amsterdam."]),
+    ("Sie fol. 12 ende cap. Vier. Daer staet het.", ["Sie fol. 12 ende cap. Vier.", "Daer staet het."]),
+    ("Hy riep: 'Waer is hy?' Niemandt wist het.", ["Hy riep: 'Waer is hy?'", "Niemandt wist het."]),
+])
+def test_abbreviations_and_initials_do_not_end_sentences(text, expected):
+    assert sentences(text) == expected
+
+
+def test_verse_sentences_run_over_line_breaks():
+    verse = ("O tulp, die in den hof\n"
+             "Soo heerlijck staet te pronken,\n"
+             "Ghy zijt maer stof.\n"
+             "Wat baet u al dat gloncken?")
+    assert sentences(verse) == [
+        "O tulp, die in den hof\nSoo heerlijck staet te pronken,\nGhy zijt maer stof.",
+        "Wat baet u al dat gloncken?",
+    ]
+    splitter = SegmentSplitter(max_tokens=15, count_tokens=words)
+    # Whole sentences per chunk: the first does not fit together with the second.
+    assert splitter.split_text(verse) == sentences(verse)
+
+
+def test_sentence_over_budget_is_packed_by_pieces_and_words():
+    text = ("Eerst quam de tulp; daer na de roos; en ten lesten de lely, "
+            "die alle andere bloemen in schoonheyt en geur en verwe verre te boven ging.")
+    splitter = SegmentSplitter(max_tokens=6, count_tokens=words)
+    chunks = splitter.split_with_offsets(text)
+    assert all(words(chunk) <= 6 for chunk, _, _ in chunks)
+    assert all(text[start:end] == chunk for chunk, start, end in chunks)
+    # The clauses that fit stay whole; the long one is cut at words, which fill up the chunks.
+    assert [chunk for chunk, _, _ in chunks[:3]] == ["Eerst quam de tulp;", "daer na de roos; en ten",
+                                                      "lesten de lely, die alle andere"]
+    assert " ".join(chunk for chunk, _, _ in chunks).split() == text.split()
+
+
+def test_word_longer_than_the_budget_is_a_chunk_of_its_own():
+    splitter = SegmentSplitter(max_tokens=2, count_tokens=len)
+    assert splitter.split_text("ab Amsterdamsche cd") == ["ab", "Amsterdamsche", "cd"]
+
+
+@pytest.mark.parametrize("max_tokens", [8, 32, 256])
+@pytest.mark.parametrize("line_break", ["\n", "\n\n", " "])
+def test_starts_sentence_agrees_with_split_text(max_tokens, line_break):
+    text = make_text("\n\n", line_break, lines=300, seed=max_tokens)
+    splitter = SegmentSplitter(max_tokens)
+    chunks = splitter.split_with_offsets(text)
+    boundaries = {start for pieces in splitter.sentences(text) for start, _, _ in pieces[:1]}
+    for chunk, start, end in chunks:
+        assert splitter.starts_sentence(text, start) == (start in boundaries)
+        if splitter.starts_sentence(text, start):
+            # Splitting from a sentence start gives the same chunks as splitting the whole text.
+            assert [c for c, _, _ in splitter.split_with_offsets(text[start:])][:3] == \
+                [c for c, s, _ in chunks if s >= start][:3]
+    for position in range(0, len(text), 97):
+        assert splitter.starts_sentence(text, position) == (position in boundaries)
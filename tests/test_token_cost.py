@@ -0,0 +1,32 @@
+import asyncio
+import pytest
+from dbnl_bear.token_cost import CostBudget, BudgetExceeded
+
+
+def test_reservations_wait_for_open_ones():
+    async def run():
+        budget = CostBudget(1.0)
+        first = await budget.reserve(0.6)
+        waiting = asyncio.create_task(budget.reserve(0.6))
+        await asyncio.sleep(0.01)
+        assert not waiting.done() and not budget.exhausted
+        # The first request turns out cheap: the second one fits now.
+        budget.spend(0.1)
+        budget.release(first)
+        assert await asyncio.wait_for(waiting, 1) == 0.6
+        assert budget.reserved == pytest.approx(0.6)
+
+    asyncio.run(run())
+
+
+def test_refused_once_spending_alone_would_go_over():
+    async def run():
+        budget = CostBudget(1.0)
+        budget.spend(0.7)
+        with pytest.raises(BudgetExceeded):
+            await budget.reserve(0.4)
+        assert budget.exhausted
+        with pytest.raises(BudgetExceeded):
+            await budget.reserve(0.01)
+
+    asyncio.run(run())
@@ -0,0 +1,78 @@
+import time
+from dbnl_bear import ai_read
+from dbnl_bear.work_queue import WorkQueue, enqueue_corpus
+from test_ai_read import make_text
+
+
+def test_expired_leases_count_as_attempts(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"), max_attempts=3)
+    queue.add("a.txt", 0, 10)
+    for attempt in range(3):
+        item = queue.claim(f"worker-{attempt}", lease_seconds=0.01)
+        assert item is not None and item[1] == "a.txt"
+        # The worker dies: no heartbeat, no complete, no fail.
+        time.sleep(0.05)
+    assert queue.claim("worker-3", lease_seconds=0.01) is None
+    assert queue.progress() == {"pending": 0, "leased": 0, "done": 0, "failed": 1}
+    assert queue.unfinished() == 0
+    queue.close()
+
+
+def test_failures_and_expired_leases_share_the_attempt_limit(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"), max_attempts=2)
+    queue.add("a.txt", 0, 10)
+    item = queue.claim("worker-0", lease_seconds=60)
+    queue.fail(item[0], "worker-0", "boom")
+    item = queue.claim("worker-1", lease_seconds=0.01)
+    time.sleep(0.05)
+    assert queue.claim("worker-2", lease_seconds=60) is None
+    assert queue.progress()["failed"] == 1
+    queue.close()
+
+
+def test_live_lease_is_not_taken_over(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"))
+    queue.add("a.txt", 0, 10)
+    item = queue.claim("worker-0", lease_seconds=60)
+    assert queue.claim("worker-1", lease_seconds=60) is None
+    assert queue.heartbeat(item[0], "worker-0", 60)
+    assert queue.complete(item[0], "worker-0")
+    assert queue.progress()["done"] == 1
+    queue.close()
+
+
+def test_requeue_failed(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"), max_attempts=1)
+    queue.add("a.txt", 0, 10)
+    queue.add("a.txt", 10, 20)
+    item = queue.claim("worker-0", lease_seconds=60)
+    queue.fail(item[0], "worker-0", "boom")
+    assert queue.progress()["failed"] == 1
+    assert queue.requeue_failed() == 1
+    assert queue.progress() == {"pending": 2, "leased": 0, "done": 0, "failed": 0}
+    # A fresh set of attempts.
+    assert queue.claim("worker-1", lease_seconds=60)[0] == item[0]
+    queue.close()
+
+
+def test_items_stream_from_their_resume_point(tmp_path):
+    text = make_text("\n\n", "\n", lines=30000)
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    (input_dir / "a.txt").write_text(text, encoding="utf-8")
+    queue_path = str(tmp_path / "queue.sqlite")
+    items = enqueue_corpus(queue_path, "tulips", str(input_dir), str(tmp_path / "out"), chunks_per_item=500)
+    expected = ai_read.split_with_offsets(text)
+    assert items == -(-len(expected) // 500)
+
+    queue = WorkQueue(queue_path)
+    resumed = 0
+    while (item := queue.claim("worker-0", lease_seconds=60)) is not None:
+        _, file, first, last, resume = item
+        resumed += resume is not None
+        index = resume[0] if resume else 0
+        chunks = ai_read.iter_chunks_with_offsets(str(input_dir / file), resume=resume)
+        assert [chunk for i, chunk in enumerate(chunks, start=index) if first <= i < last] == expected[first:last]
+        queue.complete(item[0], "worker-0")
+    assert resumed > 0
+    queue.close()